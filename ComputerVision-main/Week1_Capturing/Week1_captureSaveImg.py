@@ -3,8 +3,13 @@ import os
 import numpy as np
 
 class CaptureSaveImgProcessor:
-    def __init__(self):
-        pass
+    def __init__(self, writer=None):
+        """
+        Args:
+            writer: Optional AsyncImageWriter; when given, images are queued
+                    and written in the background instead of synchronously
+        """
+        self.writer = writer
     
     # =============================================================================
     # STEP 1: BASIC IMAGE CAPTURE (Weeks 1-2)
@@ -19,7 +24,7 @@ class CaptureSaveImgProcessor:
             filename: Path to save the image
             
         Returns:
-            bool: True if successful, False otherwise
+            bool: True if successful (or queued, with a writer), False otherwise
         """
         # TODO: Implement image capture and saving
         # Sinh viên cần:
@@ -32,6 +37,10 @@ class CaptureSaveImgProcessor:
             if bgr_img is None or not isinstance(bgr_img, np.ndarray):
                 return False
 
+            # Ghi ảnh ở luồng nền nếu có writer
+            if self.writer is not None:
+                return self.writer.submit(bgr_img, filename)
+
             # 2. Tạo thư mục CapturedImage nếu chưa tồn tại
             save_dir = "CapturedImage"
             if not os.path.exists(save_dir):
@@ -1,19 +1,137 @@
-from flask import Flask, render_template, Response, request, jsonify
+from flask import Flask, render_template, Response, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 import cv2
+import os
 import threading
 import time
 import base64
+import json
+import uuid
 import numpy as np
-from process import ImageProcessor
-from camera import VideoCamera
+from process import image_writer
+from registry import CameraRegistry
+from intermediates import shared_cache
+from streams import ProcessedStreamHub
+from results import ResultStore
+from process_pool import ProcessingExecutor
+from pipeline import check_scale, effective_scale, get_pipeline, FullResTimings
+from scheduler import FrameScheduler, NoFrameError, SchedulerClosedError
+from calibration import Calibration, calibration_store
+from recording import CameraRecorder, RECORDING_DIR, REPLAY_SCHEME
+import metrics
+
+HTTP_SECONDS = metrics.histogram('cv_http_request_seconds', 'Request handling time (until the body starts streaming)', ('endpoint',))
+JSON_SECONDS = metrics.histogram('cv_json_serialize_seconds', 'Time serializing JSON responses')
+ENCODE_SECONDS = metrics.histogram('cv_jpeg_encode_seconds', 'Time encoding result JPEGs', ('kind',))
+BASE64_SECONDS = metrics.histogram('cv_base64_seconds', 'Time building base64 data URIs')
+MJPEG_SEND_SECONDS = metrics.histogram('cv_mjpeg_send_seconds', 'Time the server takes to send one MJPEG part', ('camera', 'stream'))
+VIEWERS = metrics.gauge('cv_mjpeg_viewers', 'Open MJPEG connections', ('camera', 'stream'))
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # every jsonify() goes through dumps, so this times all JSON responses
+    def dumps(self, obj, **kwargs):
+        t0 = time.perf_counter()
+        out = super().dumps(obj, **kwargs)
+        JSON_SECONDS.observe(time.perf_counter() - t0)
+        return out
+
+
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
+
+
+# configured cameras; each one decodes only while it has consumers and is
+# stopped CV_CAMERA_IDLE_TIMEOUT seconds after the last one leaves
+CAMERA_IDLE_TIMEOUT = float(os.environ.get('CV_CAMERA_IDLE_TIMEOUT', '30'))
+CAMERA_MAX_FPS = float(os.environ.get('CV_CAMERA_MAX_FPS', '0')) or None
+# frames nobody is waiting for are grabbed but only decoded this often
+# (bounds how stale /snapshot and /capture frames can be); 0 decodes all
+CAMERA_DECODE_FPS = float(os.environ.get('CV_CAMERA_DECODE_FPS', '5')) or None
+cameras = CameraRegistry(idle_timeout=CAMERA_IDLE_TIMEOUT, max_fps=CAMERA_MAX_FPS,
+                         decode_fps=CAMERA_DECODE_FPS)
+# the page has two columns, cameras 1 and 2; more can be added via /cameras
+cameras.add(1)
+cameras.add(2)
+
+# calibrations saved by a previous run (CV_CALIBRATION_DIR); processors
+# pick them up on first use and whenever a file changes
+for _cam_id in cameras.ids():
+    try:
+        if calibration_store.load(_cam_id) is not None:
+            print(f"Loaded calibration for camera {_cam_id}")
+    except ValueError as e:
+        print(f"Ignoring calibration for camera {_cam_id}: {e}")
+
+# raw frame recordings in progress, cam_id -> CameraRecorder (see /record)
+recorders = {}
+recorders_lock = threading.Lock()
+
+# extra /stats sections, name -> callable (e.g. the async server's)
+stats_providers = {}
+
+# full resolution cost per filter spec, to report the speedup of scaled runs
+full_res_timings = FullResTimings()
+
+# one latest-frame-wins scheduler per camera for /capture and /apply_filter
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+def scheduler_for(cam_id):
+    # the camera's scheduler, created on first use
+    cam = cameras[cam_id]
+    with schedulers_lock:
+        sched = schedulers.get(cam_id)
+        if sched is None or sched.cam is not cam:
+            if sched is not None:
+                # the camera was removed and added again
+                sched.close()
+            sched = schedulers[cam_id] = FrameScheduler(cam)
+        return sched
+
+# 'thread' runs filters in the request thread; 'pool' runs them in worker
+# processes (frames passed through shared memory), one worker per camera
+PROCESSING_MODE = os.environ.get('CV_PROCESSING_MODE', 'thread')
+PROCESSING_WORKERS = int(os.environ.get('CV_PROCESSING_WORKERS', '0')) or None
+executor = ProcessingExecutor(PROCESSING_MODE, PROCESSING_WORKERS)
+
+# filtered streams, one worker per (camera, filter) with viewers; filters
+# run on the executor, so they follow CV_PROCESSING_MODE
+processed_streams = ProcessedStreamHub(executor)
+
+# encoded /capture and /apply_filter images, fetched via /result/<id>
+results_store = ResultStore()
+# distinguishes frame ETags of this process from those of a previous run
+BOOT_ID = uuid.uuid4().hex[:8]
 
+metrics.callback_gauge('cv_camera_fps', 'Achieved reader frame rate', ('camera',),
+                       lambda: {(str(cam_id),): cam.fps for cam_id, cam in cameras.items()})
+metrics.callback_gauge('cv_camera_latency_seconds', 'Frame arrival to consumer wake-up (moving average)', ('camera',),
+                       lambda: {(str(cam_id),): cam.latency_ms / 1000 for cam_id, cam in cameras.items()})
+metrics.callback_gauge('cv_processed_stream_fps', 'Filtered stream frame rate', ('camera', 'filter'),
+                       lambda: {(str(s['cam_id']), s['filter']): s['fps'] for s in processed_streams.get_stats()})
+metrics.callback_gauge('cv_motion_score', 'Fraction of the frame moving (motion-gated filtered streams)', ('camera', 'filter'),
+                       lambda: {(str(s['cam_id']), s['filter']): s['motion_score'] for s in processed_streams.get_stats()
+                                if s['motion_score'] is not None})
+metrics.callback_gauge('cv_scheduler_queue_depth', 'Queued capture/filter jobs', ('camera',),
+                       lambda: {(str(cam_id),): len(sched.queue) for cam_id, sched in list(schedulers.items())})
+metrics.callback_gauge('cv_camera_consumers', 'Viewers and requests using the camera', ('camera',),
+                       lambda: {(str(cam_id),): s['consumers'] for cam_id, s in cameras.get_stats().items()})
+metrics.callback_gauge('cv_camera_live', '1 while the camera is delivering frames', ('camera',),
+                       lambda: {(str(cam_id),): int(cam.state == 'live') for cam_id, cam in cameras.items()})
+metrics.callback_gauge('cv_camera_cpu_percent', 'Reader thread CPU use (percent of one core)', ('camera',),
+                       lambda: {(str(cam_id),): cam.cpu_percent for cam_id, cam in cameras.items()})
 
-# initialize two camera handlers (two columns)
-cameras = {
-    1: VideoCamera(),
-    2: VideoCamera()
-}
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_request_time(resp):
+    start = g.get('start_time')
+    if start is not None:
+        HTTP_SECONDS.observe(time.perf_counter() - start, request.endpoint or 'unknown')
+    return resp
 
 # --- Routes ---
 @app.route('/')
@@ -21,25 +139,66 @@ def index():
     return render_template('index.html')
 
 def mjpeg_generator(cam_id):
-    cam = cameras.get(cam_id)
+    # the viewer keeps the camera running (started on connect if idle)
+    cam = cameras.acquire(cam_id)
     if cam is None:
         return
+    try:
+        yield from mjpeg_stream(cam, cam_id, 'raw')
+    finally:
+        cameras.release(cam_id)
+
+def mjpeg_stream(source, cam_id, kind):
+    # source: anything with wait_for_jpeg(after_seq, timeout), i.e. a
+    # VideoCamera or a ProcessedStream; cam_id and kind label the metrics
+    labels = (str(cam_id), kind)
+    VIEWERS.inc(*labels)
+    try:
+        yield from _mjpeg_parts(source, labels)
+    finally:
+        VIEWERS.dec(*labels)
+
+def _mjpeg_parts(source, labels):
     boundary = b'--frame'
+    seq = -1
+    frame_bytes = None
     while True:
-        frame_bytes = cam.get_frame_jpeg()
-        if frame_bytes:
-            yield b'%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (boundary, len(frame_bytes), frame_bytes)
-        else:
-            # serve a small blank JPEG fallback so client doesn't break
-            blank = create_blank_jpeg()
-            yield b'%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (boundary, len(blank), blank)
-        time.sleep(0.04)
+        # wake up as soon as the source has a frame newer than the last one sent;
+        # bytes are shared with every other viewer of this source
+        new_seq, new_bytes = source.wait_for_jpeg(seq, timeout=1.0)
+        if new_bytes:
+            seq, frame_bytes = new_seq, new_bytes
+        elif new_seq > seq:
+            # camera stopped or has no frame yet
+            seq, frame_bytes = new_seq, None
+        # on timeout the previous frame is re-sent as a keep-alive; without
+        # a frame serve a small blank JPEG fallback so client doesn't break
+        body = frame_bytes or create_blank_jpeg()
+        part = b'%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (boundary, len(body), body)
+        # the generator is suspended while the server writes the part
+        t0 = time.perf_counter()
+        yield part
+        MJPEG_SEND_SECONDS.observe(time.perf_counter() - t0, *labels)
+
+def processed_mjpeg_generator(stream):
+    cameras.acquire(stream.cam_id)
+    try:
+        yield from mjpeg_stream(stream, stream.cam_id, 'processed')
+    finally:
+        # runs when the client disconnects and the response is closed
+        processed_streams.unsubscribe(stream)
+        cameras.release(stream.cam_id)
+
+_blank_jpeg = None
 
 def create_blank_jpeg():
-    # create gray placeholder
-    img = 128 * np.ones((240, 320, 3), dtype=np.uint8)
-    ret, jpeg = cv2.imencode('.jpg', img)
-    return jpeg.tobytes() if ret else b''
+    # create gray placeholder (encoded once, then reused)
+    global _blank_jpeg
+    if _blank_jpeg is None:
+        img = 128 * np.ones((240, 320, 3), dtype=np.uint8)
+        ret, jpeg = cv2.imencode('.jpg', img)
+        _blank_jpeg = jpeg.tobytes() if ret else b''
+    return _blank_jpeg
 
 @app.route('/video_feed/<int:cam_id>')
 def video_feed(cam_id):
@@ -47,30 +206,311 @@ def video_feed(cam_id):
     return Response(mjpeg_generator(cam_id),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/processed_feed/<int:cam_id>')
+def processed_feed(cam_id):
+    """
+    Filtered MJPEG stream, e.g. /processed_feed/1?filter=gaussian|canny&scale=0.5
+    
+    The filter runs once per camera frame on a shared worker, whatever the
+    number of viewers; stale frames are skipped when filtering is slower
+    than the camera.
+    """
+    if cam_id not in cameras:
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
+    spec = request.args.get('filter', 'grayscale')
+    try:
+        stream = processed_streams.subscribe(cam_id, cameras[cam_id], spec,
+                                             request.args.get('scale', 1.0))
+    except KeyError:
+        # removed since the check above
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 404
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    return Response(processed_mjpeg_generator(stream),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/stats')
+def stats():
+    # achieved fps and frame-to-viewer latency per camera
+    stats = {
+        **{name: provider() for name, provider in list(stats_providers.items())},
+        'ok': True,
+        'cameras': cameras.get_stats(),
+        'intermediate_cache': shared_cache.get_stats(),
+        'processed_streams': processed_streams.get_stats(),
+        'results_store': results_store.get_stats(),
+        'processing': executor.get_stats(),
+        'schedulers': {cam_id: sched.get_stats() for cam_id, sched in list(schedulers.items())},
+        'recorders': {cam_id: rec.get_stats() for cam_id, rec in list(recorders.items())}
+    }
+    if executor.mode == 'thread':
+        # in pool mode captures are written by the workers' own writers,
+        # reported per worker under processing.workers
+        stats['image_writer'] = image_writer.get_stats()
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format; CV_METRICS=0 disables collection and this endpoint
+    if not metrics.ENABLED:
+        return Response('metrics disabled (CV_METRICS=0)\n', status=404, mimetype='text/plain')
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/cameras', methods=['GET'])
+def list_cameras():
+    # per-camera source, fps, cpu, consumers and idle time
+    return jsonify({'ok': True, 'cameras': cameras.get_stats()})
+
+@app.route('/health')
+def health():
+    """
+    Connection health per camera (state, frame age, reconnects, last error)
+
+    503 when a started camera is not live, so load balancers and
+    monitoring can alert on dead or flapping sources.
+    """
+    states = {cam_id: cam.get_health() for cam_id, cam in cameras.items()}
+    ok = all(h['state'] in ('stopped', 'live', 'ended') for h in states.values())
+    return jsonify({'ok': ok, 'cameras': states}), 200 if ok else 503
+
+@app.route('/cameras', methods=['POST'])
+def add_camera():
+    """
+    Register a camera
+
+    Payload: { cam_id: int (optional, default next free id),
+               source: str (optional), max_fps: float (optional) }
+
+    The camera starts when it is first used, not here.
+    """
+    data = request.get_json() or {}
+    try:
+        cam_id = int(data['cam_id']) if data.get('cam_id') is not None else max(cameras.ids(), default=0) + 1
+        max_fps = float(data['max_fps']) if data.get('max_fps') else None
+        cameras.add(cam_id, (data.get('source') or '').strip(), max_fps)
+    except (TypeError, ValueError) as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    return jsonify({'ok': True, 'cam_id': cam_id})
+
+@app.route('/cameras/<int:cam_id>', methods=['DELETE'])
+def remove_camera(cam_id):
+    try:
+        cameras.remove(cam_id)
+    except KeyError:
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 404
+    with schedulers_lock:
+        sched = schedulers.pop(cam_id, None)
+    if sched is not None:
+        sched.close()
+    executor.discard(cam_id)
+    return jsonify({'ok': True})
+
+@app.route('/calibration/<int:cam_id>', methods=['GET'])
+def get_calibration(cam_id):
+    try:
+        calibration = calibration_store.load(cam_id)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 500
+    return jsonify({'ok': True, 'calibration': None if calibration is None else calibration.to_dict()})
+
+@app.route('/calibration/<int:cam_id>', methods=['POST'])
+def set_calibration(cam_id):
+    """
+    Save a camera's calibration (step 4), applied by process_frame
+
+    Payload: { camera_matrix: 3x3, dist_coeffs: list, homography: 3x3,
+               resolution: [width, height], alpha: float } (all optional,
+               but a camera_matrix or a homography is required)
+
+    The calibration is written to disk, so it survives restarts; remap
+    tables are rebuilt on the next frame.
+    """
+    if cam_id not in cameras:
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
+    try:
+        calibration = Calibration.from_dict(request.get_json() or {})
+    except (TypeError, ValueError) as e:
+        return jsonify({'ok': False, 'error': f'invalid calibration: {e}'}), 400
+    calibration_store.save(cam_id, calibration)
+    return jsonify({'ok': True, 'calibration': calibration.to_dict()})
+
+@app.route('/calibration/<int:cam_id>', methods=['DELETE'])
+def delete_calibration(cam_id):
+    return jsonify({'ok': calibration_store.delete(cam_id)})
+
+@app.route('/record/<int:cam_id>', methods=['POST'])
+def start_recording(cam_id):
+    """
+    Record a camera's raw frames into a ring file under CV_RECORDING_DIR
+
+    Payload: { name: str (optional, default cam_<id>.ring),
+               capacity: int (optional, frames kept, default 300),
+               overwrite: bool (optional, replace an existing file) }
+
+    The camera is kept running while recording. Play the file back with
+    the source returned in 'replay' (append ?speed=max for load tests).
+    """
+    data = request.get_json(silent=True) or {}
+    name = os.path.basename(str(data.get('name') or f'cam_{cam_id}.ring'))
+    try:
+        capacity = int(data.get('capacity', 300))
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        overwrite = parse_flag(data.get('overwrite', False))
+    except (TypeError, ValueError) as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    with recorders_lock:
+        if cam_id in recorders:
+            return jsonify({'ok': False, 'error': 'already recording'}), 409
+        cam = cameras.acquire(cam_id)
+        if cam is None:
+            return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
+        os.makedirs(RECORDING_DIR, exist_ok=True)
+        path = os.path.abspath(os.path.join(RECORDING_DIR, name))
+        if os.path.exists(path) and not overwrite:
+            cameras.release(cam_id)
+            return jsonify({'ok': False, 'error': f'{name} exists (set overwrite to replace it)'}), 409
+        recorders[cam_id] = CameraRecorder(cam, path, capacity, overwrite).start()
+    return jsonify({'ok': True, 'path': path, 'replay': REPLAY_SCHEME + path})
+
+@app.route('/record/<int:cam_id>', methods=['DELETE'])
+def stop_recording(cam_id):
+    with recorders_lock:
+        recorder = recorders.pop(cam_id, None)
+    if recorder is None:
+        return jsonify({'ok': False, 'error': 'not recording'}), 404
+    recorder.stop()
+    cameras.release(cam_id)
+    return jsonify({'ok': True, 'recording': recorder.get_stats()})
+
 @app.route('/set_source', methods=['POST'])
 def set_source():
-    # payload: { cam_id: int, source: str }
+    # payload: { cam_id: int, source: str, max_fps: float (optional) }
     data = request.get_json()
     cam_id = int(data.get('cam_id'))
     source = data.get('source', '').strip()
     if cam_id not in cameras:
         return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
-    if source == '':
-        # stop camera if empty
-        cameras[cam_id].stop()
-        return jsonify({'ok': True, 'msg': 'stopped'})
+    max_fps = data.get('max_fps')
     try:
-        cameras[cam_id].start(source)
+        # empty source stops the camera
+        cameras.set_source(cam_id, source, None if max_fps is None else float(max_fps))
+        if source == '':
+            return jsonify({'ok': True, 'msg': 'stopped'})
         return jsonify({'ok': True})
     except Exception as e:
         return jsonify({'ok': False, 'error': str(e)}), 500
 
+def encode_jpeg(img, quality=90, kind='result'):
+    # JPEG bytes of img, or None if encoding failed
+    t0 = time.perf_counter()
+    ret, jpg = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    ENCODE_SECONDS.observe(time.perf_counter() - t0, kind)
+    return jpg.tobytes() if ret else None
+
+def to_data_uri(raw):
+    t0 = time.perf_counter()
+    uri = 'data:image/jpeg;base64,' + base64.b64encode(raw).decode('utf-8')
+    BASE64_SECONDS.observe(time.perf_counter() - t0)
+    return uri
+
+RESPONSE_MODES = ('json', 'url', 'binary')
+
+def response_mode(data):
+    """
+    How /capture and /apply_filter return images
+    
+        - 'json' (default): base64 data URIs inside the JSON body
+        - 'url': JSON with /result/<id> URLs the client loads as normal images
+        - 'binary': the image bytes themselves, metadata in X-* headers
+    
+    Taken from the 'response' field of the payload; without it, a request
+    that prefers image/jpeg or multipart/mixed in its Accept header gets 'binary'.
+    """
+    mode = (data.get('response') or '').strip().lower()
+    if mode:
+        return mode
+    best = request.accept_mimetypes.best_match(['application/json', 'image/jpeg', 'multipart/mixed'])
+    return 'binary' if best in ('image/jpeg', 'multipart/mixed') else 'json'
+
+def parse_flag(value):
+    # JSON true/false, 1/0, or the strings 'true'/'false', '1'/'0', 'yes'/'no', 'on'/'off'
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        flag = value.strip().lower()
+        if flag in ('true', '1', 'yes', 'on'):
+            return True
+        if flag in ('false', '0', 'no', 'off'):
+            return False
+    raise ValueError(f"expected true or false, got {value!r}")
+
+def image_response(raw, result_id, headers):
+    # raw JPEG body; the result never changes so its id is a strong ETag
+    resp = Response(raw, mimetype='image/jpeg', headers=headers)
+    resp.set_etag(result_id)
+    resp.headers['X-Result-Id'] = result_id
+    resp.headers['Cache-Control'] = 'private, max-age=3600, immutable'
+    return resp.make_conditional(request)
+
+def multipart_response(parts, headers):
+    # multipart/mixed body with one part per (name, content type, bytes, result_id or None)
+    boundary = uuid.uuid4().hex
+    body = b''.join(
+        b'--%s\r\nContent-Type: %s\r\nContent-Disposition: inline; name="%s"\r\n'
+        b'%sContent-Length: %d\r\n\r\n%s\r\n'
+        % (boundary.encode(), content_type.encode(), name.encode(),
+           b'' if result_id is None else b'X-Result-Id: %s\r\n' % result_id.encode(), len(raw), raw)
+        for name, content_type, raw, result_id in parts
+    ) + b'--%s--\r\n' % boundary.encode()
+    return Response(body, mimetype=f'multipart/mixed; boundary={boundary}', headers=headers)
+
+@app.route('/result/<result_id>')
+def get_result(result_id):
+    # result images from /capture and /apply_filter (response: 'url' or 'binary')
+    entry = results_store.get(result_id)
+    if entry is None:
+        return jsonify({'ok': False, 'error': 'unknown or expired result'}), 404
+    raw, mimetype = entry
+    resp = Response(raw, mimetype=mimetype)
+    resp.set_etag(result_id)
+    resp.headers['Cache-Control'] = 'private, max-age=3600, immutable'
+    return resp.make_conditional(request)
+
+@app.route('/snapshot/<int:cam_id>')
+def snapshot(cam_id):
+    """
+    Current frame of a camera as image/jpeg
+    
+    The ETag names the frame, so a client polling with If-None-Match gets
+    304 Not Modified (no encode, no body) until the camera has a new frame.
+    """
+    if cam_id not in cameras:
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
+    with cameras.use(cam_id) as cam:
+        if cam is None:
+            return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
+        etag = f'{BOOT_ID}-{cam_id}-{cam.get_frame_seq()[0]}'
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+        seq, raw = cam.get_frame_jpeg_seq()
+    if raw is None:
+        return jsonify({'ok': False, 'error': 'no frame yet'}), 404
+    resp = Response(raw, mimetype='image/jpeg')
+    resp.set_etag(f'{BOOT_ID}-{cam_id}-{seq}')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 @app.route('/capture', methods=['POST'])
 def capture():
     """
     Capture image from camera and process it
     
-    Payload: { cam_id: int, step: str (optional) }
+    Payload: { cam_id: int, step: str (optional), response: str (optional) }
     
     Step options:
         - 'preprocess': Step 2 - Grayscale, Gaussian, Edge Detection
@@ -81,46 +521,66 @@ def capture():
         - 'track': Step 7 - Object tracking
         - 'license_plate': Steps 8-9 - License plate detection & OCR
         - 'all': Complete pipeline (default)
+    
+    Response options (see response_mode): 'json', 'url', or 'binary'
+    (multipart/mixed with JPEG parts 'image' and 'processed' and an
+    application/json part 'results'; results can grow with the number of
+    tracked objects, so they are not sent as a header).
     """
     data = request.get_json()
     cam_id = int(data.get('cam_id'))
     # step = data.get('step', 'all')  # Default to 'all' if not specified
+    mode = response_mode(data)
     
     if cam_id not in cameras:
         return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
+    if mode not in RESPONSE_MODES:
+        return jsonify({'ok': False, 'error': 'invalid response mode'}), 400
     
-    cam = cameras[cam_id]
-    frame = cam.get_frame_bgr()
-    if frame is None:
+    # Process the newest frame; concurrent captures share one run
+    try:
+        with cameras.use(cam_id):
+            _, (raw, processed, results, process_time_ms) = scheduler_for(cam_id).submit(
+                ('capture',), lambda seq, frame: (encode_jpeg(frame, kind='capture'), *executor.process_frame(cam_id, frame)))
+    except SchedulerClosedError:
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 404
+    except NoFrameError:
         return jsonify({'ok': False, 'error': 'no frame yet'}), 400
+    except Exception as e:
+        return jsonify({'ok': False, 'error': f'Processing failed: {str(e)}'}), 500
 
-    # Convert BGR -> JPEG base64 for immediate display (original image)
-    ret, jpg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-    if not ret:
+    # Encoded BGR -> JPEG for immediate display (original image)
+    if raw is None:
         return jsonify({'ok': False, 'error': 'encode_failed'}), 500
-    raw = jpg.tobytes()
-    b64 = base64.b64encode(raw).decode('utf-8')
-    data_uri = 'data:image/jpeg;base64,' + b64
 
-    # Process image using ImageProcessor
     try:
-        processor = ImageProcessor()
-        processed, results, process_time_ms = processor.process_frame(frame)
-        
-        # Convert processed image to base64
-        ret2, jpg2 = cv2.imencode('.jpg', processed, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-        if not ret2:
+        raw2 = encode_jpeg(processed, kind='processed')
+        if raw2 is None:
             return jsonify({'ok': False, 'error': 'processed_encode_failed'}), 500
-        raw2 = jpg2.tobytes()
-        b642 = base64.b64encode(raw2).decode('utf-8')
-        processed_uri = 'data:image/jpeg;base64,' + b642
         
+        if mode == 'json':
+            return jsonify({
+                'ok': True, 
+                'image': to_data_uri(raw), 
+                'processed': to_data_uri(raw2), 
+                'process_time_ms': round(process_time_ms, 2),
+                'results': results,  # Additional processing results
+                'step': "all"
+            })
+        
+        image_id = results_store.put(raw)
+        processed_id = results_store.put(raw2)
+        if mode == 'binary':
+            return multipart_response(
+                [('image', 'image/jpeg', raw, image_id), ('processed', 'image/jpeg', raw2, processed_id),
+                 ('results', 'application/json', app.json.dumps(results).encode(), None)],
+                {'X-Process-Time-Ms': f'{process_time_ms:.2f}', 'X-Step': 'all'})
         return jsonify({
-            'ok': True, 
-            'image': data_uri, 
-            'processed': processed_uri, 
+            'ok': True,
+            'image': f'/result/{image_id}',
+            'processed': f'/result/{processed_id}',
             'process_time_ms': round(process_time_ms, 2),
-            'results': results,  # Additional processing results
+            'results': results,
             'step': "all"
         })
     except Exception as e:
@@ -131,47 +591,117 @@ def apply_filter():
     """
     Apply a specific filter to a captured image
     
-    Payload: { cam_id: int, filter_type: str }
+    Payload: { cam_id: int, filter_type: str, response: str (optional),
+               scale: float (optional), upsample: bool (optional) }
     
     Supported filter types:
         - none, grayscale, gaussian, median, sobel, laplacian, canny
         - sharpening, bilateral, binary_threshold, erosion, dilation
         - opening, closing, histogram_eq, clahe, adaptive_threshold, contour
+    
+    Filters can be chained on the server with '|', e.g. 'gaussian|canny|dilation'.
+    
+    scale (default 1.0) runs the filter on a pyramid-downscaled frame with
+    kernels shrunk to match, for cheap previews of large frames; the result
+    is resized back unless upsample is false. The response reports the
+    effective scale and, once the filter has run at full resolution, the
+    estimated speedup.
+    
+    Response options (see response_mode): 'json', 'url', or 'binary'
+    (image/jpeg body).
     """
     data = request.get_json()
     cam_id = int(data.get('cam_id'))
     filter_type = data.get('filter_type', 'grayscale').strip().lower()
+    mode = response_mode(data)
     
     if cam_id not in cameras:
         return jsonify({'ok': False, 'error': 'invalid cam_id'}), 400
-    
-    cam = cameras[cam_id]
-    frame = cam.get_frame_bgr()
-    if frame is None:
+    if mode not in RESPONSE_MODES:
+        return jsonify({'ok': False, 'error': 'invalid response mode'}), 400
+    try:
+        scale = check_scale(data.get('scale', 1.0))
+    except (TypeError, ValueError) as e:
+        return jsonify({'ok': False, 'error': f'invalid scale: {e}'}), 400
+    try:
+        upsample = parse_flag(data.get('upsample', True))
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': f'invalid upsample: {e}'}), 400
+    try:
+        get_pipeline(filter_type, scale)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': f'invalid filter_type: {e}'}), 400
+
+    def run(seq, frame):
+        filtered_img, process_time_ms, stage_times = executor.apply_pipeline(
+            cam_id, frame, filter_type, (cam_id, *sched.cam.frame_key(seq)), scale, upsample)
+        if scale == 1.0:
+            full_res_timings.record(filter_type, frame.shape, process_time_ms)
+            speedup = 1.0
+        else:
+            speedup = full_res_timings.speedup(filter_type, frame.shape, process_time_ms)
+        return filtered_img, process_time_ms, stage_times, effective_scale(frame.shape, scale), speedup
+
+    try:
+        # newest frame wins; the frame key lets filters on the same frame share
+        # grayscale/binary intermediates
+        with cameras.use(cam_id):
+            sched = scheduler_for(cam_id)
+            _, (filtered_img, process_time_ms, stage_times, eff_scale, speedup) = sched.submit(
+                ('filter', filter_type, scale, upsample), run)
+    except SchedulerClosedError:
+        return jsonify({'ok': False, 'error': 'invalid cam_id'}), 404
+    except NoFrameError:
         return jsonify({'ok': False, 'error': 'no frame yet'}), 400
-    
+    except Exception as e:
+        return jsonify({'ok': False, 'error': f'Filter failed: {str(e)}'}), 500
+
     try:
-        processor = ImageProcessor()
-        filtered_img, process_time_ms = processor.apply_filter(frame, filter_type)
-        
-        # Convert filtered image to base64
-        ret, jpg = cv2.imencode('.jpg', filtered_img, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-        if not ret:
+        raw = encode_jpeg(filtered_img, kind='filter')
+        if raw is None:
             return jsonify({'ok': False, 'error': 'encode_failed'}), 500
+        stage_times_ms = [{'stage': name, 'ms': round(ms, 2)} for name, ms in stage_times]
+        speedup = None if speedup is None else round(speedup, 2)
         
-        raw = jpg.tobytes()
-        b64 = base64.b64encode(raw).decode('utf-8')
-        result_uri = 'data:image/jpeg;base64,' + b64
+        if mode == 'json':
+            return jsonify({
+                'ok': True,
+                'result': to_data_uri(raw),
+                'process_time_ms': round(process_time_ms, 2),
+                'stage_times_ms': stage_times_ms,
+                'scale': round(eff_scale, 4),
+                'speedup': speedup,
+                'filter_type': filter_type
+            })
         
+        result_id = results_store.put(raw)
+        if mode == 'binary':
+            return image_response(raw, result_id, {
+                'X-Process-Time-Ms': f'{process_time_ms:.2f}',
+                'X-Stage-Times-Ms': json.dumps(stage_times_ms),
+                'X-Scale': f'{eff_scale:.4f}',
+                'X-Speedup': '' if speedup is None else f'{speedup:.2f}',
+                'X-Filter-Type': filter_type,
+            })
         return jsonify({
             'ok': True,
-            'result': result_uri,
+            'result': f'/result/{result_id}',
             'process_time_ms': round(process_time_ms, 2),
+            'stage_times_ms': stage_times_ms,
+            'scale': round(eff_scale, 4),
+            'speedup': speedup,
             'filter_type': filter_type
         })
     except Exception as e:
         return jsonify({'ok': False, 'error': f'Filter failed: {str(e)}'}), 500
 
 if __name__ == '__main__':
-    # debug mode off in production
-    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
+    # CV_SERVER_MODE=async serves the MJPEG feeds from an asyncio event loop
+    # (see async_server.py) instead of one thread per viewer
+    if os.environ.get('CV_SERVER_MODE', 'threaded') == 'async':
+        import sys
+        import async_server
+        async_server.serve(sys.modules[__name__], host='0.0.0.0', port=5000)
+    else:
+        # debug mode off in production
+        app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
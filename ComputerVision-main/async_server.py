@@ -0,0 +1,364 @@
+"""
+Asyncio serving mode for large numbers of MJPEG viewers
+
+With the threaded Flask server every /video_feed client holds a thread
+for as long as it watches. Here the MJPEG routes are served from one
+event loop instead: one broadcast task per camera (or filtered stream)
+waits for new frames and fans the shared JPEG bytes out to per-client
+bounded queues. A client that cannot keep up loses its oldest queued
+parts rather than slowing anybody else, and is disconnected once a
+single write has been stuck for send_timeout seconds. Every other
+route is handed to the Flask app unchanged on a small thread pool.
+
+    CV_SERVER_MODE=async python app.py
+    python async_server.py --port 5000
+"""
+import argparse
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote
+import metrics
+
+STREAM_ROUTES = (
+    (re.compile(r'^/video_feed/(\d+)$'), 'raw'),
+    (re.compile(r'^/processed_feed/(\d+)$'), 'processed'),
+)
+
+DROPPED_PARTS = metrics.counter('cv_async_dropped_parts_total', 'MJPEG parts dropped for slow async viewers', ('camera', 'stream'))
+SLOW_DISCONNECTS = metrics.counter('cv_async_slow_disconnects_total', 'Async viewers disconnected for not reading', ('camera', 'stream'))
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+_UNKNOWN_CAMERA = b'{"error":"invalid cam_id","ok":false}'
+
+
+class _Viewer:
+    def __init__(self, max_queue):
+        self.queue = asyncio.Queue(max_queue)
+        self.dropped = 0
+
+    def offer(self, part):
+        # newest part wins: a full queue loses its oldest part; returns False if it did
+        dropped = self.queue.full()
+        if dropped:
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(part)
+        return not dropped
+
+
+class _Broadcast:
+    """One frame source fanned out to all of its async viewers"""
+
+    def __init__(self, server, key, source, labels, on_close):
+        """
+        Args:
+            server: AsyncStreamServer running the broadcast
+            key: Key of the broadcast in server.broadcasts
+            source: VideoCamera or ProcessedStream (anything with wait_for_jpeg)
+            labels: (camera, stream) metric labels
+            on_close: Called (in a worker thread) after the last viewer left
+        """
+        self.server = server
+        self.key = key
+        self.source = source
+        self.labels = labels
+        self.on_close = on_close
+        self.viewers = set()
+        self.parts = 0
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        seq = -1
+        frame_bytes = None
+        try:
+            while self.viewers:
+                # the only thread this broadcast uses, whatever the viewer count
+                new_seq, new_bytes = await loop.run_in_executor(
+                    self.server.wait_pool, self.source.wait_for_jpeg, seq, 1.0)
+                if new_bytes:
+                    seq, frame_bytes = new_seq, new_bytes
+                elif new_seq > seq:
+                    seq, frame_bytes = new_seq, None
+                # same keep-alive and blank fallback as the threaded stream
+                body = frame_bytes or self.server.blank_jpeg()
+                part = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (len(body), body)
+                self.parts += 1
+                for viewer in list(self.viewers):
+                    if not viewer.offer(part):
+                        DROPPED_PARTS.inc(*self.labels)
+        finally:
+            if self.server.broadcasts.get(self.key) is self:
+                del self.server.broadcasts[self.key]
+            for viewer in list(self.viewers):
+                # ends the viewer's response (only left here if the wait failed)
+                viewer.offer(None)
+            await loop.run_in_executor(self.server.wait_pool, self.on_close)
+
+
+class AsyncStreamServer:
+    """
+    HTTP server: MJPEG feeds on the event loop, everything else via WSGI
+
+    Only what the app's routes need of HTTP/1.1 is implemented: one
+    request per connection (responses are sent with Connection: close)
+    and bodies with a Content-Length.
+    """
+
+    def __init__(self, flask_module, max_queue=2, send_timeout=10.0, wsgi_threads=16, header_timeout=10.0,
+                 wait_threads=64):
+        """
+        Args:
+            flask_module: The app module (its app, cameras and processed_streams)
+            max_queue: MJPEG parts buffered per viewer before the oldest is dropped
+            send_timeout: Seconds one write may block before the viewer is dropped
+            wsgi_threads: Threads running non-streaming Flask requests
+            header_timeout: Seconds a client gets to send its request headers
+            wait_threads: Threads waiting for new frames; every broadcast (one
+                          per camera or filtered stream being watched, however
+                          many viewers it has) keeps one busy, so this caps the
+                          number of sources streamed at full rate
+        """
+        self.web = flask_module
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.header_timeout = header_timeout
+        self.wsgi_pool = ThreadPoolExecutor(wsgi_threads, thread_name_prefix='wsgi')
+        # one blocked wait_for_jpeg per broadcast, plus acquire/release calls
+        self.wait_threads = wait_threads
+        self.wait_pool = ThreadPoolExecutor(wait_threads, thread_name_prefix='broadcast')
+        self.broadcasts = {}
+        self.viewers = 0
+        self.slow_disconnects = 0
+        self.host = None
+        self.port = None
+
+    def blank_jpeg(self):
+        return self.web.create_blank_jpeg()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(self._read_request(reader), self.header_timeout)
+            if request is None:
+                return
+            method, path, query, headers, body = request
+            for pattern, kind in STREAM_ROUTES:
+                match = pattern.match(path)
+                if match and method == 'GET':
+                    await self._stream(writer, kind, int(match.group(1)), query)
+                    return
+            await self._wsgi(writer, method, path, query, headers, body)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        body = await reader.readexactly(length) if length else b''
+        path, _, query = target.partition('?')
+        return method.upper(), path, query, headers, body
+
+    # --- MJPEG ---
+
+    async def _stream(self, writer, kind, cam_id, query):
+        loop = asyncio.get_running_loop()
+        web = self.web
+        if cam_id not in web.cameras:
+            await self._send_json(writer, 400, _UNKNOWN_CAMERA)
+            return
+        if kind == 'raw':
+            key = ('raw', cam_id)
+            broadcast = self.broadcasts.get(key)
+            if broadcast is None:
+                cam = await loop.run_in_executor(self.wait_pool, web.cameras.acquire, cam_id)
+                if cam is None:
+                    # removed since the check above
+                    await self._send_json(writer, 404, _UNKNOWN_CAMERA)
+                    return
+                broadcast = self.broadcasts.get(key)
+                if broadcast is None:
+                    broadcast = self._start(key, cam, (str(cam_id), kind), lambda: web.cameras.release(cam_id))
+                else:
+                    # another viewer started it while this one waited for acquire
+                    web.cameras.release(cam_id)
+        else:
+            args = parse_qs(query)
+            spec = args.get('filter', ['grayscale'])[0]
+            scale = args.get('scale', [1.0])[0]
+            try:
+                stream = web.processed_streams.subscribe(cam_id, web.cameras[cam_id], spec, scale)
+            except KeyError:
+                await self._send_json(writer, 404, _UNKNOWN_CAMERA)
+                return
+            except ValueError as e:
+                await self._send_json(writer, 400, json.dumps({'ok': False, 'error': str(e)}).encode())
+                return
+            key = ('processed', cam_id, stream.spec, stream.scale)
+            broadcast = self.broadcasts.get(key)
+            if broadcast is not None and broadcast.source is stream:
+                # the broadcast already holds a subscription to this stream
+                web.processed_streams.unsubscribe(stream)
+            else:
+                if await loop.run_in_executor(self.wait_pool, web.cameras.acquire, cam_id) is None:
+                    web.processed_streams.unsubscribe(stream)
+                    await self._send_json(writer, 404, _UNKNOWN_CAMERA)
+                    return
+
+                def close(stream=stream):
+                    web.processed_streams.unsubscribe(stream)
+                    web.cameras.release(cam_id)
+                broadcast = self._start(key, stream, (str(cam_id), kind), close)
+
+        viewer = _Viewer(self.max_queue)
+        broadcast.viewers.add(viewer)
+        self.viewers += 1
+        web.VIEWERS.inc(*broadcast.labels)
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                         b'Cache-Control: no-cache\r\nConnection: close\r\n\r\n')
+            while True:
+                part = await viewer.queue.get()
+                if part is None:
+                    return
+                t0 = time.perf_counter()
+                writer.write(part)
+                try:
+                    await asyncio.wait_for(writer.drain(), self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.slow_disconnects += 1
+                    SLOW_DISCONNECTS.inc(*broadcast.labels)
+                    return
+                web.MJPEG_SEND_SECONDS.observe(time.perf_counter() - t0, *broadcast.labels)
+        finally:
+            broadcast.viewers.discard(viewer)
+            self.viewers -= 1
+            web.VIEWERS.dec(*broadcast.labels)
+
+    def _start(self, key, source, labels, on_close):
+        broadcast = self.broadcasts[key] = _Broadcast(self, key, source, labels, on_close)
+        broadcast.task = asyncio.get_running_loop().create_task(broadcast.run())
+        return broadcast
+
+    # --- everything else ---
+
+    async def _wsgi(self, writer, method, path, query, headers, body):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, encoding='latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host or 'localhost',
+            'SERVER_PORT': str(self.port or 80),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': (writer.get_extra_info('peername') or ('',))[0],
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)) if body else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        def call():
+            response = {}
+
+            def start_response(status, response_headers, exc_info=None):
+                response['status'], response['headers'] = status, response_headers
+
+            result = self.web.app.wsgi_app(environ, start_response)
+            try:
+                data = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            return response['status'], response['headers'], data
+
+        status, response_headers, data = await asyncio.get_running_loop().run_in_executor(self.wsgi_pool, call)
+        head = [f'HTTP/1.1 {status}']
+        head += [f'{name}: {value}' for name, value in response_headers
+                 if name.lower() not in ('connection', 'content-length', 'transfer-encoding')]
+        head += [f'Content-Length: {len(data)}', 'Connection: close', '', '']
+        writer.write('\r\n'.join(head).encode('latin-1') + data)
+        await writer.drain()
+
+    async def _send_json(self, writer, code, body):
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n%s' % (code, _REASONS[code].encode(), len(body), body))
+        await writer.drain()
+
+    def get_stats(self):
+        # merged into the app's /stats as 'async_server'
+        return {
+            'viewers': self.viewers,
+            'wait_threads': self.wait_threads,
+            'broadcasts': {
+                '/'.join(str(k) for k in key): {'viewers': len(b.viewers), 'parts': b.parts,
+                                                'dropped': sum(v.dropped for v in b.viewers)}
+                for key, b in list(self.broadcasts.items())
+            },
+            'slow_disconnects': self.slow_disconnects,
+        }
+
+    async def serve_forever(self, host='0.0.0.0', port=5000):
+        self.host, self.port = host, port
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        print(f" * Async server on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def serve(flask_module, host='0.0.0.0', port=5000, **kwargs):
+    """
+    Run the app in async mode until interrupted
+
+    Args:
+        flask_module: The app module (pass sys.modules['__main__'] when
+                      app.py runs as a script, so it is not imported twice)
+        host, port: Address to listen on
+        **kwargs: See AsyncStreamServer
+    """
+    server = AsyncStreamServer(flask_module, **kwargs)
+    flask_module.stats_providers['async_server'] = server.get_stats
+    metrics.callback_gauge('cv_async_viewers', 'Viewers served by the async server', (),
+                           lambda: {(): server.viewers})
+    try:
+        asyncio.run(server.serve_forever(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the app with asyncio MJPEG streaming')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--max-queue', type=int, default=2, help='MJPEG parts buffered per viewer')
+    parser.add_argument('--send-timeout', type=float, default=10.0, help='seconds before a stuck viewer is dropped')
+    parser.add_argument('--wait-threads', type=int, default=64, help='most sources (cameras, filtered streams) streamed at once')
+    args = parser.parse_args()
+    import app as web
+    serve(web, args.host, args.port, max_queue=args.max_queue, send_timeout=args.send_timeout,
+          wait_threads=args.wait_threads)
@@ -0,0 +1,378 @@
+"""
+Offline batch processing of image directories, globs and video files
+
+Runs a filter pipeline (same names and '|' chaining as /apply_filter) over
+every frame and writes the results as images, or as one video:
+
+    python batch.py recordings/day1.mp4 out/ --filter 'gaussian|canny'
+    python batch.py 'shots/*.jpg' out/ --filter clahe --workers 4
+    python batch.py recordings/ out/day.avi --filter grayscale --scale 0.5
+
+Images are read, filtered and encoded in worker processes; video frames are
+decoded here (a video can only be read in order) and filtered and encoded
+in the workers. Results come back in input order, with a bounded number of
+frames in flight, so memory stays flat however long the input is.
+
+Image output is resumable: each result is written to a temporary name and
+renamed when complete, and --resume skips inputs whose result exists
+(video frames already done are grabbed but not decoded). The run's
+settings are kept in OUTPUT/batch.json and a resumed run must use the
+same ones.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+
+from pipeline import get_pipeline, check_scale
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp')
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov', '.m4v', '.mpg', '.mpeg', '.wmv')
+OUTPUT_FORMATS = ('jpg', 'png', 'bmp')
+STATE_FILE = 'batch.json'
+
+
+# =============================================================================
+# INPUTS
+# =============================================================================
+
+def expand_inputs(inputs):
+    """
+    Resolve directories, globs and files into a sorted list of files
+
+    Returns:
+        list of (kind, path): kind is 'image' or 'video'
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = sorted(os.path.join(item, name) for name in os.listdir(item))
+        elif os.path.exists(item):
+            paths = [item]
+        else:
+            paths = sorted(glob.glob(item, recursive=True))
+            if not paths:
+                raise ValueError(f"no files match '{item}'")
+        for path in paths:
+            ext = os.path.splitext(path)[1].lower()
+            if ext in IMAGE_EXTENSIONS:
+                files.append(('image', path))
+            elif ext in VIDEO_EXTENSIONS:
+                files.append(('video', path))
+    return files
+
+
+class Item:
+    """One frame to process: an image file, or a decoded video frame"""
+
+    def __init__(self, name, path=None, frame=None, decode_ms=0.0):
+        self.name = name          # output name without extension
+        self.path = path          # image to read in the worker
+        self.frame = frame        # or the frame itself
+        self.decode_ms = decode_ms
+
+
+def iter_items(files, skip=None, every=1):
+    """
+    Yield an Item per frame, in order
+
+    Args:
+        files: From expand_inputs
+        skip: Callable(name) -> True for items already done (resume)
+        every: Keep every n-th video frame
+
+    Yields:
+        Item, or None for a skipped item (so progress can count it)
+    """
+    used = set()
+    for kind, path in files:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        # two inputs with the same stem (a.jpg, a.png) would overwrite each other
+        while stem in used:
+            stem += '_'
+        used.add(stem)
+        if kind == 'image':
+            yield None if skip is not None and skip(stem) else Item(stem, path=path)
+            continue
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            print(f"cannot open video {path}, skipping", file=sys.stderr)
+            continue
+        try:
+            index = 0
+            while True:
+                name = f'{stem}_{index:06d}'
+                wanted = index % every == 0
+                t0 = time.perf_counter()
+                if not wanted or (skip is not None and skip(name)):
+                    # grab() moves on without decoding the frame
+                    if not cap.grab():
+                        break
+                    if wanted:
+                        yield None
+                else:
+                    ok, frame = cap.read()
+                    if not ok:
+                        break
+                    yield Item(name, frame=frame, decode_ms=(time.perf_counter() - t0) * 1000)
+                index += 1
+        finally:
+            cap.release()
+
+
+# =============================================================================
+# WORKERS
+# =============================================================================
+
+def _init_worker():
+    # one OpenCV thread per worker; the pool provides the parallelism
+    cv2.setNumThreads(1)
+
+
+def _encode_params(fmt, quality):
+    if fmt == 'jpg':
+        return [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    if fmt == 'png':
+        return [int(cv2.IMWRITE_PNG_COMPRESSION), 3]
+    return []
+
+
+def process_item(item, spec, scale, output_dir, fmt, quality):
+    """
+    Read (if needed), filter and encode one item (runs in a worker)
+
+    Returns:
+        dict: name, ok, error, times in ms, bytes written; 'frame' holds the
+        filtered image instead when output_dir is None (video output)
+    """
+    result = {'name': item.name, 'ok': False, 'error': None, 'bytes': 0,
+              'decode_ms': item.decode_ms, 'process_ms': 0.0, 'encode_ms': 0.0}
+    try:
+        t0 = time.perf_counter()
+        img = item.frame
+        if img is None:
+            img = cv2.imread(item.path, cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError(f"cannot read {item.path}")
+            result['decode_ms'] = (time.perf_counter() - t0) * 1000
+        t1 = time.perf_counter()
+        out, _ = get_pipeline(spec, scale).run(img)
+        t2 = time.perf_counter()
+        result['process_ms'] = (t2 - t1) * 1000
+        if output_dir is None:
+            result['frame'] = out
+        else:
+            ret, buf = cv2.imencode('.' + fmt, out, _encode_params(fmt, quality))
+            if not ret:
+                raise ValueError("encode failed")
+            path = os.path.join(output_dir, f'{item.name}.{fmt}')
+            # rename only complete files, so --resume can trust what exists
+            with open(path + '.part', 'wb') as f:
+                f.write(buf)
+            os.replace(path + '.part', path)
+            result['bytes'] = len(buf)
+            result['encode_ms'] = (time.perf_counter() - t2) * 1000
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_ordered(executor, items, fn, max_in_flight):
+    """
+    Map fn over items on the executor, yielding results in input order
+
+    At most max_in_flight items are submitted ahead of the oldest one not
+    yet returned, which bounds memory for endless inputs. None items are
+    passed through (skipped frames keep their place).
+    """
+    pending = deque()
+    for item in items:
+        pending.append(None if item is None else executor.submit(fn, item))
+        while len(pending) > max_in_flight or (pending and pending[0] is None):
+            future = pending.popleft()
+            yield None if future is None else future.result()
+    while pending:
+        future = pending.popleft()
+        yield None if future is None else future.result()
+
+
+# =============================================================================
+# STATS
+# =============================================================================
+
+class BatchStats:
+    """Throughput and per-stage time of a run"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.stage_ms = {'decode_ms': 0.0, 'process_ms': 0.0, 'encode_ms': 0.0}
+        self.last_report = self.start
+
+    def add(self, result):
+        if result is None:
+            self.skipped += 1
+            return
+        if not result['ok']:
+            self.failed += 1
+            return
+        self.done += 1
+        self.bytes += result['bytes']
+        for key in self.stage_ms:
+            self.stage_ms[key] += result[key]
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        n = max(1, self.done)
+        return {
+            'done': self.done,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'elapsed_s': round(elapsed, 2),
+            'fps': round(self.done / elapsed, 2) if elapsed > 0 else 0.0,
+            'output_mb_s': round(self.bytes / elapsed / 1e6, 2) if elapsed > 0 else 0.0,
+            # summed over workers, so they can add up to more than the wall time
+            'avg_ms': {key[:-3]: round(ms / n, 2) for key, ms in self.stage_ms.items()},
+        }
+
+    def report(self, interval, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_report < interval:
+            return
+        self.last_report = now
+        s = self.summary()
+        avg = ', '.join(f'{k} {v:.1f}' for k, v in s['avg_ms'].items())
+        print(f"{'done' if final else 'progress'}: {s['done']} frames, {s['skipped']} skipped, "
+              f"{s['failed']} failed, {s['fps']:.1f} fps, {s['output_mb_s']:.1f} MB/s "
+              f"(avg ms per frame: {avg})", flush=True)
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def _load_state(output_dir, settings, resume):
+    # a resumed run must use the settings of the run it continues
+    path = os.path.join(output_dir, STATE_FILE)
+    if resume and os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        changed = [k for k in settings if previous.get(k) != settings[k]]
+        if changed:
+            raise ValueError(f"cannot resume: {', '.join(changed)} changed since the previous run")
+    with open(path, 'w') as f:
+        json.dump(settings, f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='image/video files, directories or glob patterns')
+    parser.add_argument('output', help='output directory, or a video file (.avi/.mp4) for ordered video output')
+    parser.add_argument('--filter', default='grayscale', help="filter or pipeline, e.g. 'gaussian|canny'")
+    parser.add_argument('--scale', type=float, default=1.0, help='processing scale (see /apply_filter)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='jpg', help='image output format')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality')
+    parser.add_argument('--every', type=int, default=1, help='process every n-th video frame')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', action='store_true', help='use threads instead of processes')
+    parser.add_argument('--resume', action='store_true', help='skip inputs whose output already exists')
+    parser.add_argument('--fps', type=float, default=25.0, help='frame rate of video output')
+    parser.add_argument('--report-every', type=float, default=5.0, help='seconds between progress lines')
+    parser.add_argument('--stats', help='write the final stats as JSON here')
+    args = parser.parse_args(argv)
+
+    try:
+        spec = '|'.join(name.strip().lower() for name in args.filter.split('|'))
+        scale = check_scale(args.scale)
+        get_pipeline(spec, scale)  # fail on unknown filters before starting
+        files = expand_inputs(args.inputs)
+    except ValueError as e:
+        parser.error(str(e))
+    if not files:
+        parser.error("no image or video inputs found")
+    if args.every < 1:
+        parser.error("--every must be at least 1")
+
+    video_out = os.path.splitext(args.output)[1].lower() in VIDEO_EXTENSIONS
+    if video_out and args.resume:
+        parser.error("--resume needs an output directory (a video file cannot be appended to)")
+
+    skip = None
+    output_dir = None
+    if not video_out:
+        output_dir = args.output
+        os.makedirs(output_dir, exist_ok=True)
+        settings = {'filter': spec, 'scale': scale, 'format': args.format, 'every': args.every,
+                    'inputs': [path for _, path in files]}
+        try:
+            _load_state(output_dir, settings, args.resume)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.resume:
+            existing = {os.path.splitext(name)[0] for name in os.listdir(output_dir)
+                        if name.endswith('.' + args.format)}
+            skip = existing.__contains__
+
+    print(f"{len(files)} input file(s), filter '{spec}' at scale {scale}, {args.workers} "
+          f"{'thread' if args.threads else 'process'} worker(s)")
+    pool_cls = ThreadPoolExecutor if args.threads else ProcessPoolExecutor
+    stats = BatchStats()
+    writer = None
+    items = iter_items(files, skip, args.every)
+    task = _Task(spec, scale, output_dir, args.format, args.quality)
+
+    with pool_cls(args.workers, initializer=_init_worker) as executor:
+        try:
+            for result in run_ordered(executor, items, task, 2 * args.workers):
+                if result is not None and not result['ok']:
+                    print(f"{result['name']}: {result['error']}", file=sys.stderr)
+                if result is not None and result['ok'] and video_out:
+                    frame = result.pop('frame')
+                    if writer is None:
+                        fourcc = 'mp4v' if args.output.lower().endswith(('.mp4', '.m4v', '.mov')) else 'MJPG'
+                        writer = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*fourcc), args.fps,
+                                                 (frame.shape[1], frame.shape[0]))
+                        if not writer.isOpened():
+                            print(f"cannot write video {args.output}", file=sys.stderr)
+                            return 1
+                    t0 = time.perf_counter()
+                    writer.write(frame)
+                    result['encode_ms'] = (time.perf_counter() - t0) * 1000
+                stats.add(result)
+                stats.report(args.report_every)
+        except KeyboardInterrupt:
+            print("interrupted; rerun with --resume to continue", file=sys.stderr)
+            executor.shutdown(wait=False, cancel_futures=True)
+            return 130
+        finally:
+            if writer is not None:
+                writer.release()
+
+    stats.report(0, final=True)
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(stats.summary(), f, indent=1)
+    return 1 if stats.failed else 0
+
+
+class _Task:
+    # picklable process_item with fixed settings, for process pools
+    def __init__(self, *settings):
+        self.settings = settings
+
+    def __call__(self, item):
+        return process_item(item, *self.settings)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""
+MJPEG viewer load test: threaded Flask server vs the asyncio server mode
+
+Starts the app in each server mode on a synthetic video, opens a growing
+number of /video_feed viewers and reports, per level, the frame rate the
+viewers actually received, the server's CPU use and thread count, and
+viewers per core (viewers divided by the cores the server used; only
+meaningful while the viewers still get the full frame rate):
+
+    python benchmarks/load_test.py --viewers 10,50,100,200
+    python benchmarks/load_test.py --modes async --viewers 500 --output load.json
+    python benchmarks/load_test.py --replay --viewers 10,50,100
+
+--replay converts the video into a raw ring file once and serves it as a
+looping replay:// source, so the server does no decoding and every run
+sees the same frames: only the serving path is measured.
+
+The viewers run in this process on one event loop. On a machine with few
+cores they compete with the server for CPU, so compare modes against
+each other rather than reading the numbers as absolute capacity. Server
+CPU is read from /proc and is only reported on Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from run_benchmarks import write_video   # noqa: E402
+from recording import REPLAY_SCHEME, record_video   # noqa: E402
+
+MODES = ('threaded', 'async')
+
+SERVER_COMMANDS = {
+    'threaded': "import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)",
+    'async': "import app, async_server; async_server.serve(app, host='127.0.0.1', port={port})",
+}
+
+
+def start_server(mode, port):
+    proc = subprocess.Popen([sys.executable, '-c', SERVER_COMMANDS[mode].format(port=port)],
+                            cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/health', timeout=1).close()
+            return proc, base
+        except urllib.error.HTTPError:
+            # 503 before the camera is live still means the server is up
+            return proc, base
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def post_json(url, data):
+    req = urllib.request.Request(url, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.load(resp)
+
+
+def cpu_seconds(pid):
+    # user + system CPU time of a process (Linux only)
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def thread_count(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Viewer:
+    """One MJPEG client counting the parts it receives"""
+
+    def __init__(self):
+        self.parts = 0
+        self.error = None
+
+    async def run(self, host, port, path, stop):
+        tail = b''
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+            await writer.drain()
+            while not stop.is_set():
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                data = tail + chunk
+                self.parts += data.count(b'--frame\r\n')
+                # a boundary split across two reads is counted in the next one
+                tail = data[-9:] if not data.endswith(b'--frame\r\n') else b''
+            writer.close()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.error = str(e)
+
+
+async def measure(host, port, path, n_viewers, warmup, duration, pid):
+    stop = asyncio.Event()
+    viewers = [Viewer() for _ in range(n_viewers)]
+    tasks = [asyncio.create_task(v.run(host, port, path, stop)) for v in viewers]
+    await asyncio.sleep(warmup)
+    start_parts = [v.parts for v in viewers]
+    cpu0, t0 = cpu_seconds(pid), time.monotonic()
+    await asyncio.sleep(duration)
+    cpu1, elapsed = cpu_seconds(pid), time.monotonic() - t0
+    parts = [v.parts - s for v, s in zip(viewers, start_parts)]
+    threads = thread_count(pid)
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    fps = sorted(p / elapsed for p in parts)
+    cores = (cpu1 - cpu0) / elapsed if cpu0 is not None and cpu1 is not None else None
+    return {
+        'viewers': n_viewers,
+        'mean_fps': round(sum(fps) / len(fps), 2),
+        'min_fps': round(fps[0], 2),
+        'errors': sum(v.error is not None for v in viewers),
+        'server_cpu_percent': round(100 * cores, 1) if cores is not None else None,
+        'server_threads': threads,
+        'viewers_per_core': round(n_viewers / cores, 1) if cores else None,
+    }
+
+
+def run_mode(mode, port, source, levels, fps, warmup, duration):
+    proc, base = start_server(mode, port)
+    rows = []
+    try:
+        post_json(base + '/set_source', {'cam_id': 1, 'source': source, 'max_fps': fps})
+        for n in levels:
+            row = asyncio.run(measure('127.0.0.1', port, '/video_feed/1', n, warmup, duration, proc.pid))
+            row['mode'] = mode
+            rows.append(row)
+            print(f"  {mode:<9}{n:>8}{row['mean_fps']:>10.1f}{row['min_fps']:>10.1f}"
+                  f"{_fmt(row['server_cpu_percent']):>10}{_fmt(row['server_threads']):>9}"
+                  f"{_fmt(row['viewers_per_core']):>14}")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return rows
+
+
+def _fmt(value):
+    return '-' if value is None else str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated, from: ' + ', '.join(MODES))
+    parser.add_argument('--viewers', default='10,50,100,200', help='comma separated viewer counts')
+    parser.add_argument('--fps', type=float, default=25, help='camera frame rate (default 25)')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds before measuring each level')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds measured per level')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--replay', action='store_true', help='serve a decode-free replay:// recording of the video')
+    parser.add_argument('--output', help='write results JSON here')
+    args = parser.parse_args(argv)
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(unknown)}")
+    levels = [int(n) for n in args.viewers.split(',')]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # long enough to keep playing through every level of one mode
+        # (replays loop, so a few seconds of raw frames are enough)
+        video = os.path.join(tmp_dir, 'load.avi')
+        n_frames = int(args.fps * (len(levels) * (args.warmup + args.duration + 1) + 5))
+        if args.replay:
+            n_frames = min(n_frames, int(args.fps * 4))
+        print(f"writing {n_frames} frame test video ...")
+        if not write_video(video, 640, 480, n_frames):
+            print("no MJPG encoder available")
+            return 1
+        source = video
+        if args.replay:
+            ring = os.path.join(tmp_dir, 'load.ring')
+            record_video(video, ring)
+            # the camera's max_fps paces the replay
+            source = f'{REPLAY_SCHEME}{ring}?speed=max&loop=1'
+        print(f"  {'mode':<9}{'viewers':>8}{'mean fps':>10}{'min fps':>10}{'cpu %':>10}{'threads':>9}{'viewers/core':>14}")
+        for i, mode in enumerate(modes):
+            rows.extend(run_mode(mode, args.port + i, source, levels, args.fps, args.warmup, args.duration))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'date': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'cpu_count': os.cpu_count(),
+                    'fps': args.fps,
+                    'duration': args.duration,
+                    'replay': args.replay,
+                },
+                'results': rows,
+            }, f, indent=1)
+        print(f"wrote {len(rows)} results to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
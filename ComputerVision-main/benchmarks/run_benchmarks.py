@@ -0,0 +1,387 @@
+"""
+Offline performance benchmarks for the processing, capture and encode paths
+
+Everything runs on synthetic frames and a synthetic video file, so no
+camera (or network) is needed. Results are written as JSON; compare them
+against the checked-in baseline to catch regressions:
+
+    python benchmarks/run_benchmarks.py run --output results.json
+    python benchmarks/run_benchmarks.py compare benchmarks/baseline.json results.json
+
+or both at once:
+
+    python benchmarks/run_benchmarks.py run --compare benchmarks/baseline.json
+
+compare exits with status 1 when a benchmark's median is slower than the
+baseline by more than --tolerance (and by more than --min-ms, which keeps
+sub-millisecond jitter from failing the run). Baselines are only
+meaningful on the machine they were recorded on; refresh them with
+'run --output benchmarks/baseline.json' after an intended change.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+# run from anywhere: the app modules live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process                                    # noqa: E402
+from process import ImageProcessor                # noqa: E402
+from pipeline import FILTER_REGISTRY              # noqa: E402
+from image_writer import AsyncImageWriter         # noqa: E402
+from camera import VideoCamera                    # noqa: E402
+from tracker import ObjectTracker                 # noqa: E402
+
+SIZES = {
+    'vga': (640, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def synthetic_frame(width, height, seed=0):
+    """
+    Deterministic BGR test frame
+
+    A colour gradient with filled shapes, lines and mild noise, so edge,
+    threshold and contour filters have real structure to work on (pure
+    noise would make them unrepresentatively slow or fast).
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.dstack([np.broadcast_to(x, (height, width)),
+                     np.broadcast_to(y, (height, width)),
+                     (x + y) / 2]).astype(np.uint8)
+    s = width / 640
+    for _ in range(40):
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            cv2.circle(img, (cx, cy), int(rng.integers(5, 60) * s), color, -1)
+        else:
+            cv2.rectangle(img, (cx, cy), (cx + int(rng.integers(10, 120) * s), cy + int(rng.integers(10, 80) * s)), color, -1)
+        cv2.line(img, (cx, cy), (int(rng.integers(0, width)), int(rng.integers(0, height))), color, max(1, int(2 * s)))
+    noise = rng.normal(0, 6, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def time_calls(fn, repeat, warmup=1, after=None):
+    """
+    Run fn warmup + repeat times
+
+    Args:
+        after: Called after every run, outside the timed region (e.g. to
+               wait for background work fn started)
+
+    Returns:
+        dict: min_ms, median_ms, mean_ms and runs
+    """
+    for _ in range(warmup):
+        fn()
+        if after is not None:
+            after()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+        if after is not None:
+            after()
+    return {
+        'min_ms': round(min(times), 4),
+        'median_ms': round(statistics.median(times), 4),
+        'mean_ms': round(statistics.fmean(times), 4),
+        'runs': repeat,
+    }
+
+
+def bench_filters(frames, repeat):
+    # every filter_type apply_filter accepts, without the intermediate cache
+    results = {}
+    processor = ImageProcessor()
+    for size, frame in frames.items():
+        for name in sorted(FILTER_REGISTRY):
+            results[f'filter/{name}/{size}'] = time_calls(lambda: processor.apply_filter(frame, name), repeat)
+    return results
+
+
+def bench_process_frame(frames, repeat, tmp_dir):
+    # process_frame queues its images on the capture writer; point it at a
+    # scratch directory and drain it between runs, so the timed call does not
+    # compete with the encoder thread for the writes of the previous one
+    saver = process.capture_saver
+    writer = AsyncImageWriter(save_dir=tmp_dir, fmt='bmp', policy='block')
+    old_writer, saver.writer = saver.writer, writer
+    try:
+        processor = ImageProcessor()
+        results = {}
+        for size, frame in frames.items():
+            results[f'process_frame/{size}'] = time_calls(lambda: processor.process_frame(frame), repeat,
+                                                          after=writer.flush)
+        return results
+    finally:
+        saver.writer = old_writer
+
+
+def bench_encoders(frames, repeat):
+    results = {}
+    for size, frame in frames.items():
+        results[f'encode/jpeg80/{size}'] = time_calls(
+            lambda: cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80]), repeat)
+        results[f'encode/jpeg90/{size}'] = time_calls(
+            lambda: cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 90]), repeat)
+        results[f'encode/bmp/{size}'] = time_calls(lambda: cv2.imencode('.bmp', frame), repeat)
+    return results
+
+
+def write_video(path, width, height, n_frames):
+    # MJPG AVI of moving synthetic frames; returns False if no encoder is available
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (width, height))
+    if not writer.isOpened():
+        return False
+    base = synthetic_frame(width, height)
+    for i in range(n_frames):
+        writer.write(np.roll(base, 8 * i, axis=1))
+    writer.release()
+    return True
+
+
+def bench_video(sizes, repeat, tmp_dir, n_frames=120):
+    """
+    Time decoding a local video file, directly and through VideoCamera
+
+    'video/capture' is a bare cv2.VideoCapture loop; 'video/camera' is the
+    VideoCamera reader thread delivering every frame to a consumer, i.e.
+    the capture path of the app. Both report ms per frame.
+    """
+    results = {}
+    for size in sizes:
+        width, height = SIZES[size]
+        path = os.path.join(tmp_dir, f'bench_{size}.avi')
+        if not write_video(path, width, height, n_frames):
+            print(f"  skipping video/{size}: no MJPG encoder")
+            continue
+
+        def read_direct():
+            cap = cv2.VideoCapture(path)
+            count = 0
+            while cap.read()[0]:
+                count += 1
+            cap.release()
+            return count
+
+        def read_camera():
+            # unpaced: measure the reader's overhead, not the file's frame rate
+            cam = VideoCamera(pace_files=False)
+            base = cam.seq + 1  # start() bumps seq once before the first frame
+            cam.start(path)
+            seq = base
+            # the reader may run ahead of this loop, so count frames by seq
+            while seq - base < n_frames:
+                seq, frame = cam.wait_for_frame(seq, timeout=5.0)
+                if frame is None:
+                    break
+            cam.stop()
+            return seq - base
+
+        for key, fn in (('capture', read_direct), ('camera', read_camera)):
+            stats = time_calls(fn, repeat)
+            results[f'video/{key}/{size}'] = {
+                k: (round(v / n_frames, 4) if k.endswith('_ms') else v) for k, v in stats.items()
+            }
+    return results
+
+
+def bench_tracker(repeat, counts=(10, 100, 1000), n_frames=30):
+    """
+    Time ObjectTracker.update with n objects moving across a 4K frame
+
+    Each run tracks a fresh tracker through n_frames frames of jittered
+    detections given in shuffled order; results are ms per frame.
+    """
+    results = {}
+    rng = np.random.default_rng(0)
+    for n in counts:
+        pos = rng.uniform(0, (3840, 2160), (n, 2))
+        vel = rng.uniform(-4, 4, (n, 2))
+        size = rng.uniform(10, 40, (n, 2))
+        frames = [np.hstack([pos + vel * i + rng.normal(0, 0.5, (n, 2)), size])[rng.permutation(n)].astype(np.float32)
+                  for i in range(n_frames)]
+
+        def track():
+            tracker = ObjectTracker()
+            for boxes in frames:
+                tracker.update(boxes)
+
+        stats = time_calls(track, repeat)
+        results[f'tracker/update/{n}'] = {
+            k: (round(v / n_frames, 4) if k.endswith('_ms') else v) for k, v in stats.items()
+        }
+    return results
+
+
+def run(sizes, repeat, groups):
+    frames = {size: synthetic_frame(*SIZES[size]) for size in sizes}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if 'filters' in groups:
+            print("filters ...")
+            results.update(bench_filters(frames, repeat))
+        if 'process_frame' in groups:
+            print("process_frame ...")
+            results.update(bench_process_frame(frames, repeat, tmp_dir))
+        if 'encode' in groups:
+            print("encoders ...")
+            results.update(bench_encoders(frames, repeat))
+        if 'video' in groups:
+            print("video ...")
+            results.update(bench_video(sizes, repeat, tmp_dir))
+        if 'tracker' in groups:
+            print("tracker ...")
+            results.update(bench_tracker(repeat))
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'cv2_threads': cv2.getNumThreads(),
+            'sizes': list(sizes),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance=0.25, min_ms=0.5, stat='median_ms'):
+    """
+    Compare two result files
+
+    Args:
+        baseline, current: Parsed JSON from run()
+        tolerance: Allowed relative slowdown (0.25 = 25%)
+        min_ms: Absolute slowdown below which a difference is ignored
+        stat: Statistic to compare
+
+    Returns:
+        (rows, regressions): rows is a list of (name, base, current, ratio,
+        status); regressions is the list of names that got slower
+    """
+    base, cur = baseline['results'], current['results']
+    rows, regressions = [], []
+    for name in sorted(set(base) | set(cur)):
+        if name not in cur:
+            rows.append((name, base[name][stat], None, None, 'missing'))
+            continue
+        if name not in base:
+            rows.append((name, None, cur[name][stat], None, 'new'))
+            continue
+        b, c = base[name][stat], cur[name][stat]
+        ratio = c / b if b > 0 else float('inf')
+        if ratio > 1 + tolerance and c - b > min_ms:
+            status = 'SLOWER'
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance) and b - c > min_ms:
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((name, b, c, ratio, status))
+    return rows, regressions
+
+
+# meta fields that must match for a comparison to mean anything
+COMPARABLE_META = ('machine', 'cpu_count', 'cv2_threads', 'opencv', 'numpy', 'python')
+
+
+def meta_mismatches(baseline, current):
+    # (field, baseline value, current value) for each differing COMPARABLE_META field
+    base, cur = baseline.get('meta', {}), current.get('meta', {})
+    return [(k, base.get(k), cur.get(k)) for k in COMPARABLE_META if base.get(k) != cur.get(k)]
+
+
+def print_comparison(rows, only_changes=False):
+    print(f"{'benchmark':<40}{'baseline ms':>13}{'current ms':>13}{'ratio':>9}  status")
+    for name, b, c, ratio, status in rows:
+        if only_changes and status in ('ok', 'missing'):
+            continue
+        fmt = lambda v: f"{v:>13.3f}" if v is not None else f"{'-':>13}"
+        r = f"{ratio:>9.2f}" if ratio is not None else f"{'-':>9}"
+        print(f"{name:<40}{fmt(b)}{fmt(c)}{r}  {status}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help='run the benchmarks')
+    p_run.add_argument('--sizes', default=','.join(SIZES), help='comma separated, from: ' + ', '.join(SIZES))
+    p_run.add_argument('--groups', default='filters,process_frame,encode,video,tracker')
+    p_run.add_argument('--repeat', type=int, default=5)
+    p_run.add_argument('--output', help='write results JSON here')
+    p_run.add_argument('--compare', metavar='BASELINE', help='compare with a baseline file after running')
+
+    p_cmp = sub.add_parser('compare', help='compare two result files')
+    p_cmp.add_argument('baseline', nargs='?', default=BASELINE)
+    p_cmp.add_argument('current')
+
+    for p in (p_run, p_cmp):
+        p.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown (default 0.25)')
+        p.add_argument('--min-ms', type=float, default=0.5, help='ignore slowdowns smaller than this')
+        p.add_argument('--changes-only', action='store_true', help='only list benchmarks that changed')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        sizes = [s.strip() for s in args.sizes.split(',') if s.strip()]
+        unknown = [s for s in sizes if s not in SIZES]
+        if unknown:
+            parser.error(f"unknown size(s): {', '.join(unknown)}")
+        groups = {g.strip() for g in args.groups.split(',')}
+        current = run(sizes, args.repeat, groups)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(current, f, indent=1, sort_keys=True)
+            print(f"wrote {len(current['results'])} results to {args.output}")
+        if not args.compare:
+            for name, stats in sorted(current['results'].items()):
+                print(f"  {name:<40}{stats['median_ms']:>12.3f} ms")
+            return 0
+        baseline_path = args.compare
+    else:
+        with open(args.current) as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    for field, b, c in meta_mismatches(baseline, current):
+        print(f"warning: baseline was recorded with {field}={b}, this run has {field}={c}; "
+              "timings may not be comparable")
+    rows, regressions = compare(baseline, current, args.tolerance, args.min_ms)
+    print_comparison(rows, args.changes_only)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than baseline by more than "
+              f"{args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    print("\nno regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
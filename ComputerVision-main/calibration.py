@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import cv2
+import numpy as np
+
+# one JSON file per camera: <CV_CALIBRATION_DIR>/cam_<id>.json
+CALIBRATION_DIR = os.environ.get('CV_CALIBRATION_DIR', 'calibration')
+
+
+def _matrix(value, shape, name):
+    arr = np.asarray(value, dtype=np.float64)
+    if arr.shape != shape:
+        raise ValueError(f"{name} must be {shape[0]}x{shape[1]}, got shape {arr.shape}")
+    return arr
+
+
+class Calibration:
+    """
+    Lens and perspective calibration of one camera
+
+    camera_matrix and dist_coeffs undistort the frame; homography then maps
+    the undistorted image to the corrected view (e.g. a top-down view of a
+    road). Either part may be missing. Both are given for frames of
+    resolution (width, height) and are rescaled for other sizes.
+    """
+
+    def __init__(self, camera_matrix=None, dist_coeffs=None, homography=None, resolution=None, alpha=None):
+        """
+        Args:
+            camera_matrix: 3x3 intrinsic matrix K
+            dist_coeffs: 4, 5, 8, 12 or 14 distortion coefficients
+            homography: 3x3 matrix from undistorted to output pixels
+            resolution: (width, height) the matrices refer to (None: any)
+            alpha: Free scaling for cv2.getOptimalNewCameraMatrix (0 crops to
+                   valid pixels, 1 keeps all source pixels; None keeps K)
+
+        Raises:
+            ValueError: on malformed matrices or resolution, or when nothing
+                        is given
+        """
+        if camera_matrix is None and homography is None:
+            raise ValueError("calibration needs a camera_matrix or a homography")
+        if dist_coeffs is not None and camera_matrix is None:
+            raise ValueError("dist_coeffs need a camera_matrix")
+        self.camera_matrix = None if camera_matrix is None else _matrix(camera_matrix, (3, 3), 'camera_matrix')
+        self.dist_coeffs = None
+        if dist_coeffs is not None:
+            self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64).ravel()
+            if len(self.dist_coeffs) not in (4, 5, 8, 12, 14):
+                raise ValueError(f"dist_coeffs must have 4, 5, 8, 12 or 14 values, got {len(self.dist_coeffs)}")
+        self.homography = None if homography is None else _matrix(homography, (3, 3), 'homography')
+        if self.homography is not None and abs(np.linalg.det(self.homography)) < 1e-12:
+            raise ValueError("homography is singular")
+        self.resolution = None
+        if resolution is not None:
+            if len(resolution) != 2:
+                raise ValueError(f"resolution must be [width, height], got {resolution}")
+            self.resolution = (int(resolution[0]), int(resolution[1]))
+            if min(self.resolution) <= 0:
+                raise ValueError(f"resolution must be positive, got {list(self.resolution)}")
+        self.alpha = None if alpha is None else float(alpha)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('camera_matrix'), data.get('dist_coeffs'), data.get('homography'),
+                   data.get('resolution'), data.get('alpha'))
+
+    def to_dict(self):
+        tolist = lambda a: None if a is None else a.tolist()
+        return {
+            'camera_matrix': tolist(self.camera_matrix),
+            'dist_coeffs': tolist(self.dist_coeffs),
+            'homography': tolist(self.homography),
+            'resolution': None if self.resolution is None else list(self.resolution),
+            'alpha': self.alpha,
+        }
+
+    def build_maps(self, width, height):
+        """
+        Remap tables doing undistortion and homography in one pass
+
+        initUndistortRectifyMap takes output pixels through R^-1 * newK^-1
+        before distorting them into the source; with
+        R = newK^-1 * H * newK that becomes newK^-1 * H^-1, i.e. output ->
+        undistorted pixel (H^-1) -> normalized ray, so a single remap does
+        both corrections.
+
+        Returns:
+            (map1, map2): CV_16SC2 coordinates and CV_16UC1 interpolation
+            table (fixed point, 6 bytes per pixel), for cv2.remap
+        """
+        # matrices are in calibration pixels; scale them to this frame size
+        sx, sy = (1.0, 1.0) if self.resolution is None else (width / self.resolution[0], height / self.resolution[1])
+        scale = np.diag([sx, sy, 1.0])
+        if self.camera_matrix is not None:
+            K = scale @ self.camera_matrix
+            D = self.dist_coeffs
+            if self.alpha is not None:
+                new_K, _ = cv2.getOptimalNewCameraMatrix(K, D, (width, height), self.alpha)
+            else:
+                new_K = K
+        else:
+            K = new_K = np.eye(3)
+            D = None
+        R = np.eye(3)
+        if self.homography is not None:
+            H = scale @ self.homography @ np.linalg.inv(scale)
+            R = np.linalg.inv(new_K) @ H @ new_K
+        return cv2.initUndistortRectifyMap(K, D, R, new_K, (width, height), cv2.CV_16SC2)
+
+
+class CalibrationMaps:
+    """
+    Remap tables of one Calibration for the current frame size
+
+    Built on the first frame and rebuilt only when the frame size changes
+    (e.g. the source was switched to another resolution), so correcting a
+    frame costs one cv2.remap.
+    """
+
+    def __init__(self, calibration):
+        self.calibration = calibration
+        self.size = None
+        self.maps = None
+        self.builds = 0
+
+    def apply(self, img, interpolation=cv2.INTER_LINEAR):
+        h, w = img.shape[:2]
+        if self.size != (w, h):
+            self.maps = self.calibration.build_maps(w, h)
+            self.size = (w, h)
+            self.builds += 1
+        return cv2.remap(img, self.maps[0], self.maps[1], interpolation)
+
+
+class CalibrationStore:
+    """
+    Calibrations on disk, one JSON file per camera
+
+    Processors call sync() before each use; it stats the camera's file and
+    reloads it only when the file changed, so a calibration saved by the
+    web server reaches thread-mode processors and pool workers alike.
+    """
+
+    def __init__(self, directory=CALIBRATION_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.loaded = {}          # cam_id -> (file stamp, Calibration or None)
+
+    def path(self, cam_id):
+        return os.path.join(self.directory, f'cam_{cam_id}.json')
+
+    def _stamp(self, cam_id):
+        try:
+            st = os.stat(self.path(cam_id))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self, cam_id):
+        """
+        Calibration of a camera (cached until its file changes)
+
+        Returns:
+            Calibration, or None if the camera has none
+
+        Raises:
+            ValueError: if the file is not a valid calibration
+        """
+        stamp = self._stamp(cam_id)
+        with self.lock:
+            cached = self.loaded.get(cam_id)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        calibration, error = None, None
+        if stamp is not None:
+            try:
+                with open(self.path(cam_id)) as f:
+                    calibration = Calibration.from_dict(json.load(f))
+            except (ValueError, TypeError, AttributeError) as e:
+                error = ValueError(f"{self.path(cam_id)}: {e}")
+        with self.lock:
+            # a broken file is reported once, then treated as no calibration
+            self.loaded[cam_id] = (stamp, calibration)
+        if error is not None:
+            raise error
+        return calibration
+
+    def save(self, cam_id, calibration):
+        os.makedirs(self.directory, exist_ok=True)
+        # write-then-rename, so readers never see a half written file
+        tmp = self.path(cam_id) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(calibration.to_dict(), f, indent=1)
+        os.replace(tmp, self.path(cam_id))
+
+    def delete(self, cam_id):
+        try:
+            os.remove(self.path(cam_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def sync(self, cam_id, processor):
+        # hand the camera's current calibration to its processor if it changed
+        try:
+            calibration = self.load(cam_id)
+        except (OSError, ValueError) as e:
+            print(f"Invalid calibration for camera {cam_id}: {e}")
+            return
+        if calibration is not processor.calibration:
+            processor.set_calibration(calibration)
+
+
+calibration_store = CalibrationStore()
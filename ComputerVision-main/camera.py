@@ -1,93 +1,571 @@
+import itertools
+import random
 import threading
+import weakref
 import cv2
+import numpy as np
 import time
+import metrics
+import recording
+
+
+GRAB_SECONDS = metrics.histogram('cv_camera_grab_seconds', 'Time spent in cap.grab()', ('camera',))
+RETRIEVE_SECONDS = metrics.histogram('cv_camera_retrieve_seconds', 'Time spent in cap.retrieve()', ('camera',))
+GRABBED = metrics.counter('cv_camera_frames_grabbed_total', 'Frames pulled from the source', ('camera',))
+DECODED = metrics.counter('cv_camera_frames_decoded_total', 'Frames retrieved into BGR and published', ('camera',))
+LOCK_WAIT_SECONDS = metrics.histogram('cv_camera_lock_wait_seconds', 'Time waiting for the frame lock', ('camera', 'op'))
+COPY_SECONDS = metrics.histogram('cv_camera_copy_seconds', 'Time copying frames for writable consumers', ('camera',))
+ENCODE_SECONDS = metrics.histogram('cv_camera_jpeg_encode_seconds', 'Time encoding the shared viewer JPEG', ('camera',))
+RECONNECTS = metrics.counter('cv_camera_reconnects_total', 'Attempts to reopen a closed source', ('camera',))
+READ_FAILURES = metrics.counter('cv_camera_read_failures_total', 'grab/retrieve calls that returned no frame', ('camera',))
+
+# distinguishes VideoCamera objects: camera ids are reused when a camera is
+# removed and added again, and each new camera counts seq from 0
+_instance_ids = itertools.count(1)
+
+
+class _FrameLease:
+    """
+    Read-only handle on a ring buffer, handed out as the published frame
+
+    Frames are np.asarray(lease): the lease is the base of that array and of
+    every view, slice or reshape taken from it, so it lives exactly as long
+    as some consumer (or self.frame) can still see the buffer. The reader
+    keeps only a weak reference per slot and reuses a buffer once its lease
+    is gone.
+    """
+
+    __slots__ = ('buffer', '__array_interface__', '__weakref__')
+
+    def __init__(self, buf):
+        self.buffer = buf
+        interface = dict(buf.__array_interface__)
+        interface['data'] = (interface['data'][0], True)
+        self.__array_interface__ = interface
+
+
+def _lease(buf):
+    # (frame, lease): a read-only frame over buf and the lease it holds
+    lease = _FrameLease(buf)
+    return np.asarray(lease), lease
+
+
+def _buffer_in_use(leases, i):
+    # a slot is busy while the lease of the frame last decoded into it is alive
+    return leases[i] is not None and leases[i]() is not None
+
+
+def _read_only(frame):
+    view = frame.view()
+    view.flags.writeable = False
+    return view
+
+
 # --- Video camera handler per camera ---
 class VideoCamera:
-    def __init__(self):
+    def __init__(self, ring_size=4, name=None, max_fps=None, decode_fps=None, buffer_size=1,
+                 open_timeout=10.0, read_timeout=5.0, backoff_base=0.5, backoff_max=30.0,
+                 join_timeout=1.0, pace_files=True):
+        # label of this camera in /metrics
+        self.name = name
+        # cap on the read rate (None or 0: as fast as the source delivers)
+        self.max_fps = max_fps
+        # grab-only mode: every frame is grabbed to keep the stream live, but
+        # only retrieved (converted to BGR) when a consumer is waiting in
+        # wait_for_frame/wait_for_jpeg or 1/decode_fps seconds have passed,
+        # which bounds how stale polled frames get. None retrieves every frame.
+        self.decode_fps = decode_fps
+        # play video files at their own frame rate (False: as fast as they
+        # decode, e.g. for benchmarks)
+        self.pace_files = pace_files
+        # CAP_PROP_BUFFERSIZE: frames the backend may queue (where supported)
+        self.buffer_size = buffer_size
+        self.waiters = 0          # consumers blocked in wait_for_*, guarded by self.lock
+        self.grabbed = 0
+        self.decoded = 0
+        # share of one CPU the reader thread used over the last second
+        self.cpu_percent = 0.0
+        # connection handling: opens and reads give up after these many
+        # seconds, failed connections are retried with exponential backoff
+        self.open_timeout = open_timeout
+        self.read_timeout = read_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.join_timeout = join_timeout
+        # health: 'stopped', 'connecting', 'live', 'stalled', 'backoff' or 'ended'
+        self.state = 'stopped'
+        self.state_since = time.monotonic()
+        self.last_error = None
+        self.reconnects = 0
+        # bumped by stop(); a reader only publishes frames of its own generation
+        self.generation = 0
+        self.stop_event = None
+        # readers that did not exit within join_timeout (blocked in open/read)
+        self.stale_readers = []
         self.source = None
-        self.cap = None
-        self.frame = None         # BGR numpy array
+        self.frame = None         # read-only BGR view into a ring buffer
+        # number of preallocated frame buffers the reader cycles through
+        self.ring_size = ring_size
+        self.ring_allocs = 0      # buffers allocated (grows only on resize/pressure)
+        self.seq = 0              # increases by one for every new frame
+        self.instance = next(_instance_ids)
         self.lock = threading.Lock()
+        # notified (under self.lock) every time a new frame is stored
+        self.new_frame = threading.Condition(self.lock)
+        self.frame_time = None    # time.monotonic() when the frame arrived
+        # achieved read rate and frame-to-consumer latency (moving averages)
+        self.fps = 0.0
+        self.latency_ms = 0.0
+        # JPEG of the current frame, encoded lazily and shared by all viewers
+        self.jpeg_lock = threading.Lock()
+        self.jpeg_seq = -1
+        self.jpeg_bytes = None
         self.running = False
         self.thread = None
 
     def start(self, source):
         # nếu cùng source thì giữ nguyên
-        if self.running and self.source == source:
+        if self.running and self.source == source and self.state != 'ended':
             return
         # stop existing
         self.stop()
         self.source = source
         self.running = True
-        self.thread = threading.Thread(target=self._reader, daemon=True)
+        stop_event = threading.Event()
+        self.stop_event = stop_event
+        with self.lock:
+            generation = self.generation
+        self._set_state(generation, 'connecting')
+        self.thread = threading.Thread(target=self._reader, args=(generation, stop_event), daemon=True)
         self.thread.start()
 
     def stop(self):
+        """
+        Stop reading; never blocks for longer than join_timeout
+
+        The reader is told to stop and its generation is retired, so even a
+        reader stuck in a blocking open or read cannot publish frames any
+        more. It releases its own capture (never released from this thread
+        while in use) once the blocking call returns, which the open/read
+        timeouts bound.
+        """
         self.running = False
-        if self.thread:
-            self.thread.join(timeout=0.5)
-        if self.cap:
-            try:
-                self.cap.release()
-            except:
-                pass
-        self.cap = None
-        self.thread = None
-        self.frame = None
+        if self.stop_event is not None:
+            self.stop_event.set()
+        with self.lock:
+            self.generation += 1
+            self.state = 'stopped'
+            self.state_since = time.monotonic()
+            self.frame = None
+            self.frame_time = None
+            self.fps = 0.0
+            self.seq += 1
+            # wake up consumers so they notice the camera went away
+            self.new_frame.notify_all()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=self.join_timeout)
+            if thread.is_alive():
+                # stuck in a blocking call; it exits when that call times out
+                self.stale_readers.append(thread)
+        self.stale_readers = [t for t in self.stale_readers if t.is_alive()]
+        self.cpu_percent = 0.0
+        with self.jpeg_lock:
+            self.jpeg_seq = -1
+            self.jpeg_bytes = None
+
+    def _set_state(self, generation, state, error=None):
+        # record a health state change, unless the reader has been retired
+        with self.lock:
+            if generation != self.generation:
+                return False
+            if state != self.state:
+                self.state = state
+                self.state_since = time.monotonic()
+            if error is not None:
+                self.last_error = error
+            return True
+
+    def _open(self, stop_event=None):
+        """
+        Open the source with open/read timeouts
 
-    def _reader(self):
-        # try open source
+        'replay://' sources are ring files played by recording.ReplayCapture.
+
+        Args:
+            stop_event: The reader's stop event; interrupts a replay waiting
+                        for its next frame's time
+
+        Returns:
+            (cap, error): an opened VideoCapture, or (None, reason)
+        """
+        if isinstance(self.source, str) and self.source.startswith(recording.REPLAY_SCHEME):
+            try:
+                cap = recording.ReplayCapture.from_source(self.source, stop_event)
+            except (OSError, ValueError) as e:
+                return None, f"open failed: {e}"
+            if not cap.isOpened():
+                cap.release()
+                return None, "recording is empty"
+            return cap, None
+        params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(self.open_timeout * 1000),
+                  cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(self.read_timeout * 1000)]
+        cap = None
         try:
-            self.cap = cv2.VideoCapture(self.source, cv2.CAP_FFMPEG)
-        except:
-            self.cap = cv2.VideoCapture(self.source)
-        # optional tune: set buffer size or transport
-        # read loop
-        while self.running:
-            if not self.cap or not self.cap.isOpened():
-                # try reopen every 2s
-                time.sleep(2)
-                try:
-                    self.cap = cv2.VideoCapture(self.source, cv2.CAP_FFMPEG)
-                except:
-                    self.cap = cv2.VideoCapture(self.source)
-                continue
-            ret, frame = self.cap.read()
-            if not ret or frame is None:
-                time.sleep(0.05)
-                continue
-            with self.lock:
-                self.frame = frame.copy()
-            # small sleep to relinquish CPU
-            time.sleep(0.02)
-        # cleanup
+            cap = cv2.VideoCapture(self.source, cv2.CAP_FFMPEG, params)
+            if not cap.isOpened():
+                # not an FFmpeg source (e.g. a device): let OpenCV pick the backend
+                cap.release()
+                cap = cv2.VideoCapture(self.source, cv2.CAP_ANY, params)
+        except cv2.error as e:
+            return None, f"open failed: {e}"
+        if not cap.isOpened():
+            cap.release()
+            return None, "could not open source"
+        if self.buffer_size:
+            # fewer queued frames = less latency; ignored by backends without it
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)
+        return cap, None
+
+    def _backoff(self, attempt):
+        # exponential backoff with jitter, so flapping cameras do not reconnect in lockstep
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _frame_interval(cap):
+        """
+        Seconds between frames of a video file, to play it in real time
+
+        Live sources block in grab() until the next frame arrives, but a
+        file is read as fast as it decodes; without pacing it would end
+        (and e.g. a recording of it would stop) after a fraction of its
+        duration. Replays pace themselves.
+
+        Returns:
+            Interval at the file's CAP_PROP_FPS (25 fps when unknown), or
+            None for live and replay sources
+        """
+        if isinstance(cap, recording.ReplayCapture) or cap.get(cv2.CAP_PROP_FRAME_COUNT) <= 0:
+            return None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        return 1.0 / (fps if 0 < fps <= 1000 else 25.0)
+
+    @staticmethod
+    def _ended(cap):
+        # a file source at its last frame (live sources report no frame count)
+        count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        return count > 0 and cap.get(cv2.CAP_PROP_POS_FRAMES) >= count
+
+    def _should_decode(self, now, last_decode):
+        if not self.decode_fps or self.waiters > 0:
+            return True
+        return now - last_decode >= 1.0 / self.decode_fps
+
+    def _reader(self, generation, stop_event):
+        """
+        Reader thread of one generation
+
+        Owns its capture: opens it (with backoff between failed attempts),
+        reconnects when no frame arrived for read_timeout, and releases it
+        on exit. Frames are only published while generation is current.
+        """
+        cap = None
+        attempt = 0
+        # frames are decoded straight into a small ring of reusable buffers
+        ring = []
+        leases = []  # weak reference to the lease of each slot's last frame
+        pos = 0
+        last_decode = 0.0
+        last_ok = time.monotonic()
+        next_due = time.monotonic()
+        play_due = time.monotonic()
+        cpu_wall, cpu_start = time.monotonic(), time.thread_time()
         try:
-            if self.cap:
-                self.cap.release()
-        except:
-            pass
-        self.cap = None
+            # read loop
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if now - cpu_wall >= 1.0:
+                    cpu = time.thread_time()
+                    self.cpu_percent = 100.0 * (cpu - cpu_start) / (now - cpu_wall)
+                    cpu_wall, cpu_start = now, cpu
+                if cap is None:
+                    if attempt > 0:
+                        RECONNECTS.inc(self.name)
+                        self.reconnects += 1
+                    self._set_state(generation, 'connecting')
+                    cap, error = self._open(stop_event)
+                    if cap is None:
+                        attempt += 1
+                        self._set_state(generation, 'backoff', error)
+                        stop_event.wait(self._backoff(attempt))
+                        continue
+                    last_ok = time.monotonic()
+                    zero_copy = getattr(cap, 'zero_copy', False)
+                    frame_interval = self._frame_interval(cap) if self.pace_files else None
+                    play_due = last_ok
+                if self.max_fps:
+                    # sleeping (instead of reading and dropping) is what saves the CPU
+                    if now < next_due:
+                        stop_event.wait(next_due - now)
+                    next_due = max(next_due + 1.0 / self.max_fps, time.monotonic())
+                if frame_interval:
+                    # video file: wait until its next frame is due
+                    now = time.monotonic()
+                    if now < play_due:
+                        if stop_event.wait(play_due - now):
+                            break
+                    play_due = max(play_due + frame_interval, time.monotonic())
+                # grab keeps the stream drained (live) even when nothing is decoded
+                t0 = time.perf_counter()
+                ret = cap.grab()
+                GRAB_SECONDS.observe(time.perf_counter() - t0, self.name)
+                if not ret:
+                    READ_FAILURES.inc(self.name)
+                    if self._ended(cap):
+                        # end of a video file: keep showing the last frame
+                        self._set_state(generation, 'ended')
+                        return
+                    if time.monotonic() - last_ok >= self.read_timeout:
+                        # dead source: drop the decoder and reconnect with backoff
+                        cap.release()
+                        cap = None
+                        attempt += 1
+                        self._set_state(generation, 'backoff', "no frames for %.1f s" % self.read_timeout)
+                        stop_event.wait(self._backoff(attempt))
+                    else:
+                        self._set_state(generation, 'stalled')
+                        stop_event.wait(0.05)
+                    continue
+                last_ok = time.monotonic()
+                attempt = 0
+                self.grabbed += 1
+                GRABBED.inc(self.name)
+                if not self._should_decode(last_ok, last_decode):
+                    continue
+                buf = None
+                if not zero_copy:
+                    # replay sources hand out views of their own memory instead
+                    pos, buf = self._next_buffer(ring, leases, pos)
+                t0 = time.perf_counter()
+                ret, frame = cap.retrieve(image=buf)
+                RETRIEVE_SECONDS.observe(time.perf_counter() - t0, self.name)
+                if not ret or frame is None:
+                    READ_FAILURES.inc(self.name)
+                    continue
+                last_decode = time.monotonic()
+                self.decoded += 1
+                DECODED.inc(self.name)
+                if frame is not buf and not zero_copy:
+                    # first frame in this slot, or the source changed resolution:
+                    # OpenCV allocated a new array, keep it for reuse
+                    ring[pos] = frame
+                    self.ring_allocs += 1
+                if zero_copy:
+                    view = _read_only(frame)
+                else:
+                    view, lease = _lease(frame)
+                    leases[pos] = weakref.ref(lease)
+                    lease = None
+                now = time.monotonic()
+                t0 = time.perf_counter()
+                with self.lock:
+                    LOCK_WAIT_SECONDS.observe(time.perf_counter() - t0, self.name, 'publish')
+                    if generation != self.generation:
+                        # retired while blocked in grab/retrieve
+                        return
+                    if self.state != 'live':
+                        self.state = 'live'
+                        self.state_since = now
+                    if self.frame_time is not None:
+                        dt = now - self.frame_time
+                        if dt > 0:
+                            self.fps = 0.9 * self.fps + 0.1 * (1.0 / dt) if self.fps else 1.0 / dt
+                    self.frame = view
+                    self.frame_time = now
+                    self.seq += 1
+                    self.new_frame.notify_all()
+                # no sleep: grab() blocks until a live source delivers the next
+                # frame, and files were paced to their frame rate above
+        finally:
+            if cap is not None:
+                cap.release()
+
+    def _next_buffer(self, ring, leases, pos):
+        """
+        Pick the ring slot the next frame is decoded into
+
+        A buffer is only reused once the lease of the frame last decoded
+        into it is gone, i.e. no consumer holds that frame or any view of it
+        (the latest frame is always held by self.frame), so a frame handed
+        out is never overwritten. When every slot is busy the slot is
+        detached and OpenCV allocates a fresh array; the old one is freed by
+        the last consumer that lets go of it.
+
+        Args:
+            ring: Reusable buffers, one per slot
+            leases: Weak reference to each slot's current lease (or None)
+            pos: Slot the previous frame was decoded into
+
+        Returns:
+            (pos, buf): slot index and buffer to read into (None to allocate)
+        """
+        if len(ring) < self.ring_size:
+            ring.append(None)
+            leases.append(None)
+            return len(ring) - 1, None
+        for k in range(1, len(ring) + 1):
+            i = (pos + k) % len(ring)
+            if ring[i] is None or not _buffer_in_use(leases, i):
+                return i, ring[i]
+        i = (pos + 1) % len(ring)
+        ring[i] = leases[i] = None
+        return i, None
+
+    def frame_key(self, seq):
+        # names frame seq of this camera for shared caches; seq never repeats
+        # within a camera (stop() bumps it too) and instances are never reused
+        return (self.instance, seq)
 
     def get_frame_jpeg(self):
         # return JPEG bytes of current frame, or None
+        return self.get_frame_jpeg_seq()[1]
+
+    def get_frame_jpeg_seq(self):
+        # return (seq, JPEG bytes) of current frame; bytes is None if no frame.
+        # The frame is encoded once, on first request, and the same bytes
+        # object is handed to every caller until a newer frame arrives.
         with self.lock:
-            f = None if self.frame is None else self.frame.copy()
+            seq = self.seq
+            f = self.frame
         if f is None:
-            return None
-        # encode as JPEG
-        ret, jpeg = cv2.imencode('.jpg', f, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-        if not ret:
-            return None
-        return jpeg.tobytes()
+            return seq, None
+        with self.jpeg_lock:
+            if self.jpeg_seq != seq:
+                # ring buffers are not reused while their lease is held,
+                # so encoding outside self.lock is safe
+                t0 = time.perf_counter()
+                ret, jpeg = cv2.imencode('.jpg', f, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+                ENCODE_SECONDS.observe(time.perf_counter() - t0, self.name)
+                self.jpeg_bytes = jpeg.tobytes() if ret else None
+                self.jpeg_seq = seq
+            return seq, self.jpeg_bytes
+
+    def wait_for_frame(self, after_seq, timeout=None, writable=False):
+        """
+        Block until a frame newer than after_seq is available
 
-    def get_frame_bgr(self):
+        Args:
+            after_seq: Sequence number the caller already has (-1 for any frame)
+            timeout: Maximum time to wait in seconds (None waits forever)
+            writable: Return a private copy instead of a read-only view
+
+        Returns:
+            (seq, frame): frame is None if the timeout expired or the camera
+            has no frame (e.g. it was stopped)
+        """
         with self.lock:
-            return None if self.frame is None else self.frame.copy()
+            if not self._wait(after_seq, timeout):
+                return self.seq, None
+            if self.frame is not None:
+                self._record_latency()
+            seq, f = self.seq, self.frame
+        return seq, self._export(f, writable)
+
+    def wait_for_jpeg(self, after_seq, timeout=None):
+        # like wait_for_frame but returns the shared JPEG bytes of the frame
+        with self.lock:
+            if not self._wait(after_seq, timeout):
+                return self.seq, None
+            if self.frame is not None:
+                self._record_latency()
+        return self.get_frame_jpeg_seq()
+
+    def _wait(self, after_seq, timeout):
+        # called with self.lock held; waiting consumers make the reader decode every frame
+        self.waiters += 1
+        try:
+            return self.new_frame.wait_for(lambda: self.seq > after_seq, timeout)
+        finally:
+            self.waiters -= 1
+
+    def _record_latency(self):
+        # called with self.lock held, right after a consumer woke up
+        ms = (time.monotonic() - self.frame_time) * 1000
+        self.latency_ms = 0.9 * self.latency_ms + 0.1 * ms if self.latency_ms else ms
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'source': self.source,
+                'running': self.running,
+                'seq': self.seq,
+                'fps': round(self.fps, 2),
+                'max_fps': self.max_fps,
+                'cpu_percent': round(self.cpu_percent, 1),
+                'latency_ms': round(self.latency_ms, 2),
+                'ring_allocs': self.ring_allocs,
+                'state': self.state,
+                'decode_fps': self.decode_fps,
+                'grabbed': self.grabbed,
+                'decoded': self.decoded,
+                'decode_ratio': round(self.decoded / self.grabbed, 3) if self.grabbed else None,
+            }
+
+    def get_health(self):
+        """
+        Connection health of the camera
+
+        Returns:
+            dict: state, seconds in that state, age of the newest frame,
+            reconnect count, last error, generation and readers still
+            winding down after a stop
+        """
+        now = time.monotonic()
+        with self.lock:
+            health = {
+                'state': self.state,
+                'state_s': round(now - self.state_since, 1),
+                'frame_age_s': None if self.frame_time is None else round(now - self.frame_time, 2),
+                'reconnects': self.reconnects,
+                'last_error': self.last_error,
+                'generation': self.generation,
+            }
+        health['stale_readers'] = sum(t.is_alive() for t in self.stale_readers)
+        return health
+
+    def get_frame_seq(self, writable=False):
+        # return (seq, frame); frame is a read-only view unless writable=True
+        t0 = time.perf_counter()
+        with self.lock:
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - t0, self.name, 'get')
+            seq, f = self.seq, self.frame
+        return seq, self._export(f, writable)
+
+    def get_frame_timed(self, writable=False):
+        # return (seq, frame, time.monotonic() when the frame arrived)
+        t0 = time.perf_counter()
+        with self.lock:
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - t0, self.name, 'get')
+            seq, f, t = self.seq, self.frame, self.frame_time
+        return seq, self._export(f, writable), t
+
+    def get_frame_bgr(self, writable=False):
+        # read-only view of the current frame, or a private copy if writable
+        return self.get_frame_seq(writable)[1]
+
+    def _export(self, f, writable):
+        if f is None or not writable:
+            return f
+        t0 = time.perf_counter()
+        f = f.copy()
+        COPY_SECONDS.observe(time.perf_counter() - t0, self.name)
+        return f
 
     def get_frame_bmp(self):
         # return BMP bytes of current frame, or None
         with self.lock:
-            f = None if self.frame is None else self.frame.copy()
+            f = self.frame
         if f is None:
             return None
         # encode as BMP
@@ -0,0 +1,188 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import cv2
+
+
+# file extension -> cv2.imencode extension
+FORMATS = {
+    'bmp': '.bmp',
+    'png': '.png',
+    'jpeg': '.jpg',
+    'jpg': '.jpg',
+}
+
+POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class AsyncImageWriter:
+    """
+    Background image writer with a bounded queue
+
+    Images are encoded and written on a worker thread so the caller (e.g. a
+    Flask request) never waits for the disk. The worker drains the queue in
+    batches; when the same file appears several times in one batch only the
+    newest image is written, since the others would be overwritten anyway.
+
+    Images are written as-is, so callers must not modify an array after
+    submitting it (camera frames are read-only views, which is fine).
+    """
+
+    def __init__(self, save_dir="CapturedImage", fmt=None, png_level=3, jpeg_quality=90,
+                 max_queue=32, policy='drop_oldest', timestamped=False, batch_size=8):
+        """
+        Args:
+            save_dir: Directory images are written into (created once here)
+            fmt: 'bmp', 'png' or 'jpeg'; None keeps each filename's extension
+            png_level: PNG compression level 0-9
+            jpeg_quality: JPEG quality 0-100
+            max_queue: Maximum number of images waiting to be written
+            policy: What submit() does when the queue is full:
+                    'drop_oldest' discards the oldest queued image,
+                    'drop_newest' rejects the new image,
+                    'block' waits for space
+            timestamped: Append a timestamp to every filename
+            batch_size: Maximum number of images handled per worker wake-up
+        """
+        if fmt is not None and fmt not in FORMATS:
+            raise ValueError(f"unsupported format '{fmt}'")
+        if policy not in POLICIES:
+            raise ValueError(f"unsupported policy '{policy}'")
+        self.save_dir = save_dir
+        self.fmt = fmt
+        self.png_level = png_level
+        self.jpeg_quality = jpeg_quality
+        self.policy = policy
+        self.timestamped = timestamped
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        os.makedirs(save_dir, exist_ok=True)
+
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.write_time = 0.0     # seconds spent encoding + writing
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, img, filename):
+        """
+        Queue an image for writing
+
+        Args:
+            img: Image (numpy array)
+            filename: File name inside save_dir
+
+        Returns:
+            bool: True if queued, False if it was dropped
+        """
+        item = (img, self._target_path(filename))
+        with self.stats_lock:
+            self.submitted += 1
+        if self.policy == 'block':
+            self.queue.put(item)
+            return True
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+            if self.policy == 'drop_newest':
+                self._count_drop()
+                return False
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self._count_drop()
+            except queue.Empty:
+                pass
+
+    def flush(self):
+        # block until everything queued so far has been written
+        self.queue.join()
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'bytes_written': self.bytes_written,
+                'writes_per_sec': round(self.written / self.write_time, 2) if self.write_time else 0.0,
+                'mb_per_sec': round(self.bytes_written / self.write_time / 1e6, 2) if self.write_time else 0.0,
+            }
+
+    def _count_drop(self):
+        with self.stats_lock:
+            self.dropped += 1
+
+    def _target_path(self, filename):
+        base, ext = os.path.splitext(filename)
+        if self.fmt is not None:
+            ext = FORMATS[self.fmt]
+        if self.timestamped:
+            base += datetime.now().strftime("_%Y%m%d-%H%M%S-%f")
+        return os.path.join(self.save_dir, base + ext)
+
+    def _encode_params(self, ext):
+        ext = ext.lower()
+        if ext == '.png':
+            return [int(cv2.IMWRITE_PNG_COMPRESSION), self.png_level]
+        if ext in ('.jpg', '.jpeg'):
+            return [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality]
+        return []
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # newest image per path wins
+            latest = {}
+            for img, path in batch:
+                latest[path] = img
+            start = time.perf_counter()
+            written = failed = nbytes = 0
+            for path, img in latest.items():
+                n = self._write(img, path)
+                if n is None:
+                    failed += 1
+                else:
+                    written += 1
+                    nbytes += n
+            with self.stats_lock:
+                self.written += written
+                self.failed += failed
+                self.coalesced += len(batch) - len(latest)
+                self.bytes_written += nbytes
+                self.write_time += time.perf_counter() - start
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write(self, img, path):
+        # returns number of bytes written, or None on failure
+        try:
+            ext = os.path.splitext(path)[1]
+            ret, buf = cv2.imencode(ext, img, self._encode_params(ext))
+            if not ret:
+                return None
+            with open(path, 'wb') as f:
+                f.write(buf)
+            return buf.nbytes
+        except Exception as e:
+            print("Error saving image:", e)
+            return None
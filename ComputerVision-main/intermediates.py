@@ -0,0 +1,131 @@
+import threading
+from collections import OrderedDict
+import cv2
+
+
+class IntermediateCache:
+    """
+    Bounded LRU cache for images derived from a frame (grayscale, binary mask, ...)
+
+    Entries are keyed by (frame_key, derivation, params), where frame_key
+    identifies one camera frame, e.g. (cam_id, *cam.frame_key(seq)). Cached
+    arrays are made read-only so a stage cannot corrupt them for the next
+    user.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=256):
+        """
+        Args:
+            max_bytes: Upper bound on the total size of cached arrays
+            max_entries: Upper bound on the number of cached arrays
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for key, computing and storing it on a miss
+
+        Args:
+            key: Hashable key (frame_key, derivation, params)
+            compute: Callable returning a numpy array
+
+        Returns:
+            Read-only numpy array
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        # compute outside the lock; two threads racing on the same key both
+        # compute, the first one to finish wins
+        value = compute()
+        value.flags.writeable = False
+        with self.lock:
+            existing = self.entries.get(key)
+            if existing is not None:
+                return existing
+            self.entries[key] = value
+            self.nbytes += value.nbytes
+            while self.entries and (self.nbytes > self.max_bytes or len(self.entries) > self.max_entries):
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+            }
+
+
+# shared by every ImageProcessor unless one is given explicitly
+shared_cache = IntermediateCache()
+
+
+class FrameContext:
+    """
+    Per-run view of the cache for one source frame
+
+    Tracks which arrays are known derivations of the source frame, so a
+    stage asking for e.g. the binary mask of the cached grayscale image
+    hits the same entry as a stage asking for the binary mask of the frame.
+    Without a frame_key (or cache) everything is computed directly.
+    """
+
+    def __init__(self, source, frame_key=None, cache=None):
+        self.frame_key = frame_key
+        self.cache = cache if frame_key is not None else None
+        # id(array) -> (derivation chain, array); the array is kept so its id stays valid
+        self.known = {id(source): ((), source)}
+
+    def derive(self, img, name, params, compute):
+        """
+        Return compute() for img, memoized when img derives from the source frame
+
+        Args:
+            img: Input of the derivation
+            name: Derivation name, e.g. 'gray'
+            params: Hashable parameters of the derivation
+            compute: Callable returning the derived array
+        """
+        entry = self.known.get(id(img))
+        if self.cache is None or entry is None or entry[1] is not img:
+            return compute()
+        chain = entry[0] + ((name, params),)
+        value = self.cache.get_or_compute((self.frame_key, chain), compute)
+        self.known[id(value)] = (chain, value)
+        return value
+
+    def gray(self, img):
+        # grayscale of img (img itself if it is already single-channel)
+        if len(img.shape) == 2:
+            return img
+        return self.derive(img, 'gray', None, lambda: cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+
+    def binary(self, img, threshold_value=127):
+        # cv2.THRESH_BINARY mask of the grayscale of img
+        gray = self.gray(img)
+        return self.derive(gray, 'binary', threshold_value,
+                           lambda: cv2.threshold(gray, threshold_value, 255, cv2.THRESH_BINARY)[1])
@@ -0,0 +1,216 @@
+import os
+import threading
+from bisect import bisect_left
+
+# CV_METRICS=0 turns every observe/inc/set into an early return
+ENABLED = os.environ.get('CV_METRICS', '1') != '0'
+
+# seconds; covers sub-millisecond copies up to multi-second filters
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# label sets beyond this many per metric are folded into 'other'
+MAX_SERIES = 200
+
+
+def set_enabled(flag):
+    global ENABLED
+    ENABLED = bool(flag)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        # called with self.lock held; caps the number of series per metric
+        if labels in self.series or len(self.series) < MAX_SERIES:
+            return labels
+        return ('other',) * len(self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type_name}']
+        with self.lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        with self.lock:
+            key = self._key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}'
+                for k, v in self.series.items()]
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value, *labels):
+        if not ENABLED:
+            return
+        with self.lock:
+            self.series[self._key(labels)] = value
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        with self.lock:
+            key = self._key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}'
+                for k, v in self.series.items()]
+
+
+class CallbackGauge(Gauge):
+    """Gauge read at scrape time from fn() -> {label values tuple: value}"""
+
+    def __init__(self, name, help_text, labelnames, fn):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def render(self):
+        values = self.fn()
+        with self.lock:
+            self.series = dict(values)
+        return super().render()
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        Record one value (in seconds for *_seconds metrics)
+
+        Args:
+            value: Observed value
+            *labels: One value per label name, in order
+        """
+        if not ENABLED:
+            return
+        with self.lock:
+            key = self._key(labels)
+            series = self.series.get(key)
+            if series is None:
+                # per-bucket counts (+Inf last), then sum and count
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    """All metrics of the process, rendered together for /metrics"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # registering the same name twice returns the existing metric
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """
+        Prometheus text exposition format (version 0.0.4)
+
+        Returns:
+            str: One HELP/TYPE block per metric
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labelnames=()):
+    return REGISTRY.register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, labelnames=()):
+    return REGISTRY.register(Gauge(name, help_text, labelnames))
+
+
+def callback_gauge(name, help_text, labelnames, fn):
+    return REGISTRY.register(CallbackGauge(name, help_text, labelnames, fn))
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labelnames, buckets))
+
+
+# =============================================================================
+# PIPELINE METRICS (shared by in-process and pooled processing)
+# =============================================================================
+
+PIPELINE_SECONDS = histogram('cv_pipeline_seconds', 'Filter pipeline run time', ('filter',))
+STAGE_SECONDS = histogram('cv_pipeline_stage_seconds', 'Time per pipeline stage', ('filter', 'stage'))
+PROCESS_FRAME_SECONDS = histogram('cv_process_frame_seconds', 'ImageProcessor.process_frame run time')
+
+
+def record_pipeline(spec, process_time_ms, stage_times):
+    # stage_times as returned by ImageProcessor.apply_pipeline (milliseconds)
+    if not ENABLED:
+        return
+    PIPELINE_SECONDS.observe(process_time_ms / 1000, spec)
+    for stage, ms in stage_times:
+        STAGE_SECONDS.observe(ms / 1000, spec, stage)
@@ -1,15 +1,27 @@
+import atexit
+import threading
 import time
-import cv2
-import numpy as np
 import os
 from Week1_Capturing.Week1_captureSaveImg import CaptureSaveImgProcessor
 from Week2_Filtering.Week2_Ex1_Grayscale import GrayscaleProcessor
-from Week2_Filtering.Week2_Ex1_Gaussian import GaussianProcessor
-from Week2_Filtering.Week2_Ex2_AdvancedFilters import (
-    MedianBlur, SobelEdgeDetection, LaplacianEdgeDetection,
-    SharpeningFilter, BilateralFilter, BinaryThresholding,
-    Erosion, Dilation
-)
+from pipeline import get_pipeline
+from intermediates import shared_cache
+from image_writer import AsyncImageWriter
+from motion import MotionDetector, SKIPPED
+from tracker import ObjectTracker
+from calibration import CalibrationMaps, calibration_store
+import metrics
+
+
+# capture images are written in the background, off the request thread
+image_writer = AsyncImageWriter(save_dir="CapturedImage", fmt='bmp')
+capture_saver = CaptureSaveImgProcessor(writer=image_writer)
+atexit.register(image_writer.flush)
+grayscale_processor = GrayscaleProcessor()
+
+# CV_MOTION_GATE=1 reuses the previous result while the scene is static
+# (inherited by pool workers, which build their own processors)
+MOTION_GATE = os.environ.get('CV_MOTION_GATE', '0') == '1'
 
 
 class ImageProcessor:
@@ -18,13 +30,29 @@ class ImageProcessor:
     Implements computer vision techniques from ProjectProgress.txt
     """
     
-    def __init__(self):
-        """Initialize image processor with calibration parameters"""
+    def __init__(self, cache=None, motion_gate=None):
+        """
+        Initialize image processor with calibration parameters
+        
+        Args:
+            cache: IntermediateCache for per-frame intermediates
+                   (defaults to the cache shared by all processors)
+            motion_gate: Skip processing and return the previous result
+                         while nothing moves (default: CV_MOTION_GATE)
+        """
+        self.cache = shared_cache if cache is None else cache
         self.camera_matrix = None  # Camera calibration matrix
         self.dist_coeffs = None    # Distortion coefficients
         self.homography_matrix = None  # Homography transformation matrix
+        self.calibration = None     # Calibration the three above come from
+        self.calibration_maps = None  # its remap tables for the current frame size
         self.previous_frame = None  # For motion detection
-        self.tracked_objects = []   # For object tracking
+        self.tracker = ObjectTracker()  # For object tracking (see tracked_objects)
+        self.frames_processed = 0   # process_frame calls so far
+        self.previous_results = {}
+        self.motion = MotionDetector()
+        self.motion_gate = MOTION_GATE if motion_gate is None else motion_gate
+        self.frames_reused = 0      # calls answered with the previous result
         pass
     
     
@@ -42,152 +70,166 @@ class ImageProcessor:
         start_time = time.perf_counter()
         results = {}
         
-
+        ## Step 4: Calibration and perspective correction (no-op when uncalibrated)
+        frame = self.correct_frame(bgr_img)
+        
+        # static scene: the previous result still holds, skip the pipeline
+        motion = self.detect_motion(frame)
+        if self.motion_gate and not motion.changed and self.previous_frame is not None:
+            self.frames_reused += 1
+            SKIPPED.inc('process_frame')
+            results = dict(self.previous_results, motion=dict(motion.to_dict(), reused=True))
+            return self.previous_frame, results, (time.perf_counter() - start_time) * 1000
         
         ###################### WRITE YOUR PROCESS PIPELINE HERE #########################
-        saveImg = CaptureSaveImgProcessor()
+        saveImg = capture_saver
         
         step1_image = saveImg.capture_and_save_image(bgr_img, "test_capture.bmp") ## Step 1: Capture and Save Image
         ######################## IMAGE FILTERING ########################################
         ## Step 2: Convert to Grayscale
-        grayScaleProcessor = GrayscaleProcessor()
-        processed_img = grayScaleProcessor.convert_to_grayscale(bgr_img)
+        grayScaleProcessor = grayscale_processor
+        processed_img = grayScaleProcessor.convert_to_grayscale(frame)
         ## Save Processed Image
         step3_image = saveImg.capture_and_save_image(processed_img, "processed_capture.bmp")
+        ## Step 7: Track the moving regions across frames
+        self.track_objects(motion.boxes)
+        results['tracks'] = self.tracked_objects
         #################################################################################
         
+        # keep state for the next call on this processor (motion, tracking)
+        self.previous_frame = processed_img
+        self.previous_results = results
+        self.motion.mark_processed()
+        self.frames_processed += 1
+        results = dict(results, motion=dict(motion.to_dict(), reused=False))
+        
         process_time_ms = (time.perf_counter() - start_time) * 1000
+        metrics.PROCESS_FRAME_SECONDS.observe(process_time_ms / 1000)
         return processed_img, results, process_time_ms
     
-    def apply_filter(self, bgr_img, filter_type='grayscale'):
+    # =============================================================================
+    # STEP 4: CALIBRATION AND PERSPECTIVE CORRECTION
+    # =============================================================================
+    
+    def set_calibration(self, calibration):
+        """
+        Use a camera calibration (or None to stop correcting frames)
+        
+        Args:
+            calibration: calibration.Calibration with the camera matrix,
+                         distortion coefficients and/or homography
+        """
+        self.calibration = calibration
+        self.camera_matrix = None if calibration is None else calibration.camera_matrix
+        self.dist_coeffs = None if calibration is None else calibration.dist_coeffs
+        self.homography_matrix = None if calibration is None else calibration.homography
+        self.calibration_maps = None if calibration is None else CalibrationMaps(calibration)
+    
+    def correct_frame(self, bgr_img):
+        """
+        Undistort and perspective-correct a frame with one cv2.remap
+        
+        The remap tables are built on the first frame and again only when
+        the frame size changes.
+        
+        Args:
+            bgr_img: Input image
+            
+        Returns:
+            Corrected image (the input itself when there is no calibration)
+        """
+        maps = self.calibration_maps
+        if maps is None:
+            return bgr_img
+        return maps.apply(bgr_img)
+    
+    # =============================================================================
+    # STEP 7: OBJECT TRACKING
+    # =============================================================================
+    
+    def track_objects(self, boxes):
+        """
+        Associate this frame's detections with the camera's tracks
+        
+        Args:
+            boxes: Detections as (x, y, w, h) in frame pixels, e.g. the
+                   boxes of detect_motion
+            
+        Returns:
+            list: Track id of each box (new ids for new objects)
+        """
+        return self.tracker.update(boxes).tolist()
+    
+    @property
+    def tracked_objects(self):
+        # current tracks: id, box, velocity, age, missed
+        return self.tracker.tracks()
+    
+    def detect_motion(self, bgr_img):
+        """
+        Update this processor's motion model with a frame
+        
+        Args:
+            bgr_img: Input image in BGR format
+            
+        Returns:
+            MotionResult: score, moving regions, and whether the frame
+            differs from the last one processed
+        """
+        return self.motion.update(bgr_img)
+    
+    def apply_filter(self, bgr_img, filter_type='grayscale', frame_key=None):
         """
         Apply a specific filter to the image
         
         Args:
             bgr_img: Input image in BGR format
-            filter_type: Type of filter to apply
+            filter_type: Type of filter to apply, or a pipeline of filters
+                         separated by '|' (e.g. 'gaussian|canny|dilation')
+            frame_key: Identity of the frame, e.g. (cam_id, instance, seq), used to
+                       share grayscale/binary intermediates between calls
             
         Returns:
             filtered_img: Processed image
             process_time_ms: Processing time in milliseconds
         """
+        filtered_img, process_time_ms, _ = self.apply_pipeline(bgr_img, filter_type, frame_key)
+        return filtered_img, process_time_ms
+    
+    def apply_pipeline(self, bgr_img, spec, frame_key=None, scale=1.0, upsample=True):
+        """
+        Run a compiled filter pipeline on the image
+        
+        Args:
+            bgr_img: Input image in BGR format
+            spec: Filter names separated by '|'; compiled once, then cached
+            frame_key: Identity of the frame, e.g. (cam_id, instance, seq), or None
+            scale: Processing scale (1.0 = native resolution); below 1 the
+                   frame goes through an image pyramid first, for previews
+            upsample: Resize a downscaled result back to the input size
+            
+        Returns:
+            filtered_img: Processed image (3-channel BGR)
+            process_time_ms: Processing time in milliseconds
+            stage_times: List of (stage name, time in ms)
+        """
         
         if bgr_img is None:
             raise ValueError("Input frame is None")
         
         start_time = time.perf_counter()
-        filtered_img = bgr_img.copy()
         
         try:
-            if filter_type == 'none':
-                filtered_img = bgr_img
-            
-            elif filter_type == 'grayscale':
-                processor = GrayscaleProcessor()
-                gray = processor.convert_to_grayscale(bgr_img)
-                # Convert back to 3-channel for display
-                filtered_img = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'gaussian':
-                processor = GaussianProcessor()
-                filtered_img = processor.apply_gaussian_filter(bgr_img, kernel_size=(5, 5), sigma=1.0)
-            
-            elif filter_type == 'median':
-                median = MedianBlur(kernel_size=5)
-                filtered_img = median.apply(bgr_img)
-            
-            elif filter_type == 'sobel':
-                sobel = SobelEdgeDetection()
-                edge_img = sobel.apply(bgr_img)
-                # Convert to 3-channel
-                filtered_img = cv2.cvtColor(edge_img, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'laplacian':
-                laplacian = LaplacianEdgeDetection()
-                edge_img = laplacian.apply(bgr_img)
-                # Convert to 3-channel
-                filtered_img = cv2.cvtColor(edge_img, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'canny':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                edges = cv2.Canny(gray, 100, 200)
-                filtered_img = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'sharpening':
-                sharpening = SharpeningFilter()
-                filtered_img = sharpening.apply(bgr_img)
-            
-            elif filter_type == 'bilateral':
-                bilateral = BilateralFilter(diameter=9, sigma_color=75, sigma_space=75)
-                filtered_img = bilateral.apply(bgr_img)
-            
-            elif filter_type == 'binary_threshold':
-                threshold = BinaryThresholding(threshold_value=127)
-                binary_img = threshold.apply(bgr_img)
-                # Convert to 3-channel
-                filtered_img = cv2.cvtColor(binary_img, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'erosion':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-                erosion = Erosion(kernel_size=5)
-                eroded = erosion.apply(binary)
-                filtered_img = cv2.cvtColor(eroded, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'dilation':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-                dilation = Dilation(kernel_size=5)
-                dilated = dilation.apply(binary)
-                filtered_img = cv2.cvtColor(dilated, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'opening':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-                opened = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
-                filtered_img = cv2.cvtColor(opened, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'closing':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-                closed = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
-                filtered_img = cv2.cvtColor(closed, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'histogram_eq':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                equalized = cv2.equalizeHist(gray)
-                filtered_img = cv2.cvtColor(equalized, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'clahe':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-                enhanced = clahe.apply(gray)
-                filtered_img = cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'adaptive_threshold':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                adaptive = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                                cv2.THRESH_BINARY, 11, 2)
-                filtered_img = cv2.cvtColor(adaptive, cv2.COLOR_GRAY2BGR)
-            
-            elif filter_type == 'contour':
-                gray = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY)
-                _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-                contours, _ = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                filtered_img = bgr_img.copy()
-                cv2.drawContours(filtered_img, contours, -1, (0, 255, 0), 2)
-            
-            else:
-                filtered_img = bgr_img
+            pipeline = get_pipeline(spec, scale)
+            filtered_img, stage_times = pipeline.run(bgr_img, frame_key, self.cache, upsample)
         
         except Exception as e:
-            print(f"Error applying filter {filter_type}: {str(e)}")
-            filtered_img = bgr_img
+            print(f"Error applying filter {spec}: {str(e)}")
+            filtered_img, stage_times = bgr_img, []
         
         process_time_ms = (time.perf_counter() - start_time) * 1000
-        return filtered_img, process_time_ms
+        metrics.record_pipeline(spec, process_time_ms, stage_times)
+        return filtered_img, process_time_ms, stage_times
     
         """
         Visualize all processing results on image
@@ -200,4 +242,53 @@ class ImageProcessor:
             Annotated image
         """
 
-        pass
\ No newline at end of file
+        pass
+
+
+class ProcessorContexts:
+    """
+    One long-lived ImageProcessor per camera
+
+    Filter objects and kernels live in the compiled pipelines (built once
+    per spec and shared by all threads; see register_filter), so a
+    processor is cheap to use but carries per-camera state between calls:
+    the previous frame, tracked objects, calibration. Each camera therefore
+    keeps its own processor for its whole life instead of getting a fresh
+    one per request.
+    """
+
+    def __init__(self, calibrations=None):
+        """
+        Args:
+            calibrations: CalibrationStore the processors are kept in sync
+                          with (default: the store under CV_CALIBRATION_DIR)
+        """
+        self.calibrations = calibration_store if calibrations is None else calibrations
+        self.lock = threading.Lock()
+        self.contexts = {}
+
+    def get(self, cam_id):
+        """
+        Processor of a camera, created on first use
+
+        Returns:
+            (processor, lock): hold lock while calling stateful methods
+            such as process_frame; apply_pipeline only reads the processor,
+            and compiled stages are thread safe, so it may run concurrently
+        """
+        with self.lock:
+            ctx = self.contexts.get(cam_id)
+            if ctx is None:
+                ctx = self.contexts[cam_id] = (ImageProcessor(), threading.Lock())
+        # loaded on first use, reloaded whenever the camera's file changes
+        self.calibrations.sync(cam_id, ctx[0])
+        return ctx
+
+    def discard(self, cam_id):
+        # forget a camera's state, e.g. when the camera is removed
+        with self.lock:
+            self.contexts.pop(cam_id, None)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.contexts)
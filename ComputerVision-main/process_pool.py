@@ -0,0 +1,293 @@
+import atexit
+import multiprocessing as mp
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from process import ProcessorContexts, image_writer
+from motion import SKIPPED
+import metrics
+
+
+PROCESSING_MODES = ('thread', 'pool')
+
+# 4K BGR; larger frames grow the worker's buffers on demand
+DEFAULT_BUFFER_BYTES = 3840 * 2160 * 3
+
+
+def _worker_main(conn):
+    """
+    Worker process loop
+
+    Holds one warm ImageProcessor per camera for its whole life, so camera
+    state (previous frame, tracked objects) survives between requests as
+    in thread mode. Frames arrive in a
+    shared memory block owned by the parent and results are written back
+    into a second block, so only the small request/reply tuples go through
+    the pipe.
+    """
+    processors = ProcessorContexts()
+    blocks = {}
+
+    def attach(name, current):
+        if name not in blocks:
+            # the parent replaced its blocks (larger frames): unmap the old ones
+            for stale in [n for n in blocks if n not in current]:
+                try:
+                    blocks.pop(stale).close()
+                except BufferError:
+                    pass  # still viewed by a cached array; unmapped when that goes
+            blocks[name] = shared_memory.SharedMemory(name=name)
+        return blocks[name]
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        op, cam_id, in_name, shape, dtype, out_name, args = msg
+        if op == 'discard':
+            # the camera was removed: a camera added later under the same id
+            # must not inherit its tracks, motion background or reuse gate
+            processors.discard(cam_id)
+            conn.send(('ok', None, None, None, None))
+            continue
+        try:
+            # requests are handled one at a time, so the processor lock is not needed
+            processor, _ = processors.get(cam_id)
+            frame = np.ndarray(shape, dtype=dtype, buffer=attach(in_name, (in_name, out_name)).buf)
+            frame.flags.writeable = False
+            if op == 'apply_pipeline':
+                out, process_time_ms, stage_times = processor.apply_pipeline(frame, *args)
+                meta = (process_time_ms, stage_times)
+            elif op == 'process_frame':
+                # process_frame queues the frame on the background image
+                # writer, and the parent overwrites the block with the next
+                # request: hand it a private copy
+                out, results, process_time_ms = processor.process_frame(frame.copy())
+                # the parent's writer is idle in pool mode: report this one
+                meta = (results, process_time_ms, image_writer.get_stats())
+            else:
+                raise ValueError(f"unknown operation '{op}'")
+            out = np.ascontiguousarray(out)
+            out_block = attach(out_name, (in_name, out_name))
+            if out.nbytes <= out_block.size:
+                np.ndarray(out.shape, dtype=out.dtype, buffer=out_block.buf)[...] = out
+                conn.send(('ok', out.shape, out.dtype.str, None, meta))
+            else:
+                # does not fit: fall back to pickling this one result
+                conn.send(('ok', out.shape, out.dtype.str, out, meta))
+        except Exception as e:
+            conn.send(('error', None, None, None, f"{type(e).__name__}: {e}"))
+        # drop views of the blocks, so they can be unmapped when replaced
+        frame = out = None
+    for block in blocks.values():
+        block.close()
+
+
+class _Worker:
+    """Parent-side handle: process, pipe, and the two shared memory blocks"""
+
+    def __init__(self, ctx, buffer_bytes):
+        self.ctx = ctx
+        self.lock = threading.Lock()   # one request in flight per worker
+        self.process = None
+        self.conn = None
+        self.in_block = None
+        self.out_block = None
+        self.buffer_bytes = buffer_bytes
+        self.requests = 0
+        self.busy_time = 0.0
+        self.writer_stats = None   # worker's image writer, as of its last process_frame
+
+    def _ensure(self, nbytes):
+        # (re)start the process and size the buffers; called with self.lock held
+        if nbytes > self.buffer_bytes or self.in_block is None:
+            self._free_blocks()
+            self.buffer_bytes = max(self.buffer_bytes, nbytes)
+            self.in_block = shared_memory.SharedMemory(create=True, size=self.buffer_bytes)
+            self.out_block = shared_memory.SharedMemory(create=True, size=self.buffer_bytes)
+        if self.process is None or not self.process.is_alive():
+            parent_conn, child_conn = self.ctx.Pipe()
+            self.process = self.ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+            self.process.start()
+            child_conn.close()
+            self.conn = parent_conn
+
+    def run(self, op, cam_id, frame, args):
+        with self.lock:
+            start = time.perf_counter()
+            self._ensure(frame.nbytes)
+            np.ndarray(frame.shape, dtype=frame.dtype, buffer=self.in_block.buf)[...] = frame
+            try:
+                self.conn.send((op, cam_id, self.in_block.name, frame.shape, frame.dtype.str, self.out_block.name, args))
+                status, shape, dtype, pickled, meta = self.conn.recv()
+            except (EOFError, OSError, BrokenPipeError):
+                # worker died; it is restarted on the next request
+                self.process = None
+                raise RuntimeError("processing worker died")
+            if status != 'ok':
+                raise RuntimeError(meta)
+            if pickled is not None:
+                out = pickled
+            else:
+                # copy out: the block is reused by the next request
+                out = np.ndarray(shape, dtype=dtype, buffer=self.out_block.buf).copy()
+            self.requests += 1
+            self.busy_time += time.perf_counter() - start
+            return out, meta
+
+    def discard(self, cam_id):
+        # drop the worker's processor for a camera; a stopped worker has none
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                return
+            try:
+                self.conn.send(('discard', cam_id, None, None, None, None, ()))
+                self.conn.recv()
+            except (EOFError, OSError, BrokenPipeError):
+                self.process = None
+
+    def _free_blocks(self):
+        for block in (self.in_block, self.out_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.in_block = self.out_block = None
+
+    def close(self):
+        with self.lock:
+            if self.process is not None and self.process.is_alive():
+                try:
+                    self.conn.send(None)
+                except (OSError, BrokenPipeError):
+                    pass
+                self.process.join(timeout=2)
+                if self.process.is_alive():
+                    self.process.terminate()
+            self.process = None
+            self._free_blocks()
+
+
+class SharedMemoryProcessPool:
+    """
+    Pool of worker processes for CPU-bound processing
+
+    Each camera is pinned to one worker (cam_id modulo the pool size), so
+    per-camera state and the worker's intermediate cache stay warm, while
+    different cameras run in parallel without sharing the GIL.
+    """
+
+    def __init__(self, workers=None, buffer_bytes=DEFAULT_BUFFER_BYTES):
+        """
+        Args:
+            workers: Number of worker processes (default: CPU count, max 4)
+            buffer_bytes: Initial size of each worker's in/out frame buffers
+        """
+        # spawn: forking a threaded server (camera readers, Flask) is unsafe
+        ctx = mp.get_context('spawn')
+        n = workers or min(4, mp.cpu_count())
+        self.workers = [_Worker(ctx, buffer_bytes) for _ in range(n)]
+
+    def _worker_for(self, cam_id):
+        return self.workers[hash(cam_id) % len(self.workers)]
+
+    def apply_pipeline(self, cam_id, frame, spec, frame_key=None, scale=1.0, upsample=True):
+        out, (process_time_ms, stage_times) = self._worker_for(cam_id).run(
+            'apply_pipeline', cam_id, frame, (spec, frame_key, scale, upsample))
+        return out, process_time_ms, stage_times
+
+    def process_frame(self, cam_id, frame):
+        worker = self._worker_for(cam_id)
+        out, (results, process_time_ms, worker.writer_stats) = worker.run('process_frame', cam_id, frame, ())
+        return out, results, process_time_ms
+
+    def discard(self, cam_id):
+        self._worker_for(cam_id).discard(cam_id)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def get_stats(self):
+        return [{
+            'worker': i,
+            'alive': worker.process is not None and worker.process.is_alive(),
+            'requests': worker.requests,
+            'busy_s': round(worker.busy_time, 3),
+            'buffer_bytes': worker.buffer_bytes,
+            'image_writer': worker.writer_stats,
+        } for i, worker in enumerate(self.workers)]
+
+
+class ProcessingExecutor:
+    """
+    Runs ImageProcessor work either in the calling thread or in the pool
+
+    mode 'thread' runs on one long-lived ImageProcessor per camera in the
+    calling thread; mode 'pool' sends frames to a SharedMemoryProcessPool,
+    started on first use (never at import time, because spawned workers
+    re-import the main module), whose workers keep the per-camera
+    processors instead.
+    """
+
+    def __init__(self, mode='thread', workers=None):
+        if mode not in PROCESSING_MODES:
+            raise ValueError(f"unknown processing mode '{mode}'")
+        self.mode = mode
+        self.workers = workers
+        self.pool = None
+        self.processors = ProcessorContexts()
+        self.lock = threading.Lock()
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = SharedMemoryProcessPool(self.workers)
+                atexit.register(self.pool.close)
+            return self.pool
+
+    def apply_pipeline(self, cam_id, frame, spec, frame_key=None, scale=1.0, upsample=True):
+        if self.mode == 'pool':
+            # the worker's own metrics stay in the worker; record them here
+            out, process_time_ms, stage_times = self._get_pool().apply_pipeline(
+                cam_id, frame, spec, frame_key, scale, upsample)
+            metrics.record_pipeline(spec, process_time_ms, stage_times)
+            return out, process_time_ms, stage_times
+        processor, _ = self.processors.get(cam_id)
+        return processor.apply_pipeline(frame, spec, frame_key, scale, upsample)
+
+    def process_frame(self, cam_id, frame):
+        if self.mode == 'pool':
+            out, results, process_time_ms = self._get_pool().process_frame(cam_id, frame)
+            if results.get('motion', {}).get('reused'):
+                SKIPPED.inc('process_frame')
+            else:
+                metrics.PROCESS_FRAME_SECONDS.observe(process_time_ms / 1000)
+            return out, results, process_time_ms
+        processor, lock = self.processors.get(cam_id)
+        with lock:
+            return processor.process_frame(frame)
+
+    def discard(self, cam_id):
+        """
+        Forget a camera's processing state, e.g. when the camera is removed
+
+        Clears the processor kept here and, in pool mode, the one kept by
+        the camera's worker, so a camera added later under the same id
+        starts from scratch.
+        """
+        self.processors.discard(cam_id)
+        with self.lock:
+            pool = self.pool
+        if pool is not None:
+            pool.discard(cam_id)
+
+    def get_stats(self):
+        return {
+            'mode': self.mode,
+            'processors': len(self.processors),
+            'workers': [] if self.pool is None else self.pool.get_stats(),
+        }
@@ -0,0 +1,453 @@
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs
+import numpy as np
+
+# ring files written by POST /record/<cam_id>
+RECORDING_DIR = os.environ.get('CV_RECORDING_DIR', 'recordings')
+# replay:///path/to/file.ring[?speed=original|max|<factor>&loop=1]
+REPLAY_SCHEME = 'replay://'
+
+MAGIC = b'CVRING01'
+# magic, version, width, height, channels, capacity, slot bytes, data offset,
+# frames written (ever; the newest is slot (count - 1) % capacity), created
+HEADER = struct.Struct('<8sIIIIIQQQd')
+COUNT_OFFSET = struct.calcsize('<8sIIIIIQQ')
+HEADER_SIZE = 4096
+# per slot: frame number (0-based, over the whole recording) and wall clock time
+INDEX_ENTRY = struct.Struct('<Qd')
+PAGE = mmap.ALLOCATIONGRANULARITY
+
+
+def _align(n):
+    return (n + PAGE - 1) // PAGE * PAGE
+
+
+class RingFileWriter:
+    """
+    Fixed-size ring of raw frames in a memory-mapped file
+
+    Layout: a 4 KB header, an index of (frame number, timestamp) per slot,
+    then page-aligned slots of width * height * channels bytes. Frames are
+    copied straight into the mapping; the header's frame count is updated
+    last, so a reader (or a crash) never sees a half-written frame as
+    valid. Once capacity frames are stored the oldest slot is overwritten.
+
+    The file is built under a temporary name and renamed into place, so a
+    replay still mapping an older file of the same name keeps its own copy
+    instead of seeing it truncated (which would crash it with SIGBUS).
+    """
+
+    def __init__(self, path, width, height, channels=3, capacity=300, overwrite=False):
+        """
+        Args:
+            path: File to create
+            width, height, channels: Frame geometry (uint8 pixels)
+            capacity: Number of frames kept
+            overwrite: Replace path if it exists
+
+        Raises:
+            FileExistsError: if path exists and overwrite is False
+        """
+        if channels not in (1, 3):
+            raise ValueError("channels must be 1 or 3")
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if not overwrite and os.path.exists(path):
+            raise FileExistsError(f"{path} already exists")
+        self.path = path
+        self.shape = (height, width, channels) if channels == 3 else (height, width)
+        self.capacity = capacity
+        self.slot_size = _align(width * height * channels)
+        self.frame_bytes = width * height * channels
+        self.data_offset = _align(HEADER_SIZE + capacity * INDEX_ENTRY.size)
+        self.count = 0
+        self.lock = threading.Lock()
+        size = self.data_offset + capacity * self.slot_size
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                f.truncate(size)  # sparse on most file systems until written
+                self.mm = mmap.mmap(f.fileno(), size)
+            HEADER.pack_into(self.mm, 0, MAGIC, 1, width, height, channels, capacity,
+                             self.slot_size, self.data_offset, 0, time.time())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def append(self, frame, timestamp=None):
+        """
+        Store one frame
+
+        Args:
+            frame: uint8 array of the file's shape
+            timestamp: Wall clock time of the frame (default: now)
+
+        Raises:
+            ValueError: if the frame does not match the file's geometry
+        """
+        if frame.shape != self.shape or frame.dtype != np.uint8:
+            raise ValueError(f"frame {frame.shape} {frame.dtype} does not match recording {self.shape} uint8")
+        with self.lock:
+            slot = self.count % self.capacity
+            offset = self.data_offset + slot * self.slot_size
+            np.ndarray(self.shape, np.uint8, self.mm, offset)[...] = frame
+            INDEX_ENTRY.pack_into(self.mm, HEADER_SIZE + slot * INDEX_ENTRY.size,
+                                  self.count, time.time() if timestamp is None else timestamp)
+            self.count += 1
+            # commit: readers only trust slots below the stored count
+            struct.pack_into('<Q', self.mm, COUNT_OFFSET, self.count)
+
+    def close(self):
+        with self.lock:
+            if self.mm is not None:
+                self.mm.flush()
+                self.mm.close()
+                self.mm = None
+
+
+class RingFileReader:
+    """Read-only view of a ring file; frames are zero-copy views into the mapping"""
+
+    def __init__(self, path):
+        """
+        Raises:
+            ValueError: if path is not a ring file
+        """
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            self.mm.close()
+            raise ValueError(f"{path} is not a frame recording")
+        (magic, version, width, height, channels, self.capacity,
+         self.slot_size, self.data_offset, _, self.created) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != 1:
+            self.mm.close()
+            raise ValueError(f"{path} is not a frame recording")
+        self.width, self.height, self.channels = width, height, channels
+        self.shape = (height, width, channels) if channels == 3 else (height, width)
+
+    def count(self):
+        # frames written so far (re-read, the file may still be recording)
+        return struct.unpack_from('<Q', self.mm, COUNT_OFFSET)[0]
+
+    def available(self):
+        """
+        Frame numbers still in the ring, oldest first
+
+        Returns:
+            range of frame numbers
+        """
+        count = self.count()
+        return range(max(0, count - self.capacity), count)
+
+    def frame(self, number):
+        """
+        Frame by number (see available)
+
+        Returns:
+            (timestamp, frame): frame is a read-only view into the file
+        """
+        slot = number % self.capacity
+        stored, timestamp = INDEX_ENTRY.unpack_from(self.mm, HEADER_SIZE + slot * INDEX_ENTRY.size)
+        if stored != number:
+            raise IndexError(f"frame {number} has been overwritten")
+        frame = np.ndarray(self.shape, np.uint8, self.mm, self.data_offset + slot * self.slot_size)
+        return timestamp, frame
+
+    def close(self):
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # consumers still hold frames: the mapping goes with the last one
+                pass
+            self.mm = None
+
+
+class ReplayCapture:
+    """
+    cv2.VideoCapture stand-in that plays a ring file
+
+    VideoCamera opens one for 'replay://' sources. Frames are handed out
+    as read-only views of the mapped file (zero_copy), so replay costs no
+    decoding and no copying. speed 'original' keeps the recorded frame
+    spacing, 'max' plays as fast as frames are taken, and a number scales
+    the original speed; loop restarts at the oldest frame instead of
+    ending. Replay a finished recording: a file still being recorded into
+    can overwrite a frame while a consumer holds it.
+    """
+
+    zero_copy = True
+
+    def __init__(self, path, speed='original', loop=False, stop_event=None):
+        """
+        Args:
+            path: Ring file to play
+            speed: 'original', 'max' or a factor of the original speed
+            loop: Restart at the oldest frame instead of ending
+            stop_event: threading.Event that interrupts the wait for the
+                        next frame's time (e.g. the camera's); without one,
+                        release() interrupts it
+        """
+        self.own_event = stop_event is None
+        self.stop_event = threading.Event() if stop_event is None else stop_event
+        self.reader = RingFileReader(path)
+        if speed == 'max':
+            self.speed = None
+        elif speed == 'original':
+            self.speed = 1.0
+        else:
+            self.speed = float(speed)
+            if self.speed <= 0:
+                raise ValueError("speed must be positive")
+        self.loop = loop
+        self.frames = self.reader.available()
+        self.pos = 0              # index into self.frames of the next grab
+        self.current = None       # frame number of the last grab
+        self.start_wall = None    # (monotonic time, recorded time) of the first frame played
+
+    @classmethod
+    def from_source(cls, source, stop_event=None):
+        # 'replay:///data/cam1.ring?speed=max&loop=1'
+        path, _, query = source[len(REPLAY_SCHEME):].partition('?')
+        args = {k: v[-1] for k, v in parse_qs(query).items()}
+        return cls(path, args.get('speed', 'original'), args.get('loop', '0') not in ('0', 'false', ''),
+                   stop_event)
+
+    def isOpened(self):
+        return self.reader.mm is not None and len(self.frames) > 0
+
+    def grab(self):
+        if self.pos >= len(self.frames):
+            if not self.loop or not len(self.frames):
+                return False
+            self.pos = 0
+            self.start_wall = None
+        number = self.frames[self.pos]
+        try:
+            timestamp, _ = self.reader.frame(number)
+        except IndexError:
+            # overwritten by a recorder still writing: skip ahead
+            self.frames = self.reader.available()
+            self.pos = 0
+            return self.grab() if len(self.frames) else False
+        if self.speed is not None:
+            now = time.monotonic()
+            if self.start_wall is None:
+                self.start_wall = (now, timestamp)
+            due = self.start_wall[0] + (timestamp - self.start_wall[1]) / self.speed
+            if due > now and self.stop_event.wait(due - now):
+                # stopped while waiting for the frame's time
+                return False
+        self.current = number
+        self.pos += 1
+        return True
+
+    def retrieve(self, image=None):
+        # image is accepted for compatibility but never written: zero copy
+        if self.current is None:
+            return False, None
+        try:
+            return True, self.reader.frame(self.current)[1]
+        except IndexError:
+            return False, None
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop):
+        import cv2
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            # looping replays never end, like a live source
+            return 0.0 if self.loop else float(len(self.frames))
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.pos)
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.reader.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.reader.height)
+        return 0.0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        if self.own_event:
+            self.stop_event.set()
+        self.reader.close()
+
+
+class CameraRecorder:
+    """
+    Records every frame a VideoCamera publishes into a ring file
+
+    The file is created on the first frame, with that frame's geometry;
+    frames of another size (the source changed resolution) are counted
+    and skipped. While recording the camera decodes every frame, as for
+    any waiting consumer.
+    """
+
+    def __init__(self, cam, path, capacity=300, overwrite=False):
+        """
+        Args:
+            cam: VideoCamera to record
+            path: Ring file to create
+            capacity: Frames kept (the oldest are overwritten)
+            overwrite: Replace an existing file at path (else the recording
+                       fails with a FileExistsError in error)
+        """
+        self.cam = cam
+        self.path = path
+        self.capacity = capacity
+        self.overwrite = overwrite
+        self.writer = None
+        self.recorded = 0
+        self.skipped = 0
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        seq = -1
+        try:
+            while not self.stop_event.is_set():
+                new_seq, frame = self.cam.wait_for_frame(seq, timeout=0.5)
+                if frame is None:
+                    continue
+                seq = new_seq
+                # woken as the frame is published, so now is its arrival time
+                stamp = time.time()
+                if self.writer is None:
+                    h, w = frame.shape[:2]
+                    channels = 1 if frame.ndim == 2 else frame.shape[2]
+                    self.writer = RingFileWriter(self.path, w, h, channels, self.capacity, self.overwrite)
+                try:
+                    self.writer.append(frame, stamp)
+                    self.recorded += 1
+                except ValueError:
+                    self.skipped += 1
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=2.0)
+
+    def get_stats(self):
+        return {
+            'path': self.path,
+            'capacity': self.capacity,
+            'recorded': self.recorded,
+            'skipped': self.skipped,
+            'bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            'running': self.thread.is_alive(),
+            'error': self.error,
+        }
+
+
+def record_video(source, path, capacity=None, overwrite=False):
+    """
+    Convert a video file into a ring file, keeping its frame timing
+
+    Decodes the video once, so later replays (and load tests) cost no
+    decoding at all.
+
+    Args:
+        source: Video file or URL readable by cv2.VideoCapture
+        path: Ring file to create
+        capacity: Frames kept (None: the whole video; longer videos keep
+                  their last capacity frames)
+        overwrite: Replace an existing file at path
+
+    Returns:
+        Number of frames written
+
+    Raises:
+        ValueError: if the source cannot be opened or has no frames
+        FileExistsError: if path exists and overwrite is False
+    """
+    import cv2
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise ValueError(f"could not open {source}")
+    writer = None
+    written = 0
+    try:
+        if capacity is None:
+            capacity = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 300
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        start = time.time()
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if writer is None:
+                h, w = frame.shape[:2]
+                writer = RingFileWriter(path, w, h, 1 if frame.ndim == 2 else frame.shape[2], capacity, overwrite)
+            # container timestamps when the backend has them, else the nominal rate
+            msec = cap.get(cv2.CAP_PROP_POS_MSEC)
+            offset = msec / 1000 if msec > 0 else written / fps
+            writer.append(frame, start + offset)
+            written += 1
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.close()
+    if not written:
+        raise ValueError(f"no frames in {source}")
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record raw frames into a ring file for replay://")
+    parser.add_argument('source', help='video file, URL or device index')
+    parser.add_argument('output', help='ring file to create')
+    parser.add_argument('--capacity', type=int, help='frames kept (default: whole file, or 300 when live)')
+    parser.add_argument('--seconds', type=float,
+                        help='record a live source through VideoCamera for this long instead of converting a file')
+    parser.add_argument('--overwrite', action='store_true', help='replace an existing output file')
+    args = parser.parse_args(argv)
+    source = int(args.source) if args.source.isdigit() else args.source
+    if not args.overwrite and os.path.exists(args.output):
+        parser.error(f"{args.output} exists (use --overwrite to replace it)")
+
+    if args.seconds is None:
+        try:
+            n = record_video(source, args.output, args.capacity, args.overwrite)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        from camera import VideoCamera
+        cam = VideoCamera(name='recording')
+        cam.start(source)
+        recorder = CameraRecorder(cam, args.output, args.capacity or 300, args.overwrite).start()
+        time.sleep(args.seconds)
+        recorder.stop()
+        cam.stop()
+        if recorder.error:
+            print(recorder.error)
+            return 1
+        n = recorder.recorded
+    print(f"recorded {n} frames to {args.output}; play with {REPLAY_SCHEME}{os.path.abspath(args.output)}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,200 @@
+import threading
+import time
+from contextlib import contextmanager
+from camera import VideoCamera
+
+
+class _Entry:
+    def __init__(self, cam):
+        self.cam = cam
+        self.lock = threading.Lock()   # serializes start/stop of cam
+        self.consumers = 0             # guarded by the registry lock
+        self.last_used = time.monotonic()
+
+
+class CameraRegistry:
+    """
+    Configured cameras, decoding only while somebody uses them
+
+    A camera added with a source does not start reading until its first
+    consumer (a viewer, a processed stream or a capture/filter request)
+    acquires it. Once it has had no consumers for idle_timeout seconds a
+    background reaper stops it again; the source stays configured, so the
+    next consumer restarts it. This lets one server hold many cameras
+    while only paying for the ones being watched.
+    """
+
+    def __init__(self, idle_timeout=30.0, max_fps=None, decode_fps=None, start_wait=2.0, reap_interval=1.0):
+        """
+        Args:
+            idle_timeout: Seconds without consumers before a camera is stopped
+                          (None never stops idle cameras)
+            max_fps: Default read rate cap for cameras added without one
+            decode_fps: Grab-only decode rate for frames nobody waits for
+                        (see VideoCamera; None decodes every frame)
+            start_wait: Seconds acquire(wait=True) waits for the first frame
+                        of a camera it had to start
+            reap_interval: Seconds between idle checks
+        """
+        self.idle_timeout = idle_timeout
+        self.max_fps = max_fps
+        self.decode_fps = decode_fps
+        self.start_wait = start_wait
+        self.reap_interval = reap_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.reaper = None
+
+    # --- configuration ---
+
+    def add(self, cam_id, source=None, max_fps=None):
+        """
+        Register a camera (not started until it is used)
+
+        Raises:
+            ValueError: if cam_id is already registered
+        """
+        cam = VideoCamera(name=str(cam_id), max_fps=max_fps or self.max_fps, decode_fps=self.decode_fps)
+        cam.source = source or None
+        with self.lock:
+            if cam_id in self.entries:
+                raise ValueError(f"camera {cam_id} already exists")
+            self.entries[cam_id] = _Entry(cam)
+            if self.reaper is None and self.idle_timeout is not None:
+                self.reaper = threading.Thread(target=self._reap, daemon=True)
+                self.reaper.start()
+        return cam
+
+    def remove(self, cam_id):
+        """
+        Stop and forget a camera
+
+        Raises:
+            KeyError: if cam_id is not registered
+        """
+        with self.lock:
+            entry = self.entries.pop(cam_id)
+        with entry.lock:
+            entry.cam.stop()
+
+    def set_source(self, cam_id, source, max_fps=None):
+        """
+        Point a camera at a new source and start it; an empty source stops it
+
+        The camera is started right away (the caller usually wants to see
+        it), but is reaped like any other if nobody consumes it.
+
+        Raises:
+            KeyError: if cam_id is not registered
+        """
+        with self.lock:
+            entry = self.entries[cam_id]
+            entry.last_used = time.monotonic()
+        with entry.lock:
+            if max_fps is not None:
+                entry.cam.max_fps = max_fps or None
+            if not source:
+                entry.cam.stop()
+                entry.cam.source = None
+            else:
+                entry.cam.start(source)
+
+    # --- lookup (dict-like) ---
+
+    def get(self, cam_id):
+        with self.lock:
+            entry = self.entries.get(cam_id)
+        return entry.cam if entry is not None else None
+
+    def __contains__(self, cam_id):
+        with self.lock:
+            return cam_id in self.entries
+
+    def __getitem__(self, cam_id):
+        cam = self.get(cam_id)
+        if cam is None:
+            raise KeyError(cam_id)
+        return cam
+
+    def items(self):
+        # snapshot of (cam_id, VideoCamera)
+        with self.lock:
+            return [(cam_id, entry.cam) for cam_id, entry in self.entries.items()]
+
+    def ids(self):
+        with self.lock:
+            return list(self.entries)
+
+    # --- consumers ---
+
+    def acquire(self, cam_id, wait=False):
+        """
+        Register a consumer, starting the camera if it is configured but idle
+
+        Args:
+            cam_id: Camera to use
+            wait: Block up to start_wait seconds for the first frame (for
+                  one-shot requests that need a frame right away)
+
+        Returns:
+            VideoCamera, or None if cam_id is not registered
+        """
+        with self.lock:
+            entry = self.entries.get(cam_id)
+            if entry is None:
+                return None
+            entry.consumers += 1
+            entry.last_used = time.monotonic()
+        cam = entry.cam
+        with entry.lock:
+            if not cam.running and cam.source:
+                cam.start(cam.source)
+        if wait:
+            seq, frame = cam.get_frame_seq()
+            deadline = time.monotonic() + self.start_wait
+            while frame is None and cam.running and time.monotonic() < deadline:
+                seq, frame = cam.wait_for_frame(seq, deadline - time.monotonic())
+        return cam
+
+    def release(self, cam_id):
+        with self.lock:
+            entry = self.entries.get(cam_id)
+            if entry is not None:
+                entry.consumers = max(0, entry.consumers - 1)
+                entry.last_used = time.monotonic()
+
+    @contextmanager
+    def use(self, cam_id, wait=True):
+        # with registry.use(cam_id) as cam: ... (cam is None if unknown)
+        cam = self.acquire(cam_id, wait)
+        try:
+            yield cam
+        finally:
+            if cam is not None:
+                self.release(cam_id)
+
+    def _reap(self):
+        while True:
+            time.sleep(self.reap_interval)
+            now = time.monotonic()
+            with self.lock:
+                idle = [entry for entry in self.entries.values()
+                        if entry.consumers == 0 and entry.cam.running
+                        and now - entry.last_used >= self.idle_timeout]
+            for entry in idle:
+                with entry.lock:
+                    # a consumer may have arrived since the check above
+                    if entry.consumers == 0 and time.monotonic() - entry.last_used >= self.idle_timeout:
+                        entry.cam.stop()
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            entries = list(self.entries.items())
+        stats = {}
+        for cam_id, entry in entries:
+            s = entry.cam.get_stats()
+            s['consumers'] = entry.consumers
+            s['idle_s'] = 0.0 if entry.consumers else round(now - entry.last_used, 1)
+            stats[cam_id] = s
+        return stats
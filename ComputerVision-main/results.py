@@ -0,0 +1,46 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+
+class ResultStore:
+    """
+    Bounded in-memory store of encoded result images
+
+    /capture and /apply_filter put their JPEGs here and hand out the id, so
+    the browser can load them with a plain <img src="/result/<id>"> instead
+    of decoding base64 out of JSON. Results never change once stored, so
+    the id doubles as the ETag.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=256):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, data, mimetype='image/jpeg'):
+        """
+        Store encoded image bytes
+
+        Returns:
+            str: Result id
+        """
+        result_id = uuid.uuid4().hex
+        with self.lock:
+            self.entries[result_id] = (data, mimetype)
+            self.nbytes += len(data)
+            while self.entries and (self.nbytes > self.max_bytes or len(self.entries) > self.max_entries):
+                _, (old, _) = self.entries.popitem(last=False)
+                self.nbytes -= len(old)
+        return result_id
+
+    def get(self, result_id):
+        # (bytes, mimetype), or None if unknown or evicted
+        with self.lock:
+            return self.entries.get(result_id)
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.nbytes}
@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import numpy as np
+
+
+class NoFrameError(RuntimeError):
+    """The camera has no frame to process"""
+
+
+class SchedulerClosedError(NoFrameError):
+    """The scheduler was closed, e.g. because its camera was removed"""
+
+
+def _nbytes(result):
+    # approximate memory held by a result: its arrays and byte strings
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, (tuple, list)):
+        return sum(_nbytes(item) for item in result)
+    return 0
+
+
+class _Job:
+    def __init__(self, op_key, fn):
+        self.op_key = op_key
+        self.fn = fn
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.waiters = 1
+        self.seq = None           # frame the job runs on, set when it starts
+
+
+class FrameScheduler:
+    """
+    Latest-frame-wins scheduler between one VideoCamera and the processor
+
+    Requests are queued per operation key (e.g. ('filter', 'canny')) and run
+    one at a time on a worker thread. A job takes the camera's newest frame
+    when it starts, not when it was requested, so a slow processor never
+    works through a backlog of stale frames. Requests for an operation that
+    is already queued, or running on the newest frame, join that job instead
+    of running it again.
+    """
+
+    def __init__(self, cam, max_last=32, max_last_bytes=64 * 1024 * 1024):
+        """
+        Args:
+            cam: VideoCamera to take frames from
+            max_last: Most results kept for reuse on the same frame
+            max_last_bytes: Upper bound on the memory those results hold
+        """
+        self.cam = cam
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        self.queue = deque()
+        self.pending = {}         # op_key -> queued _Job
+        self.running = None       # _Job being processed
+        self.last = OrderedDict() # op_key -> (seq, result, nbytes) of the last run
+        self.last_bytes = 0
+        self.max_last = max_last
+        self.max_last_bytes = max_last_bytes
+        self.thread = None
+        self.closed = False
+
+        self.requests = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.dropped_frames = 0   # frames no job ever ran on
+        self.last_seq = None
+        self.queue_wait_ms = 0.0
+        self.max_queue_wait_ms = 0.0
+        self.process_ms = 0.0
+        self.lag_ms = 0.0         # frame arrival -> result ready
+
+    def submit(self, op_key, fn, timeout=None):
+        """
+        Run fn on the newest frame, sharing the work with identical requests
+
+        Args:
+            op_key: Hashable description of the operation and its parameters
+            fn: Callable fn(seq, frame) -> result
+            timeout: Seconds to wait for the result (None waits forever)
+
+        Returns:
+            (seq, result): frame sequence number the result belongs to
+
+        Raises:
+            NoFrameError: if the camera has no frame
+            SchedulerClosedError: if the scheduler is (or gets) closed
+                before the job runs
+        """
+        with self.lock:
+            if self.closed:
+                raise SchedulerClosedError("camera removed")
+            self.requests += 1
+            job = self.pending.get(op_key)
+            running = self.running
+            if job is None and running is not None and running.op_key == op_key \
+                    and running.seq == self.cam.seq:
+                job = running
+            if job is not None:
+                job.waiters += 1
+                self.coalesced += 1
+            else:
+                job = _Job(op_key, fn)
+                self.pending[op_key] = job
+                self.queue.append(job)
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._worker, daemon=True)
+                    self.thread.start()
+                self.work.notify()
+        return job.future.result(timeout)
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                self.work.wait_for(lambda: self.queue or self.closed)
+                if not self.queue:
+                    return
+                job = self.queue.popleft()
+                del self.pending[job.op_key]
+                self.running = job
+            start = time.monotonic()
+            seq, frame, frame_time = self.cam.get_frame_timed()
+            job.seq = seq
+            try:
+                if frame is None:
+                    raise NoFrameError("no frame yet")
+                last = self.last.get(job.op_key)
+                if last is not None and last[0] == seq:
+                    # same frame and operation as the previous run (joined
+                    # waiters were already counted in submit)
+                    result = last[1]
+                    with self.lock:
+                        self.coalesced += 1
+                else:
+                    result = job.fn(seq, frame)
+                    self._remember(job.op_key, seq, result)
+                    self._account(job, seq, start, frame_time)
+                job.future.set_result((seq, result))
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.running = None
+
+    def _remember(self, op_key, seq, result):
+        # keep the result for requests on the same frame, within the bounds
+        nbytes = _nbytes(result)
+        old = self.last.pop(op_key, None)
+        if old is not None:
+            self.last_bytes -= old[2]
+        if nbytes > self.max_last_bytes:
+            return
+        self.last[op_key] = (seq, result, nbytes)
+        self.last_bytes += nbytes
+        while len(self.last) > self.max_last or self.last_bytes > self.max_last_bytes:
+            self.last_bytes -= self.last.popitem(last=False)[1][2]
+
+    def close(self):
+        # fail queued jobs and let the worker exit (e.g. camera removed);
+        # a job already running still delivers its result
+        with self.lock:
+            self.closed = True
+            queued = list(self.queue)
+            self.queue.clear()
+            self.pending.clear()
+            self.work.notify_all()
+        for job in queued:
+            job.future.set_exception(SchedulerClosedError("camera removed"))
+
+    def _account(self, job, seq, start, frame_time):
+        now = time.monotonic()
+        with self.lock:
+            self.processed += 1
+            if self.last_seq is not None and seq > self.last_seq + 1:
+                self.dropped_frames += seq - self.last_seq - 1
+            if self.last_seq is None or seq > self.last_seq:
+                self.last_seq = seq
+            wait_ms = (start - job.submitted) * 1000
+            self.max_queue_wait_ms = max(self.max_queue_wait_ms, wait_ms)
+            self.queue_wait_ms = _ema(self.queue_wait_ms, wait_ms)
+            self.process_ms = _ema(self.process_ms, (now - start) * 1000)
+            if frame_time is not None:
+                self.lag_ms = _ema(self.lag_ms, (now - frame_time) * 1000)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'processed': self.processed,
+                'dropped_frames': self.dropped_frames,
+                'queue_depth': len(self.queue),
+                'cached_bytes': self.last_bytes,
+                'queue_wait_ms': round(self.queue_wait_ms, 2),
+                'max_queue_wait_ms': round(self.max_queue_wait_ms, 2),
+                'process_ms': round(self.process_ms, 2),
+                'lag_ms': round(self.lag_ms, 2),
+            }
+
+
+def _ema(avg, value):
+    return 0.9 * avg + 0.1 * value if avg else value
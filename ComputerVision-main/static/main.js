@@ -42,7 +42,8 @@ async function capture(cam_id){
     const res = await fetch('/capture', {
       method: 'POST',
       headers: {'Content-Type':'application/json'},
-      body: JSON.stringify({cam_id: cam_id})
+      // 'url': images come back as /result/<id> links instead of base64
+      body: JSON.stringify({cam_id: cam_id, response: 'url'})
     });
     const j = await res.json();
     if(!j.ok){
@@ -131,6 +132,7 @@ document.addEventListener('DOMContentLoaded', () => {
 async function applyFilterToCamera(cam_id){
   const filterSelect = document.getElementById(`filter-${cam_id}`);
   const filter_type = filterSelect.value.trim();
+  const scale = parseFloat(document.getElementById(`scale-${cam_id}`).value);
   
   try{
     const res = await fetch('/apply_filter', {
@@ -138,7 +140,9 @@ async function applyFilterToCamera(cam_id){
       headers: {'Content-Type': 'application/json'},
       body: JSON.stringify({
         cam_id: cam_id,
-        filter_type: filter_type
+        filter_type: filter_type,
+        scale: scale,
+        response: 'url'
       })
     });
     
@@ -157,7 +161,14 @@ async function applyFilterToCamera(cam_id){
     }
     
     if(typeof j.process_time_ms === 'number'){
-      timeBox.textContent = `Filter time: ${j.process_time_ms.toFixed(2)} ms`;
+      let text = `Filter time: ${j.process_time_ms.toFixed(2)} ms`;
+      if(j.stage_times_ms && j.stage_times_ms.length > 1){
+        text += ' (' + j.stage_times_ms.map(s => `${s.stage} ${s.ms.toFixed(2)}`).join(', ') + ')';
+      }
+      if(j.scale < 1){
+        text += ` @ ${j.scale.toFixed(2)}x` + (j.speedup ? `, ${j.speedup.toFixed(1)}x faster` : '');
+      }
+      timeBox.textContent = text;
     }
   }catch(err){
     alert('Error: ' + err);
@@ -165,3 +176,14 @@ async function applyFilterToCamera(cam_id){
   }
 }
 
+
+// Live filtered stream: the server filters every camera frame once and
+// shares the result with all viewers of the same camera + filter
+function streamFilterToCamera(cam_id){
+  const filter_type = document.getElementById(`filter-${cam_id}`).value.trim();
+  const scale = document.getElementById(`scale-${cam_id}`).value;
+  const resultImg = document.getElementById(`filter-result-${cam_id}`);
+  const timeBox = document.getElementById(`filter-time-${cam_id}`);
+  resultImg.src = `/processed_feed/${cam_id}?filter=${encodeURIComponent(filter_type)}&scale=${scale}&t=${Date.now()}`;
+  timeBox.textContent = `Live: ${filter_type}`;
+}
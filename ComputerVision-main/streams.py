@@ -0,0 +1,177 @@
+import threading
+import time
+import cv2
+from process import MOTION_GATE
+from pipeline import parse_spec, get_pipeline, check_scale
+from motion import MotionDetector, SKIPPED
+
+
+class ProcessedStream:
+    """
+    Filtered video for one camera + filter combination
+
+    A worker thread waits for the camera's newest frame, runs the filter
+    pipeline on it through the hub's ProcessingExecutor (so with the pool
+    mode the filter runs in a worker process, not under the server's GIL)
+    and encodes the result to JPEG once; every subscriber
+    gets the same bytes. Frames that arrive while a frame is being
+    processed are skipped, so the stream never falls behind the camera.
+    """
+
+    def __init__(self, hub, cam_id, cam, spec, scale=1.0, idle_timeout=5.0):
+        """
+        Args:
+            hub: ProcessedStreamHub that owns this stream
+            cam_id: Camera id (used for the intermediate cache key)
+            cam: VideoCamera to read frames from
+            spec: Normalized pipeline spec, e.g. 'gaussian|canny'
+            scale: Processing scale, see ImageProcessor.apply_pipeline
+            idle_timeout: Seconds without subscribers before the worker exits
+        """
+        self.hub = hub
+        self.cam_id = cam_id
+        self.cam = cam
+        self.spec = spec
+        self.scale = scale
+        self.idle_timeout = idle_timeout
+        # the stream's own motion model: the camera's processor may be
+        # in another process, and gates its own process_frame calls
+        self.motion = MotionDetector()
+        self.motion_gate = MOTION_GATE
+        self.subscribers = 0      # guarded by hub.lock
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.seq = 0
+        self.jpeg_bytes = None
+        self.processed = 0
+        self.skipped = 0
+        self.reused = 0           # frames skipped by the motion gate
+        self.motion_score = None
+        self.process_ms = 0.0
+        self.fps = 0.0
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+
+    def wait_for_jpeg(self, after_seq, timeout=None):
+        # (seq, JPEG bytes) of the newest result after after_seq; bytes None on timeout
+        with self.lock:
+            if not self.new_frame.wait_for(lambda: self.seq > after_seq, timeout):
+                return self.seq, None
+            return self.seq, self.jpeg_bytes
+
+    def _publish(self, jpeg_bytes):
+        with self.lock:
+            self.jpeg_bytes = jpeg_bytes
+            self.seq += 1
+            self.new_frame.notify_all()
+
+    def _worker(self):
+        cam_seq = -1
+        idle_since = None
+        last_time = None
+        while True:
+            seq, frame = self.cam.wait_for_frame(cam_seq, timeout=1.0)
+            if self.hub.idle(self):
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since >= self.idle_timeout and self.hub.retire(self):
+                    return
+            else:
+                idle_since = None
+            if frame is None:
+                if seq > cam_seq:
+                    # camera stopped: show the blank placeholder
+                    cam_seq = seq
+                    self._publish(None)
+                continue
+            if cam_seq >= 0 and seq - cam_seq > 1:
+                self.skipped += seq - cam_seq - 1
+            cam_seq = seq
+            if self.motion_gate:
+                motion = self.motion.update(frame)
+                self.motion_score = motion.score
+                if not motion.changed and self.jpeg_bytes is not None:
+                    # static scene: viewers keep the last result, no filter or encode
+                    self.reused += 1
+                    SKIPPED.inc('stream')
+                    continue
+            filtered, process_ms, _ = self.hub.executor.apply_pipeline(
+                self.cam_id, frame, self.spec, (self.cam_id, *self.cam.frame_key(seq)), self.scale)
+            ret, jpeg = cv2.imencode('.jpg', filtered, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+            self._publish(jpeg.tobytes() if ret else None)
+            self.motion.mark_processed()
+            now = time.monotonic()
+            if last_time is not None and now > last_time:
+                self.fps = 0.9 * self.fps + 0.1 / (now - last_time) if self.fps else 1.0 / (now - last_time)
+            last_time = now
+            self.processed += 1
+            self.process_ms = 0.9 * self.process_ms + 0.1 * process_ms if self.process_ms else process_ms
+
+    def get_stats(self):
+        return {
+            'cam_id': self.cam_id,
+            'filter': self.spec,
+            'scale': self.scale,
+            'subscribers': self.subscribers,
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'reused': self.reused,
+            'motion_score': None if self.motion_score is None else round(self.motion_score, 4),
+            'fps': round(self.fps, 2),
+            'process_ms': round(self.process_ms, 2),
+        }
+
+
+class ProcessedStreamHub:
+    """One ProcessedStream per (camera, filter, scale), created on first subscriber"""
+
+    def __init__(self, executor, idle_timeout=5.0):
+        """
+        Args:
+            executor: ProcessingExecutor the streams run their filters on
+            idle_timeout: Seconds without subscribers before a stream stops
+        """
+        self.executor = executor
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def subscribe(self, cam_id, cam, spec, scale=1.0):
+        """
+        Join (or start) the stream for cam_id + spec at the given scale
+
+        Raises:
+            ValueError: if spec is not a valid pipeline or scale is out of range
+        """
+        spec = '|'.join(parse_spec(spec))
+        scale = check_scale(scale)
+        get_pipeline(spec, scale)  # validate before starting a worker
+        with self.lock:
+            stream = self.streams.get((cam_id, spec, scale))
+            if stream is None or stream.cam is not cam:
+                stream = ProcessedStream(self, cam_id, cam, spec, scale, self.idle_timeout)
+                self.streams[(cam_id, spec, scale)] = stream
+                stream.thread.start()
+            stream.subscribers += 1
+            return stream
+
+    def unsubscribe(self, stream):
+        with self.lock:
+            stream.subscribers -= 1
+
+    def idle(self, stream):
+        with self.lock:
+            return stream.subscribers == 0
+
+    def retire(self, stream):
+        # called by an idle worker; False if someone subscribed meanwhile
+        with self.lock:
+            if stream.subscribers > 0:
+                return False
+            key = (stream.cam_id, stream.spec, stream.scale)
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+            return True
+
+    def get_stats(self):
+        with self.lock:
+            streams = list(self.streams.values())
+        return [stream.get_stats() for stream in streams]
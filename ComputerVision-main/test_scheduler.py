@@ -0,0 +1,65 @@
+import threading
+import time
+import numpy as np
+import pytest
+from scheduler import FrameScheduler, NoFrameError, SchedulerClosedError
+
+
+class FakeCamera:
+    def __init__(self):
+        self.seq = 1
+        self.frame = np.zeros((4, 4, 3), np.uint8)
+
+    def get_frame_timed(self):
+        return self.seq, self.frame, None
+
+
+def test_submit_runs_on_newest_frame():
+    sched = FrameScheduler(FakeCamera())
+    assert sched.submit('op', lambda seq, frame: frame.shape, timeout=5) == (1, (4, 4, 3))
+    sched.close()
+
+
+def test_submit_after_close_raises():
+    sched = FrameScheduler(FakeCamera())
+    sched.submit('op', lambda seq, frame: None, timeout=5)
+    sched.close()
+    sched.thread.join(timeout=5)
+    with pytest.raises(SchedulerClosedError):
+        sched.submit('op', lambda seq, frame: None, timeout=5)
+    # still a NoFrameError for callers that only handle that
+    with pytest.raises(NoFrameError):
+        sched.submit('other', lambda seq, frame: None, timeout=5)
+
+
+def test_close_fails_queued_jobs():
+    sched = FrameScheduler(FakeCamera())
+    started, release = threading.Event(), threading.Event()
+
+    def slow(seq, frame):
+        started.set()
+        release.wait(5)
+        return 'slow'
+
+    results = {}
+
+    def call(op_key, fn):
+        try:
+            results[op_key] = sched.submit(op_key, fn, timeout=5)[1]
+        except Exception as e:
+            results[op_key] = e
+
+    running = threading.Thread(target=call, args=('slow', slow))
+    running.start()
+    assert started.wait(5)
+    queued = threading.Thread(target=call, args=('queued', lambda seq, frame: 'queued'))
+    queued.start()
+    while sched.get_stats()['queue_depth'] == 0:
+        time.sleep(0.001)
+    sched.close()
+    queued.join(5)
+    release.set()
+    running.join(5)
+    # the running job finishes, the queued one fails instead of hanging
+    assert results['slow'] == 'slow'
+    assert isinstance(results['queued'], SchedulerClosedError)
@@ -0,0 +1,227 @@
+import numpy as np
+
+
+def box_iou(a, b):
+    """
+    Intersection over union of paired boxes
+
+    Args:
+        a, b: (K, 4) arrays of x, y, w, h; row i of a is compared with row i of b
+
+    Returns:
+        (K,) float32 array
+    """
+    iw = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+    ih = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+    inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+    union = a[:, 2] * a[:, 3] + b[:, 2] * b[:, 3] - inter
+    return (inter / np.maximum(union, 1e-6)).astype(np.float32)
+
+
+def greedy_assign(rows, cols, costs, n_rows, n_cols):
+    """
+    Match rows to columns, lowest cost first, from a sparse list of pairs
+
+    Each round takes every pair that is the cheapest one left for both its
+    row and its column (such pairs never compete with each other), then
+    drops the pairs touching a matched row or column. Rounds are whole-array
+    NumPy operations and most pairs settle in the first one or two; the
+    result equals a sequential greedy matching.
+
+    Args:
+        rows, cols, costs: Candidate pairs (gated ones left out)
+        n_rows, n_cols: Number of rows and columns
+
+    Returns:
+        (rows, cols): int arrays of matched indices
+    """
+    order = np.argsort(costs, kind='stable')
+    rows, cols = rows[order], cols[order]
+    row_done = np.zeros(n_rows, bool)
+    col_done = np.zeros(n_cols, bool)
+    matched_rows, matched_cols = [], []
+    while len(rows):
+        # in cost order, the first pair of a row (column) is its cheapest
+        first_of_row = np.zeros(len(rows), bool)
+        first_of_row[np.unique(rows, return_index=True)[1]] = True
+        first_of_col = np.zeros(len(rows), bool)
+        first_of_col[np.unique(cols, return_index=True)[1]] = True
+        mutual = first_of_row & first_of_col
+        r, c = rows[mutual], cols[mutual]
+        matched_rows.append(r)
+        matched_cols.append(c)
+        row_done[r] = True
+        col_done[c] = True
+        keep = ~(row_done[rows] | col_done[cols])
+        rows, cols = rows[keep], cols[keep]
+    if not matched_rows:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    return np.concatenate(matched_rows), np.concatenate(matched_cols)
+
+
+class ObjectTracker:
+    """
+    Multi-object tracker on centroid distance and box overlap
+
+    Tracks live in parallel NumPy arrays (box, velocity, id, age, hits,
+    missed) instead of one Python object each, so predicting, associating
+    and updating hundreds of tracks per frame are a handful of array
+    operations. Each frame the tracks are moved by their velocity, pairs of
+    track and detection farther apart than max_distance (and not
+    overlapping) are gated out, and the rest get a cost of (1 - IoU) plus
+    normalized centroid distance and are matched greedily.
+    Unmatched detections start new tracks with increasing ids; tracks
+    unmatched for more than max_missed frames are dropped.
+    """
+
+    def __init__(self, max_distance=50.0, iou_weight=0.5, max_missed=5, min_hits=1, capacity=64):
+        """
+        Args:
+            max_distance: Largest centroid jump (pixels per frame) that can
+                          still be the same object
+            iou_weight: Share of (1 - IoU) in the cost; the rest is distance
+            max_missed: Frames a track survives without a detection
+            min_hits: Detections before a track is reported as confirmed
+            capacity: Initial array size (grows by doubling)
+        """
+        self.max_distance = float(max_distance)
+        self.iou_weight = iou_weight
+        self.max_missed = max_missed
+        self.min_hits = min_hits
+        self.next_id = 1
+        self.count = 0
+        self.frames = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        self.boxes = np.zeros((capacity, 4), np.float32)     # x, y, w, h
+        self.velocity = np.zeros((capacity, 2), np.float32)  # centroid dx, dy per frame
+        self.ids = np.zeros(capacity, np.int64)
+        self.age = np.zeros(capacity, np.int32)
+        self.hits = np.zeros(capacity, np.int32)
+        self.missed = np.zeros(capacity, np.int32)
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        old = (self.boxes, self.velocity, self.ids, self.age, self.hits, self.missed)
+        self._alloc(capacity)
+        for new, arr in zip((self.boxes, self.velocity, self.ids, self.age, self.hits, self.missed), old):
+            new[:self.count] = arr[:self.count]
+
+    def reset(self):
+        self.count = 0
+        self.next_id = 1
+        self.frames = 0
+
+    def update(self, detections):
+        """
+        Advance all tracks by one frame
+
+        Args:
+            detections: Sequence or (M, 4) array of x, y, w, h boxes
+
+        Returns:
+            (M,) int64 array: track id of each detection
+        """
+        dets = np.asarray(detections, np.float32).reshape(-1, 4)
+        n, m = self.count, len(dets)
+        self.frames += 1
+
+        # predict: shift each box by its velocity
+        boxes = self.boxes[:n]
+        boxes[:, :2] += self.velocity[:n]
+        self.age[:n] += 1
+
+        det_ids = np.zeros(m, np.int64)
+        matched_tracks = np.zeros(n, bool)
+        if n and m:
+            centers = boxes[:, :2] + boxes[:, 2:] / 2
+            det_centers = dets[:, :2] + dets[:, 2:] / 2
+            rows, cols = self._candidates(boxes, centers, dets, det_centers)
+            dist = np.sqrt(((centers[rows] - det_centers[cols]) ** 2).sum(axis=1))
+            iou = box_iou(boxes[rows], dets[cols])
+            # gate: too far apart and not overlapping
+            ok = (dist <= self.max_distance) | (iou > 0)
+            rows, cols, dist, iou = rows[ok], cols[ok], dist[ok], iou[ok]
+            cost = self.iou_weight * (1 - iou) + (1 - self.iou_weight) * np.minimum(dist / self.max_distance, 1)
+            rows, cols = greedy_assign(rows, cols, cost, n, m)
+
+            # update matched tracks from their detections; the offset from the
+            # predicted centre corrects the velocity (moving average)
+            self.velocity[rows] += 0.5 * (det_centers[cols] - centers[rows])
+            boxes[rows] = dets[cols]
+            self.hits[rows] += 1
+            self.missed[rows] = 0
+            matched_tracks[rows] = True
+            det_ids[cols] = self.ids[rows]
+
+        # age out unmatched tracks, then compact the arrays in place
+        self.missed[:n][~matched_tracks] += 1
+        keep = self.missed[:n] <= self.max_missed
+        if not keep.all():
+            k = int(keep.sum())
+            for arr in (self.boxes, self.velocity, self.ids, self.age, self.hits, self.missed):
+                arr[:k] = arr[:n][keep]
+            n = k
+
+        # new tracks for unmatched detections
+        new = np.flatnonzero(det_ids == 0)
+        if len(new):
+            self._grow(n + len(new))
+            end = n + len(new)
+            new_ids = np.arange(self.next_id, self.next_id + len(new), dtype=np.int64)
+            self.next_id += len(new)
+            self.boxes[n:end] = dets[new]
+            self.velocity[n:end] = 0
+            self.ids[n:end] = new_ids
+            self.age[n:end] = 1
+            self.hits[n:end] = 1
+            self.missed[n:end] = 0
+            det_ids[new] = new_ids
+            n = end
+        self.count = n
+        return det_ids
+
+    def _candidates(self, boxes, centers, dets, det_centers):
+        # pairs whose centres are within reach on both axes: max_distance, or
+        # half the summed box sizes (boxes that may overlap). Detections are
+        # sorted by x and each track takes the window it can reach, so only
+        # nearby pairs are ever materialized.
+        order = np.argsort(det_centers[:, 0], kind='stable')
+        xs = det_centers[order, 0]
+        reach_x = np.maximum(self.max_distance, (boxes[:, 2] + dets[:, 2].max()) / 2)
+        lo = np.searchsorted(xs, centers[:, 0] - reach_x, 'left')
+        hi = np.searchsorted(xs, centers[:, 0] + reach_x, 'right')
+        counts = hi - lo
+        rows = np.repeat(np.arange(len(boxes)), counts)
+        starts = np.cumsum(counts) - counts
+        cols = order[lo[rows] + np.arange(len(rows)) - starts[rows]]
+        reach = np.maximum(self.max_distance, (boxes[rows, 2:] + dets[cols, 2:]) / 2)
+        near = (np.abs(centers[rows] - det_centers[cols]) <= reach).all(axis=1)
+        return rows[near], cols[near]
+
+    def tracks(self, confirmed_only=True):
+        """
+        Current tracks
+
+        Returns:
+            list of dict: id, box (x, y, w, h), velocity, age, missed
+        """
+        n = self.count
+        sel = np.arange(n)
+        if confirmed_only:
+            sel = sel[self.hits[:n] >= self.min_hits]
+        return [{
+            'id': int(self.ids[i]),
+            'box': [int(round(v)) for v in self.boxes[i]],
+            'velocity': [round(float(v), 2) for v in self.velocity[i]],
+            'age': int(self.age[i]),
+            'missed': int(self.missed[i]),
+        } for i in sel]
+
+    def __len__(self):
+        return self.count
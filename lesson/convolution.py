@@ -0,0 +1,257 @@
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# border name -> np.pad mode (the names follow OpenCV's BORDER_* constants)
+BORDER_MODES = {
+    'reflect101': 'reflect',     # gfedcb|abcdefgh|gfedcba (OpenCV default)
+    'reflect': 'symmetric',      # fedcba|abcdefgh|hgfedcb
+    'replicate': 'edge',         # aaaaaa|abcdefgh|hhhhhhh
+    'constant': 'constant',      # 000000|abcdefgh|0000000
+    'wrap': 'wrap',              # cdefgh|abcdefgh|abcdefg
+}
+
+# crossover points measured with benchmark() at 1080p (see __main__):
+# rank-1 kernels up to this size use two 1-D passes ...
+SEPARABLE_MAX_SIZE = 11
+# ... and other kernels with at least this many taps go through the FFT
+FFT_MIN_TAPS = 7 * 7
+
+# largest difference from cv2.filter2D accepted by check_parity (the worst
+# case measured is ~7e-12 on 0-255 images, float64 rounding)
+PARITY_TOL = 1e-9
+
+
+def pad_image(img, kernel_shape, border='reflect101'):
+    """
+    Pad img so that a 'same' size output can be computed without bounds checks
+
+    The anchor is the kernel centre (kh // 2, kw // 2), as in cv2.filter2D.
+    """
+    if border not in BORDER_MODES:
+        raise ValueError(f"unknown border mode '{border}'")
+    kh, kw = kernel_shape
+    pad = ((kh // 2, kh - 1 - kh // 2), (kw // 2, kw - 1 - kw // 2))
+    return np.pad(img, pad, mode=BORDER_MODES[border])
+
+
+def separate_kernel(kernel, tol=1e-10):
+    """
+    Split a rank-1 kernel into column and row vectors
+
+    Returns:
+        (col, row) with kernel == np.outer(col, row), or None if the kernel
+        is not separable (e.g. a Laplacian)
+    """
+    u, s, vt = np.linalg.svd(kernel)
+    if s[0] == 0 or (len(s) > 1 and s[1] > tol * s[0]):
+        return None
+    scale = np.sqrt(s[0])
+    return u[:, 0] * scale, vt[0] * scale
+
+
+def convolve_direct(img, kernel, border='reflect101'):
+    # one strided view of every kernel-sized window, reduced with einsum
+    padded = pad_image(img, kernel.shape, border)
+    windows = sliding_window_view(padded, kernel.shape)
+    return np.einsum('ijkl,kl->ij', windows, kernel)
+
+
+def convolve_separable(img, kernel, border='reflect101', parts=None):
+    # vertical 1-D pass, then horizontal 1-D pass: kh + kw taps instead of kh * kw;
+    # each tap is one whole-image multiply-add on a shifted slice
+    col, row = separate_kernel(kernel) if parts is None else parts
+    h, w = img.shape
+    padded = pad_image(img, kernel.shape, border)
+    tmp = col[0] * padded[0:h]
+    for i in range(1, len(col)):
+        tmp += col[i] * padded[i:i + h]
+    out = row[0] * tmp[:, 0:w]
+    for j in range(1, len(row)):
+        out += row[j] * tmp[:, j:j + w]
+    return out
+
+
+def _fast_len(n):
+    # next size made of the factors 2, 3 and 5 (fast for the FFT)
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def convolve_fft(img, kernel, border='reflect101'):
+    # correlation == convolution with the flipped kernel; keep the 'valid' part
+    kh, kw = kernel.shape
+    h, w = img.shape
+    padded = pad_image(img, kernel.shape, border)
+    fh = _fast_len(padded.shape[0] + kh - 1)
+    fw = _fast_len(padded.shape[1] + kw - 1)
+    spectrum = np.fft.rfft2(padded, (fh, fw)) * np.fft.rfft2(kernel[::-1, ::-1], (fh, fw))
+    full = np.fft.irfft2(spectrum, (fh, fw))
+    return full[kh - 1:kh - 1 + h, kw - 1:kw - 1 + w]
+
+
+def choose_method(kernel):
+    # 'separable' for small rank-1 kernels, 'fft' for large kernels, else 'direct'
+    if 1 < min(kernel.shape) and max(kernel.shape) <= SEPARABLE_MAX_SIZE and separate_kernel(kernel) is not None:
+        return 'separable'
+    if kernel.size >= FFT_MIN_TAPS:
+        return 'fft'
+    return 'direct'
+
+
+METHODS = {
+    'direct': convolve_direct,
+    'separable': convolve_separable,
+    'fft': convolve_fft,
+}
+
+
+def convolve(img, kernel, border='reflect101', method='auto'):
+    """
+    Filter an image with an arbitrary kernel
+
+    Like cv2.filter2D (and the original lesson code) this computes the
+    correlation sum(window * kernel) without flipping the kernel; for the
+    symmetric and anti-symmetric kernels used in the lessons the result is
+    the convolution up to sign.
+
+    Args:
+        img: 2-D image, or 3-D with channels last (filtered per channel)
+        kernel: 2-D kernel of any size
+        border: 'reflect101', 'reflect', 'replicate', 'constant' or 'wrap'
+        method: 'auto', 'direct', 'separable' or 'fft'
+
+    Returns:
+        float64 array with the same shape as img
+    """
+    img = np.asarray(img, dtype=np.float64)
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.ndim != 2:
+        raise ValueError("kernel must be 2-D")
+    if method == 'auto':
+        method = choose_method(kernel)
+    if method not in METHODS:
+        raise ValueError(f"unknown method '{method}'")
+    if method == 'separable' and separate_kernel(kernel) is None:
+        raise ValueError("kernel is not separable")
+    fn = METHODS[method]
+    if img.ndim == 3:
+        return np.dstack([fn(img[:, :, c], kernel, border) for c in range(img.shape[2])])
+    return fn(img, kernel, border)
+
+
+# =============================================================================
+# PARITY CHECK AND BENCHMARK
+# =============================================================================
+
+def check_parity(shape=(240, 320), seed=0, tol=PARITY_TOL):
+    """
+    Compare every method and border mode against cv2.filter2D
+
+    Args:
+        shape: Size of the random test image
+        seed: Seed of the test image and random kernels
+        tol: Largest accepted max abs error (None only reports)
+
+    Returns:
+        List of (kernel name, method, border, max abs error)
+
+    Raises:
+        AssertionError: if any combination differs by more than tol
+    """
+    import cv2
+    borders = {
+        'reflect101': cv2.BORDER_REFLECT_101,
+        'reflect': cv2.BORDER_REFLECT,
+        'replicate': cv2.BORDER_REPLICATE,
+        'constant': cv2.BORDER_CONSTANT,
+        'wrap': cv2.BORDER_WRAP,
+    }
+    rng = np.random.default_rng(seed)
+    img = rng.uniform(0, 255, shape)
+    g = cv2.getGaussianKernel(7, 1.5)
+    kernels = {
+        'sobel 3x3': np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float64),
+        'gaussian 7x7': g @ g.T,
+        'random 4x6': rng.normal(size=(4, 6)),
+        'random 21x21': rng.normal(size=(21, 21)),
+    }
+    rows = []
+    for name, kernel in kernels.items():
+        methods = ['direct', 'fft'] + (['separable'] if separate_kernel(kernel) is not None else [])
+        for border, cv_border in borders.items():
+            if border == 'wrap':
+                # filter2D rejects BORDER_WRAP: pad with copyMakeBorder, then crop
+                kh, kw = kernel.shape
+                top, left = kh // 2, kw // 2
+                padded = cv2.copyMakeBorder(img, top, kh - 1 - top, left, kw - 1 - left, cv_border)
+                ref = cv2.filter2D(padded, cv2.CV_64F, kernel)[top:top + shape[0], left:left + shape[1]]
+            else:
+                ref = cv2.filter2D(img, cv2.CV_64F, kernel, borderType=cv_border)
+            for method in methods:
+                out = convolve(img, kernel, border, method)
+                rows.append((name, method, border, float(np.abs(out - ref).max())))
+    failed = [row for row in rows if tol is not None and not row[3] <= tol]
+    if failed:
+        raise AssertionError("convolution differs from cv2.filter2D: " + ", ".join(
+            f"{name} {method} {border} {err:.2e}" for name, method, border, err in failed))
+    return rows
+
+
+def benchmark(shape=(1080, 1920), sizes=(3, 5, 9, 15, 31), repeat=3, seed=0):
+    """
+    Time each method (and cv2.filter2D) for Gaussian and random kernels
+
+    Returns:
+        List of (kernel name, {method: time in ms}, auto-chosen method)
+    """
+    import cv2
+    rng = np.random.default_rng(seed)
+    img = rng.uniform(0, 255, shape)
+
+    def best(fn):
+        t_best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            t_best = min(t_best, time.perf_counter() - t0)
+        return t_best * 1000
+
+    rows = []
+    for k in sizes:
+        g = cv2.getGaussianKernel(k, 0)
+        for name, kernel in ((f'gaussian {k}x{k}', g @ g.T), (f'random {k}x{k}', rng.normal(size=(k, k)))):
+            times = {}
+            for method in ('direct', 'separable', 'fft'):
+                if method == 'separable' and separate_kernel(kernel) is None:
+                    continue
+                if method == 'direct' and k > 15:
+                    continue  # minutes at 1080p, not informative
+                times[method] = best(lambda: convolve(img, kernel, method=method))
+            times['cv2.filter2D'] = best(lambda: cv2.filter2D(img, cv2.CV_64F, kernel))
+            rows.append((name, times, choose_method(kernel)))
+    return rows
+
+
+if __name__ == '__main__':
+    print("Parity against cv2.filter2D (max abs error, image values 0-255)")
+    worst = 0.0
+    for name, method, border, err in check_parity(tol=None):
+        worst = max(worst, err)
+        print(f"  {name:<14}{method:<11}{border:<12}{err:.2e}")
+    print(f"  worst: {worst:.2e} (tolerance {PARITY_TOL:.0e})")
+    if not worst <= PARITY_TOL:
+        raise SystemExit("parity check failed")
+    print()
+    columns = ('direct', 'separable', 'fft', 'cv2.filter2D')
+    print("Benchmark on a 1920x1080 float64 image (ms)")
+    print(f"  {'kernel':<16}" + ''.join(f"{c:>14}" for c in columns) + f"{'auto':>11}")
+    for name, times, auto in benchmark():
+        cells = ''.join(f"{times[c]:>14.1f}" if c in times else f"{'-':>14}" for c in columns)
+        print(f"  {name:<16}{cells}{auto:>11}")
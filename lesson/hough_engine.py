@@ -0,0 +1,204 @@
+import time
+import numpy as np
+import cv2
+
+
+class HoughLineEngine:
+    """
+    Vectorized standard Hough transform for lines
+
+    A line is x*cos(theta) + y*sin(theta) = rho. Every edge pixel votes for
+    one rho per theta; the votes of a chunk of pixels are turned into flat
+    (rho, theta) indices and counted with np.bincount, so there is no Python
+    loop over pixels or angles. Trig tables and the accumulator geometry are
+    computed once per image size and reused.
+    """
+
+    def __init__(self, theta_step_deg=1.0, rho_step=1.0, theta_range_deg=(-90, 90), chunk_votes=4_000_000):
+        """
+        Args:
+            theta_step_deg: Angular resolution in degrees
+            rho_step: Distance resolution in pixels
+            theta_range_deg: Half-open range of theta in degrees
+            chunk_votes: Maximum number of votes computed at once; bounds the
+                         temporary memory to about 16 bytes per vote
+        """
+        self.theta_step_deg = theta_step_deg
+        self.rho_step = rho_step
+        self.thetas = np.deg2rad(np.arange(theta_range_deg[0], theta_range_deg[1], theta_step_deg))
+        self.cos_t = np.cos(self.thetas)
+        self.sin_t = np.sin(self.thetas)
+        self.chunk_votes = chunk_votes
+        self._shape = None
+        self.diag_len = 0
+        self.rhos = None
+
+    def _prepare(self, shape):
+        # accumulator geometry depends only on the image size
+        if shape == self._shape:
+            return
+        rows, cols = shape
+        diag = np.sqrt(rows ** 2 + cols ** 2)
+        self.diag_len = int(np.ceil(diag / self.rho_step))
+        self.rhos = np.linspace(-self.diag_len, self.diag_len, 2 * self.diag_len) * self.rho_step
+        self._shape = shape
+
+    def accumulate(self, edges):
+        """
+        Vote in (rho, theta) space
+
+        Args:
+            edges: Binary edge image (non-zero pixels vote)
+
+        Returns:
+            accumulator: int64 array of shape (2 * diag_len, len(thetas)),
+                         row index = rho / rho_step + diag_len
+        """
+        self._prepare(edges.shape)
+        n_theta = len(self.thetas)
+        n_bins = 2 * self.diag_len * n_theta
+        y_idxs, x_idxs = np.nonzero(edges)
+        # scale trig tables once instead of dividing every vote by rho_step
+        cos_t = self.cos_t / self.rho_step
+        sin_t = self.sin_t / self.rho_step
+        theta_idx = np.arange(n_theta)
+        accumulator = np.zeros(n_bins, dtype=np.int64)
+        chunk = max(1, self.chunk_votes // n_theta)
+        for start in range(0, len(x_idxs), chunk):
+            x = x_idxs[start:start + chunk, None].astype(np.float64)
+            y = y_idxs[start:start + chunk, None].astype(np.float64)
+            rho_idx = np.rint(x * cos_t + y * sin_t).astype(np.int64)
+            rho_idx += self.diag_len
+            flat = rho_idx * n_theta + theta_idx
+            accumulator += np.bincount(flat.ravel(), minlength=n_bins)
+        return accumulator.reshape(2 * self.diag_len, n_theta)
+
+    def find_peaks(self, accumulator, threshold, num_peaks=None, nms_size=(9, 9)):
+        """
+        Local maxima of the accumulator with non-maximum suppression
+
+        Args:
+            accumulator: Output of accumulate()
+            threshold: Minimum number of votes for a line
+            num_peaks: Return at most this many lines (strongest first)
+            nms_size: (rho bins, theta bins) neighbourhood in which only the
+                      strongest peak survives
+
+        Returns:
+            List of (rho, theta, votes), strongest first
+        """
+        acc = accumulator.astype(np.float32)
+        kernel = np.ones(nms_size, dtype=np.uint8)
+        local_max = cv2.dilate(acc, kernel)
+        rho_idx, theta_idx = np.nonzero((acc >= threshold) & (acc == local_max))
+        votes = accumulator[rho_idx, theta_idx]
+        order = np.argsort(-votes, kind='stable')
+        # plateaus give several equal maxima; keep the first one per window
+        half_r, half_t = nms_size[0] // 2, nms_size[1] // 2
+        kept = []
+        for i in order:
+            r, t = rho_idx[i], theta_idx[i]
+            if any(abs(r - kr) <= half_r and abs(t - kt) <= half_t for kr, kt in kept):
+                continue
+            kept.append((r, t))
+            if num_peaks is not None and len(kept) >= num_peaks:
+                break
+        return [((r - self.diag_len) * self.rho_step, self.thetas[t], int(accumulator[r, t])) for r, t in kept]
+
+    def detect(self, edges, threshold, num_peaks=None, nms_size=(9, 9)):
+        """
+        Detect lines in an edge image
+
+        Returns:
+            List of (rho, theta) pairs, strongest first
+        """
+        accumulator = self.accumulate(edges)
+        return [(rho, theta) for rho, theta, _ in self.find_peaks(accumulator, threshold, num_peaks, nms_size)]
+
+
+def hough_accumulate_loop(edges, thetas):
+    """Reference per-pixel loop (the original lesson code), for benchmarks"""
+    rows, cols = edges.shape
+    diag_len = int(np.ceil(np.sqrt(rows ** 2 + cols ** 2)))
+    accumulator = np.zeros((2 * diag_len, len(thetas)), dtype=np.uint64)
+    y_idxs, x_idxs = np.nonzero(edges)
+    for i in range(len(x_idxs)):
+        x = x_idxs[i]
+        y = y_idxs[i]
+        for t_idx in range(len(thetas)):
+            theta = thetas[t_idx]
+            rho = int(round(x * np.cos(theta) + y * np.sin(theta))) + diag_len
+            accumulator[rho, t_idx] += 1
+    return accumulator
+
+
+def draw_lines(img, lines, color=(0, 0, 255), thickness=2):
+    # draw (rho, theta) lines across the whole image
+    for rho, theta in lines:
+        a = np.cos(theta)
+        b = np.sin(theta)
+        x0 = a * rho
+        y0 = b * rho
+        x1 = int(x0 + 1000 * (-b))
+        y1 = int(y0 + 1000 * (a))
+        x2 = int(x0 - 1000 * (-b))
+        y2 = int(y0 - 1000 * (a))
+        cv2.line(img, (x1, y1), (x2, y2), color, thickness)
+    return img
+
+
+def _best_time(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def benchmark(edges, threshold=100, repeat=3, loop_pixels=2000):
+    """
+    Compare the Python loop, the vectorized engine and cv2.HoughLines
+
+    The loop is only run on the first loop_pixels edge pixels and its time
+    is extrapolated, since the full image takes far too long.
+
+    Returns:
+        List of (method, time in ms, number of lines)
+    """
+    engine = HoughLineEngine()
+    n_edges = int(np.count_nonzero(edges))
+    rows = []
+
+    y_idxs, x_idxs = np.nonzero(edges)
+    sample = np.zeros_like(edges)
+    sample[y_idxs[:loop_pixels], x_idxs[:loop_pixels]] = 255
+    n_sample = int(np.count_nonzero(sample))
+    loop_ms = _best_time(lambda: hough_accumulate_loop(sample, engine.thetas), 1)
+    # the loop and the engine must agree on the votes
+    assert np.array_equal(hough_accumulate_loop(sample, engine.thetas).astype(np.int64), engine.accumulate(sample))
+    rows.append(('python loop (extrapolated)', loop_ms * n_edges / max(n_sample, 1), None))
+
+    vec_ms = _best_time(lambda: engine.detect(edges, threshold), repeat)
+    rows.append(('vectorized + NMS', vec_ms, len(engine.detect(edges, threshold))))
+
+    cv_ms = _best_time(lambda: cv2.HoughLines(edges, 1, np.pi / 180, threshold), repeat)
+    cv_lines = cv2.HoughLines(edges, 1, np.pi / 180, threshold)
+    rows.append(('cv2.HoughLines (no NMS)', cv_ms, 0 if cv_lines is None else len(cv_lines)))
+    return rows
+
+
+if __name__ == '__main__':
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else 'lane.jpg'
+    img = cv2.imread(path)
+    if img is None:
+        # no image next to us: synthetic 1080p frame with a few lines
+        img = np.zeros((1080, 1920, 3), dtype=np.uint8)
+        for k in range(6):
+            cv2.line(img, (0, 100 + 150 * k), (1919, 300 + 100 * k), (255, 255, 255), 2)
+    edges = cv2.Canny(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 100, 130)
+    print(f"{path}: {img.shape[1]}x{img.shape[0]}, {np.count_nonzero(edges)} edge pixels")
+    print(f"{'method':<30}{'time (ms)':>12}{'lines':>8}")
+    for method, ms, n_lines in benchmark(edges):
+        print(f"{method:<30}{ms:>12.1f}{'-' if n_lines is None else n_lines:>8}")
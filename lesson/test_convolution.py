@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from convolution import check_parity, convolve, PARITY_TOL
+
+
+def test_parity_with_filter2d():
+    # raises if any method/border combination drifts from cv2.filter2D
+    rows = check_parity(shape=(60, 80))
+    assert rows and max(err for *_, err in rows) <= PARITY_TOL
+
+
+def test_parity_failure_is_reported():
+    with pytest.raises(AssertionError):
+        check_parity(shape=(60, 80), tol=0.0)
+
+
+def test_channels_filtered_separately():
+    img = np.random.default_rng(0).uniform(0, 255, (20, 30, 3))
+    kernel = np.ones((3, 3)) / 9
+    out = convolve(img, kernel)
+    for c in range(3):
+        np.testing.assert_allclose(out[:, :, c], convolve(img[:, :, c], kernel))